@@ -1,11 +1,13 @@
 # [file name]: advanced_routes.py
 # [file content begin]
-from flask import Blueprint, jsonify, request, send_file, render_template
+from flask import Blueprint, Response, jsonify, request, send_file, render_template
 import os
 from datetime import datetime
 import json
 import tempfile
 
+from metrics import stage
+
 def create_advanced_routes(app, mongo):
     # ✅ FIX: Correct blueprint definition
     advanced_bp = Blueprint("advanced_bp", __name__)
@@ -108,13 +110,22 @@ def create_advanced_routes(app, mongo):
     def analyze_depth():
         """Analyze quarry depth from DEM data"""
         try:
-            from depth_analysis import calculate_quarry_depth, generate_depth_visualization
+            from depth_analysis import (calculate_quarry_depth, depth_visualization_path,
+                                        save_depth_visualization)
             
-            depth_data, stats, transform, crs = calculate_quarry_depth("cropped.tif")
+            data = request.get_json(silent=True) or {}
+            fill_voids = bool(data.get("fill_voids", False))
+            boundary = data.get("coords")
+            with stage("depth"):
+                depth_data, stats, transform, crs = calculate_quarry_depth(
+                    "cropped.tif", fill_voids=fill_voids, boundary=boundary)
             
             # Save depth visualization
-            viz_path = "static/Figure/depth_analysis.png"
-            generate_depth_visualization(depth_data, viz_path)
+            viz_path = depth_visualization_path("cropped.tif", fill_voids=fill_voids,
+                                                boundary=boundary)
+            with stage("render"):
+                save_depth_visualization("cropped.tif", viz_path, fill_voids=fill_voids,
+                                         boundary=boundary)
             
             return jsonify({
                 "status": "success",
@@ -131,7 +142,11 @@ def create_advanced_routes(app, mongo):
         try:
             from volume_calculator import calculate_excavation_volume
             
-            volume_data = calculate_excavation_volume("cropped.tif")
+            data = request.get_json(silent=True) or {}
+            with stage("volume"):
+                volume_data = calculate_excavation_volume(
+                    "cropped.tif", fill_voids=bool(data.get("fill_voids", False)),
+                    boundary=data.get("coords"))
             
             return jsonify({
                 "status": "success", 
@@ -157,6 +172,245 @@ def create_advanced_routes(app, mongo):
         except Exception as e:
             return jsonify({"status": "error", "message": str(e)})
 
+    @advanced_bp.route("/api/stability_zones", methods=["POST"])
+    def stability_zones():
+        """Classify highwall/bench stability zones as GeoJSON polygons"""
+        try:
+            from slope_analysis import analyze_stability_zones
+
+            data = request.get_json(silent=True) or {}
+            min_pixels = int(data.get("min_pixels", 4))
+
+            with stage("stability_zones"):
+                zones = analyze_stability_zones("cropped.tif", min_pixels=min_pixels)
+
+            return jsonify({
+                "status": "success",
+                "zones": zones
+            })
+
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)})
+
+    @advanced_bp.route("/api/hydrology", methods=["POST"])
+    def hydrology():
+        """Pit lakes of the DEM: spill level, fill depth, ponded volume and outlet"""
+        try:
+            from hydrology import MIN_FILL_DEPTH, analyze_depressions
+
+            data = request.get_json(silent=True) or {}
+            min_depth = float(data.get("min_depth", MIN_FILL_DEPTH))
+
+            with stage("hydrology"):
+                ponding = analyze_depressions("cropped.tif", min_depth=min_depth)
+
+            return jsonify({
+                "status": "success",
+                "hydrology": ponding
+            })
+
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)})
+
+    @advanced_bp.route("/api/analysis", methods=["POST"])
+    def analysis():
+        """
+        Several analysis products from one read of the DEM, e.g.
+        {"products": ["depth", "volume", "slope", "stability_zones", "hydrology", "3d", "visualization"]}
+        """
+        try:
+            from analysis_pipeline import DEFAULT_PRODUCTS, run_analysis
+
+            data = request.get_json(silent=True) or {}
+            products = data.get("products") or list(DEFAULT_PRODUCTS)
+            if isinstance(products, str):
+                products = [product.strip() for product in products.split(",")]
+
+            try:
+                result = run_analysis(
+                    "cropped.tif",
+                    products=products,
+                    reference_point=data.get("reference_point"),
+                    reference_elevation=data.get("reference_elevation"),
+                    fill_voids=bool(data.get("fill_voids", False)),
+                    boundary=data.get("coords"),
+                    min_pixels=int(data.get("min_pixels", 4)),
+                )
+            except ValueError as e:
+                return jsonify({"status": "error", "message": str(e)}), 400
+
+            if "depth" in result["products"]:
+                from analysis_store import record_analysis
+                visualization = result["products"].get("visualization", {}).get("path")
+                result["analysis_id"] = record_analysis(mongo, "cropped.tif", result["products"]["depth"],
+                                                        data, visualization)
+
+            return jsonify({"status": "success", **result})
+
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)})
+
+    @advanced_bp.route("/api/cache/analysis", methods=["GET"])
+    def analysis_cache_stats():
+        """Hit rates and sizes of the memoised analysis results"""
+        from result_cache import result_cache
+        return jsonify({"status": "success", "cache": result_cache.stats()})
+
+    @advanced_bp.route("/api/cache/rasters", methods=["GET"])
+    def raster_store_stats():
+        """Size and deduplication of the content-addressed raster store"""
+        from raster_store import raster_store
+        return jsonify({"status": "success", "store": raster_store.stats()})
+
+    @advanced_bp.route("/api/cache/analysis", methods=["DELETE"])
+    def invalidate_analysis_cache():
+        """
+        Drop memoised results: ?raster=<content hash> and/or ?analysis=<name>,
+        ?raster=current for the analysed DEM, or everything without arguments
+        """
+        import re
+
+        try:
+            from raster_store import raster_hash
+            from result_cache import result_cache
+
+            source_hash = request.args.get("raster")
+            if source_hash not in (None, "current") and not re.fullmatch(r"[0-9a-f]{40}", source_hash):
+                return jsonify({"status": "error", "message": "Invalid raster hash"}), 400
+            if source_hash == "current":
+                if not os.path.exists("cropped.tif"):
+                    return jsonify({"status": "error", "message": "No analysed DEM available"}), 404
+                source_hash = raster_hash("cropped.tif")
+            removed = result_cache.invalidate(source_hash, request.args.get("analysis"))
+            return jsonify({"status": "success", "removed": removed})
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)})
+
+    @advanced_bp.route("/api/contours")
+    def contours():
+        """Depth or elevation contours as GeoJSON LineStrings"""
+        try:
+            from contour_service import get_contours
+
+            layer = request.args.get("layer", "depth")
+            interval = request.args.get("interval", 5.0, type=float)
+            tolerance = request.args.get("tolerance", 0.5, type=float)
+            reference_elevation = request.args.get("reference_elevation", type=float)
+
+            geojson_text, cache_key = get_contours("cropped.tif", layer, interval,
+                                                   tolerance, reference_elevation)
+
+            if request.if_none_match.contains(cache_key):
+                return Response(status=304, headers={"ETag": f'"{cache_key}"'})
+
+            response = Response(geojson_text, mimetype="application/geo+json")
+            response.set_etag(cache_key)
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)})
+
+    @advanced_bp.route("/api/get_3d_terrain.bin")
+    def get_3d_terrain_binary():
+        """Compressed binary heightmap of the analysed DEM for the 3D viewer"""
+        try:
+            import hashlib
+
+            from three_visualization import compress_payload, generate_3d_terrain_binary
+
+            if not os.path.exists("cropped.tif"):
+                return jsonify({"status": "error", "message": "No analysed DEM available"}), 404
+
+            dtype = request.args.get("dtype", "uint16")
+            payload = generate_3d_terrain_binary("cropped.tif", dtype)
+            etag = hashlib.sha1(payload).hexdigest()
+
+            if request.if_none_match.contains(etag):
+                return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+            body, encoding = compress_payload(payload, request.headers.get("Accept-Encoding", ""))
+            response = Response(body, mimetype="application/octet-stream")
+            if encoding:
+                response.headers["Content-Encoding"] = encoding
+            response.headers["Vary"] = "Accept-Encoding"
+            response.headers["Cache-Control"] = "no-cache"
+            response.set_etag(etag)
+            return response
+
+        except Exception as e:
+            return jsonify({"status": "error", "message": f"3D data error: {str(e)}"}), 500
+
+    @advanced_bp.route("/api/get_3d_mesh.bin")
+    def get_3d_mesh_binary():
+        """Adaptive LOD terrain mesh (vertex + index buffers) of the analysed DEM"""
+        try:
+            import hashlib
+
+            from three_visualization import compress_payload, generate_3d_terrain_mesh
+
+            if not os.path.exists("cropped.tif"):
+                return jsonify({"status": "error", "message": "No analysed DEM available"}), 404
+
+            level = request.args.get("lod", 0, type=int)
+            payload = generate_3d_terrain_mesh("cropped.tif", level)
+            etag = hashlib.sha1(payload).hexdigest()
+
+            if request.if_none_match.contains(etag):
+                return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+            body, encoding = compress_payload(payload, request.headers.get("Accept-Encoding", ""))
+            response = Response(body, mimetype="application/octet-stream")
+            if encoding:
+                response.headers["Content-Encoding"] = encoding
+            response.headers["Vary"] = "Accept-Encoding"
+            response.headers["Cache-Control"] = "no-cache"
+            response.set_etag(etag)
+            return response
+
+        except Exception as e:
+            return jsonify({"status": "error", "message": f"3D mesh error: {str(e)}"}), 500
+
+    @advanced_bp.route("/api/terrain/manifest")
+    def terrain_manifest():
+        """Chunk pyramid description of the analysed DEM, tiles are built on first request"""
+        try:
+            from terrain_chunks import build_terrain_chunks
+
+            if not os.path.exists("cropped.tif"):
+                return jsonify({"status": "error", "message": "No analysed DEM available"}), 404
+
+            manifest = build_terrain_chunks("cropped.tif")
+            if request.if_none_match.contains(manifest["version"]):
+                return Response(status=304, headers={"ETag": f'"{manifest["version"]}"'})
+
+            response = jsonify(manifest)
+            response.set_etag(manifest["version"])
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+
+        except Exception as e:
+            return jsonify({"status": "error", "message": f"Terrain manifest error: {str(e)}"}), 500
+
+    @advanced_bp.route("/api/terrain/<version>/<int:level>/<int:cx>/<int:cy>.bin")
+    def terrain_chunk(version, level, cx, cy):
+        """One precomputed heightmap chunk; URLs are versioned so they never change"""
+        import re
+
+        from terrain_chunks import chunk_path
+
+        if not re.fullmatch(r"[0-9a-f]{16}", version):
+            return jsonify({"status": "error", "message": "Invalid terrain version"}), 404
+
+        path = chunk_path(version, level, cx, cy)
+        if not os.path.exists(path):
+            return jsonify({"status": "error", "message": "Chunk not found"}), 404
+
+        response = send_file(path, mimetype="application/octet-stream", etag=True,
+                             conditional=True, max_age=31536000)
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
     @advanced_bp.route("/api/get_3d_data")
     def get_3d_data():
         """Provide latest 3D terrain data for visualization"""
@@ -180,6 +434,9 @@ def create_advanced_routes(app, mongo):
                 "maxElevation": 100
             })
 
+    from profiling import enable_profiling
+    enable_profiling(advanced_bp)
+
     return advanced_bp
     @advanced_bp.route("/3d_viewer")
     def three_d_viewer():
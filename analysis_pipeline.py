@@ -0,0 +1,198 @@
+import time
+
+import numpy as np
+import rasterio
+
+from geodesy import pixel_area_m2
+from metrics import RASTER_PIXELS, stage
+from precision import read_elevation
+
+# Products in the order they are computed; later products reuse the
+# intermediate arrays of earlier ones
+PRODUCTS = ("depth", "volume", "slope", "stability_zones", "hydrology", "3d", "visualization")
+DEFAULT_PRODUCTS = ("depth", "volume", "slope")
+
+
+class AnalysisContext:
+    """
+    One DEM loaded and preprocessed once, plus the intermediate arrays
+    (depth map, slope) shared by every requested product
+    """
+
+    def __init__(self, dem_file, reference_point=None, reference_elevation=None,
+                 fill_voids=False, boundary=None):
+        from depth_analysis import estimate_original_surface, reference_point_elevation
+
+        with rasterio.open(dem_file) as src:
+            dem_data = read_elevation(src)
+            self.transform = src.transform
+            self.crs = src.crs
+            self.bounds = src.bounds
+        RASTER_PIXELS.observe(dem_data.size, stage="analysis_load")
+
+        self.filled_void_pixels = 0
+        if fill_voids:
+            from nodata_fill import fill_nodata
+            void_mask = np.isnan(dem_data)
+            self.filled_void_pixels = int(void_mask.sum())
+            fill_nodata(dem_data, void_mask)
+
+        self.dem_file = dem_file
+        self.fill_voids = fill_voids
+        self.boundary = boundary
+        self.dem_data = dem_data
+        self.pixel_area = pixel_area_m2(self.transform, self.crs, dem_data.shape[0])
+        # Fractional pixel weights of the site polygon, for depth and volume
+        self.coverage = None
+        if boundary:
+            from pixel_coverage import pixel_coverage
+            self.coverage = pixel_coverage(boundary, self.transform, self.crs, dem_data.shape)
+
+        # One reference surface for depth and volume, so their figures agree
+        self.estimated_surface = estimate_original_surface(dem_data)
+        self.reference_method = "estimated"
+        if reference_elevation is not None:
+            self.reference_elevation = float(reference_elevation)
+            self.reference_method = "elevation"
+        else:
+            self.reference_elevation = None
+            if reference_point:
+                self.reference_elevation = reference_point_elevation(
+                    dem_data, self.transform, self.crs, reference_point)
+            if self.reference_elevation is None:
+                self.reference_elevation = self.estimated_surface
+            else:
+                self.reference_method = "point"
+
+        self._depth = None
+        self._slope = None
+
+    def depth(self):
+        """(depth_map, stats) below the shared reference elevation"""
+        if self._depth is None:
+            from depth_analysis import depth_statistics
+            depth_map, stats = depth_statistics(self.dem_data, self.reference_elevation,
+                                                self.pixel_area, self.estimated_surface,
+                                                self.coverage)
+            stats['filled_void_pixels'] = self.filled_void_pixels
+            self._depth = depth_map, stats
+        return self._depth
+
+    def slope(self):
+        """(slope_degrees, stats) of the DEM"""
+        if self._slope is None:
+            from slope_analysis import slope_from_dem
+            # Same working dtype as calculate_slope_simple, so zones match
+            # /api/stability_zones; np.gradient leaves dem_data untouched
+            self._slope = slope_from_dem(self.dem_data, self.transform, self.crs)
+        return self._slope
+
+
+def _product_depth(context, options):
+    return context.depth()[1]
+
+
+def _product_volume(context, options):
+    from volume_calculator import volume_from_depth
+    return volume_from_depth(context.depth()[0], context.transform, context.reference_elevation,
+                             context.crs, context.coverage)
+
+
+def _product_slope(context, options):
+    return context.slope()[1]
+
+
+def _product_stability_zones(context, options):
+    from slope_analysis import classify_stability_zones
+
+    slope_degrees, slope_stats = context.slope()
+    zones = classify_stability_zones(slope_degrees, context.dem_data, context.transform,
+                                     context.crs, min_pixels=options.get("min_pixels", 4))
+    zones['slope_stats'] = slope_stats
+    return zones
+
+
+def _product_hydrology(context, options):
+    from hydrology import MIN_FILL_DEPTH, depressions_from_array
+    return depressions_from_array(context.dem_data, context.transform, context.crs,
+                                  min_depth=options.get("min_depth", MIN_FILL_DEPTH))
+
+
+def _product_3d(context, options):
+    """Viewer terrain JSON, stored under the same artifact key as /api/get_3d_data"""
+    from artifact_store import artifact_key, terrain_store
+    from raster_store import raster_hash
+    from three_visualization import (TERRAIN_JSON_PARAMS, prepare_3d_elevation,
+                                     store_3d_terrain_data)
+
+    source_hash = raster_hash(context.dem_file)
+    key = artifact_key(source_hash, TERRAIN_JSON_PARAMS)
+    terrain_file = terrain_store.get(key)
+    if not terrain_file:
+        elevation = prepare_3d_elevation(context.dem_data.copy())
+        terrain_file = store_3d_terrain_data(elevation, context.bounds, context.dem_file,
+                                             key, source_hash)
+    return {"terrain_file": terrain_file, "url": "/api/get_3d_data"}
+
+
+def _product_visualization(context, options):
+    from depth_analysis import depth_visualization_path, generate_depth_visualization
+
+    output_path = options.get("visualization_path") or depth_visualization_path(
+        context.dem_file, reference_elevation=float(context.reference_elevation),
+        fill_voids=context.fill_voids, boundary=context.boundary)
+    generate_depth_visualization(context.depth()[0], output_path)
+    return {"path": output_path}
+
+
+PRODUCT_BUILDERS = {
+    "depth": _product_depth,
+    "volume": _product_volume,
+    "slope": _product_slope,
+    "stability_zones": _product_stability_zones,
+    "hydrology": _product_hydrology,
+    "3d": _product_3d,
+    "visualization": _product_visualization,
+}
+
+
+def run_analysis(dem_file="cropped.tif", products=DEFAULT_PRODUCTS, reference_point=None,
+                 reference_elevation=None, fill_voids=False, boundary=None, **options):
+    """
+    Compute several analysis products from one read of the DEM.
+
+    Depth, volume and the depth visualization share one depth map below
+    one reference elevation; slope and stability zones share one slope
+    raster. With a boundary, depth and volume measure only the polygon,
+    boundary pixels by their covered fraction. Returns the products plus
+    per-stage timings in milliseconds.
+    """
+    unknown = [product for product in products if product not in PRODUCT_BUILDERS]
+    if unknown:
+        raise ValueError(f"Unknown products {unknown}, choose from {list(PRODUCTS)}")
+    requested = [product for product in PRODUCTS if product in products]
+
+    timings = {}
+    start = time.perf_counter()
+    with stage("analysis_load"):
+        context = AnalysisContext(dem_file, reference_point, reference_elevation, fill_voids,
+                                  boundary)
+    timings["load"] = round((time.perf_counter() - start) * 1000, 2)
+
+    results = {}
+    for product in requested:
+        product_start = time.perf_counter()
+        with stage(f"analysis_{product}"):
+            results[product] = PRODUCT_BUILDERS[product](context, options)
+        timings[product] = round((time.perf_counter() - product_start) * 1000, 2)
+    timings["total"] = round((time.perf_counter() - start) * 1000, 2)
+
+    print(f"🧮 Analysis pipeline {requested} on {dem_file}: {timings['total']:.0f} ms")
+    return {
+        "products": results,
+        "reference_elevation": float(context.reference_elevation),
+        "reference_method": context.reference_method,
+        "shape": list(context.dem_data.shape),
+        "filled_void_pixels": context.filled_void_pixels,
+        "timings_ms": timings,
+    }
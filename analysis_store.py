@@ -0,0 +1,267 @@
+import atexit
+import threading
+import time
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, InsertOne
+from pymongo.errors import BulkWriteError
+
+# Analysis documents (with the raster hashes they point at) expire this
+# long after they were computed; MongoDB's TTL monitor deletes them
+ANALYSIS_RETENTION_DAYS = 180
+# Writes are buffered and sent as one bulk_write per batch or interval
+WRITE_BATCH_SIZE = 100
+WRITE_FLUSH_SECONDS = 2.0
+# While MongoDB is unreachable at most this many documents wait for a retry
+MAX_PENDING_WRITES = 10000
+DUPLICATE_KEY_ERROR = 11000
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 500
+
+# Headline figures copied out of the depth statistics for trend queries
+SUMMARY_FIELDS = ("max_depth", "mean_depth", "median_depth", "volume_m3", "total_area_m2",
+                  "quarry_bottom_elevation", "original_surface_elevation")
+HISTORY_PROJECTION = {"siteId": 1, "sitename": 1, "timestamp": 1, "source": 1,
+                      "summary": 1, "rasterHash": 1, "visualization": 1}
+
+
+def ensure_analysis_indexes(collection):
+    """Indexes for per-site history, global recency and TTL pruning (idempotent)"""
+    # _id breaks timestamp ties, so cursor pages sort entirely in the index
+    collection.create_index([("siteId", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)],
+                            name="site_timestamp")
+    collection.create_index([("timestamp", DESCENDING), ("_id", DESCENDING)], name="timestamp")
+    collection.create_index([("rasterHash", ASCENDING)], name="raster_hash")
+    collection.create_index("expireAt", name="expire_at", expireAfterSeconds=0)
+
+
+def to_object_id(value):
+    """ObjectId from a string id, None for missing or malformed ids"""
+    if isinstance(value, ObjectId):
+        return value
+    if value and ObjectId.is_valid(str(value)):
+        return ObjectId(str(value))
+    return None
+
+
+def analysis_document(stats, site_id=None, sitename=None, raster_hash=None, source=None,
+                      reference_point=None, visualization=None, timestamp=None,
+                      retention_days=ANALYSIS_RETENTION_DAYS):
+    """One Analyses document: full statistics plus a flat summary for dashboards"""
+    # MongoDB keeps milliseconds, so history cursors round-trip exactly
+    timestamp = timestamp or datetime.utcnow()
+    timestamp = timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+    return {
+        "_id": ObjectId(),
+        "siteId": to_object_id(site_id),
+        "sitename": sitename,
+        "timestamp": timestamp,
+        "expireAt": timestamp + timedelta(days=retention_days),
+        "rasterHash": raster_hash,
+        "source": source or {},
+        "referencePoint": reference_point,
+        "stats": stats,
+        "summary": {field: stats.get(field) for field in SUMMARY_FIELDS if field in stats},
+        "visualization": visualization,
+    }
+
+
+class AnalysisRecorder:
+    """
+    Buffers analysis documents and writes them with one unordered
+    bulk_write per batch (or every few seconds), off the request thread.
+    Indexes are created on the first flush, so startup never waits on
+    MongoDB.
+    """
+
+    def __init__(self, collection, batch_size=WRITE_BATCH_SIZE, flush_seconds=WRITE_FLUSH_SECONDS):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.pending = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.indexes_ready = False
+        self.written = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def record(self, document):
+        """Queue one document; returns its id so responses can refer to it"""
+        with self.lock:
+            self.pending.append(document)
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.wake.set()
+        return document["_id"]
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.flush_seconds)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write everything queued so far; failed batches are kept for the next try"""
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+            if not batch:
+                return 0
+            retry = batch
+            try:
+                if not self.indexes_ready:
+                    ensure_analysis_indexes(self.collection)
+                    self.indexes_ready = True
+                start = time.perf_counter()
+                result = self.collection.bulk_write([InsertOne(doc) for doc in batch], ordered=False)
+                self.written += result.inserted_count
+                print(f"💾 Stored {result.inserted_count} analyses "
+                      f"({(time.perf_counter() - start) * 1000:.0f} ms)")
+                return result.inserted_count
+            except BulkWriteError as e:
+                # Duplicate ids were stored by an earlier, partly applied
+                # batch; only the other failures are retried
+                failed = {error["index"] for error in e.details.get("writeErrors", [])
+                          if error.get("code") != DUPLICATE_KEY_ERROR}
+                retry = [doc for index, doc in enumerate(batch) if index in failed]
+                self.written += e.details.get("nInserted", 0)
+                print(f"⚠️ Analysis bulk write: {len(retry)} of {len(batch)} documents failed")
+            except Exception as e:
+                print(f"❌ Analysis write failed, will retry: {e}")
+
+            self.failed += len(retry)
+            with self.lock:
+                self.pending = (retry + self.pending)[-MAX_PENDING_WRITES:]
+            return 0
+
+    def discard_site(self, site_id):
+        """
+        Drop queued documents of one site, waiting for a write in progress
+        so none of them lands after the caller deletes the site's history
+        """
+        with self.flush_lock, self.lock:
+            kept = [doc for doc in self.pending if doc.get("siteId") != site_id]
+            dropped = len(self.pending) - len(kept)
+            self.pending = kept
+        return dropped
+
+    def get(self, analysis_id):
+        """One analysis, also if it is still waiting in the write buffer"""
+        analysis_id = to_object_id(analysis_id)
+        if analysis_id is None:
+            return None
+        with self.lock:
+            for document in self.pending:
+                if document["_id"] == analysis_id:
+                    return document
+        return self.collection.find_one({"_id": analysis_id})
+
+
+def history_page(collection, site_id=None, limit=HISTORY_PAGE_SIZE, before=None, fields=None):
+    """
+    Newest-first page of analyses for one site (or all sites) served from
+    the (siteId, timestamp) index. Pagination is by cursor: pass the
+    `next` value of one page as `before` to get the following page, which
+    stays fast however deep the history goes (no skip()).
+    """
+    limit = max(1, min(int(limit), MAX_HISTORY_PAGE_SIZE))
+    query = {}
+    if site_id is not None:
+        query["siteId"] = to_object_id(site_id)
+    if before:
+        timestamp, _, last_id = str(before).partition("_")
+        cursor_time = datetime.fromisoformat(timestamp)
+        query["$or"] = [
+            {"timestamp": {"$lt": cursor_time}},
+            {"timestamp": cursor_time, "_id": {"$lt": to_object_id(last_id)}},
+        ]
+
+    projection = dict(HISTORY_PROJECTION)
+    if fields:
+        projection.pop("summary")
+        projection.update({f"summary.{field}": 1 for field in fields if field in SUMMARY_FIELDS})
+
+    documents = list(collection.find(query, projection)
+                     .sort([("timestamp", DESCENDING), ("_id", DESCENDING)])
+                     .limit(limit + 1))
+    has_more = len(documents) > limit
+    documents = documents[:limit]
+
+    items = [serialize_analysis(document) for document in documents]
+    next_cursor = None
+    if has_more:
+        last = documents[-1]
+        next_cursor = f"{last['timestamp'].isoformat()}_{last['_id']}"
+    return {"analyses": items, "next": next_cursor}
+
+
+def latest_per_site(collection, site_ids, fields=None):
+    """
+    Most recent analysis summary of each site in one aggregation that
+    walks the (siteId, timestamp) index, for dashboards over many sites
+    """
+    site_ids = [oid for oid in (to_object_id(site_id) for site_id in site_ids) if oid is not None]
+    summary = ({f"summary.{field}": 1 for field in fields if field in SUMMARY_FIELDS}
+               if fields else {"summary": 1})
+    pipeline = [
+        {"$match": {"siteId": {"$in": site_ids}}},
+        {"$sort": {"siteId": 1, "timestamp": -1, "_id": -1}},
+        {"$group": {"_id": "$siteId", "doc": {"$first": "$$ROOT"}}},
+        {"$replaceRoot": {"newRoot": "$doc"}},
+        {"$project": {"siteId": 1, "sitename": 1, "timestamp": 1, **summary}},
+    ]
+    return [serialize_analysis(document) for document in collection.aggregate(pipeline)]
+
+
+def serialize_analysis(document):
+    """JSON-safe copy of an Analyses document"""
+    item = dict(document)
+    item["id"] = str(item.pop("_id"))
+    if item.get("siteId") is not None:
+        item["siteId"] = str(item["siteId"])
+    for field in ("timestamp", "expireAt"):
+        if isinstance(item.get(field), datetime):
+            item[field] = item[field].isoformat()
+    return item
+
+
+def record_analysis(mongo, dem_file, stats, data, visualization=None):
+    """
+    Queue an analysis of dem_file for the Analyses history. `data` is the
+    request body (site_id, sitename, dem, bbox, reference_point, source).
+    Returns the analysis id, or None if it could not be queued.
+    """
+    try:
+        from raster_store import raster_hash
+
+        source = data.get("source") or {"type": "dem", "dem": data.get("dem"), "bbox": data.get("bbox")}
+        document = analysis_document(
+            stats,
+            site_id=data.get("site_id"),
+            sitename=data.get("sitename"),
+            raster_hash=raster_hash(dem_file),
+            source=source,
+            reference_point=data.get("reference_point"),
+            visualization=visualization,
+        )
+        return str(get_recorder(mongo).record(document))
+    except Exception as e:
+        print(f"❌ Could not record analysis: {e}")
+        return None
+
+
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+
+def get_recorder(mongo):
+    """The process-wide recorder for a PyMongo instance's Analyses collection"""
+    with _recorders_lock:
+        if id(mongo) not in _recorders:
+            _recorders[id(mongo)] = AnalysisRecorder(mongo.db.Analyses)
+        return _recorders[id(mongo)]
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from metrics import record_cache
+
+ARTIFACT_ROOT = os.path.join("static", "3d")
+# Retention: artifacts unused for longer than this, or beyond the byte
+# budget (least recently used first), are removed. The latest artifact
+# is always kept.
+MAX_ARTIFACT_BYTES = 100 * 1024 * 1024
+MAX_ARTIFACT_AGE = 7 * 24 * 3600
+# Expired entries and orphaned files are swept at most this often, or
+# whenever the byte budget is exceeded
+SWEEP_INTERVAL = 3600
+# A sweep over budget frees space down to this fraction of it
+EVICT_TARGET = 0.9
+
+
+def artifact_key(source_hash, params=None):
+    """Registry key for an output of one source raster with given parameters"""
+    canonical = json.dumps(params or {}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(f"{source_hash}:{canonical}".encode()).hexdigest()
+
+
+class ArtifactStore:
+    """
+    On-disk registry of generated artifacts. A small JSON index maps
+    (source raster hash, params) keys to content-addressed files, so the
+    latest artifact is found without scanning the directory and identical
+    outputs are stored once. The index also counts references and bytes per
+    file, so storing an artifact does not touch the rest of the store.
+    """
+
+    def __init__(self, root=ARTIFACT_ROOT, max_bytes=MAX_ARTIFACT_BYTES,
+                 max_age=MAX_ARTIFACT_AGE, suffix=".json"):
+        self.root = root
+        self.files_dir = os.path.join(root, "artifacts")
+        self.index_path = os.path.join(root, "index.json")
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.suffix = suffix
+        self.lock = threading.Lock()
+        self.index = None
+
+    def _load_index(self):
+        if self.index is not None:
+            return self.index
+        try:
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {"entries": {}, "latest": None}
+        if "files" not in self.index:
+            # Index written before reference counting: rebuild the totals
+            self.index["files"] = {}
+            self.index["bytes"] = 0
+            for entry in self.index["entries"].values():
+                self._ref(entry["digest"], entry["size"])
+        self.index.setdefault("swept", 0)
+        return self.index
+
+    def _save_index(self):
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f"{self.index_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f, separators=(",", ":"))
+        os.replace(tmp_path, self.index_path)
+
+    def _path(self, digest):
+        return os.path.join(self.files_dir, f"{digest}{self.suffix}")
+
+    def _ref(self, digest, size):
+        files = self.index["files"]
+        if digest in files:
+            files[digest]["refs"] += 1
+        else:
+            files[digest] = {"size": size, "refs": 1}
+            self.index["bytes"] += size
+
+    def _unref(self, digest):
+        """Drop one reference to a file, removing it once nothing uses it"""
+        info = self.index["files"].get(digest)
+        if info is None:
+            return
+        info["refs"] -= 1
+        if info["refs"] > 0:
+            return
+        del self.index["files"][digest]
+        self.index["bytes"] -= info["size"]
+        try:
+            os.remove(self._path(digest))
+        except OSError:
+            pass
+
+    def get(self, key):
+        """Path of the artifact stored under key, or None"""
+        with self.lock:
+            entry = self._load_index()["entries"].get(key)
+            if entry is None:
+                record_cache("terrain_artifacts", False)
+                return None
+            path = self._path(entry["digest"])
+            if not os.path.exists(path):
+                del self.index["entries"][key]
+                self._unref(entry["digest"])
+                if self.index["latest"] == key:
+                    self.index["latest"] = None
+                self._save_index()
+                record_cache("terrain_artifacts", False)
+                return None
+            record_cache("terrain_artifacts", True)
+            # Only rewrite the index when something visible to eviction changed
+            now = time.time()
+            if self.index["latest"] != key or now - entry["last_used"] > 60:
+                entry["last_used"] = now
+                self.index["latest"] = key
+                self._save_index()
+            return path
+
+    def latest(self):
+        """Path of the most recently stored or used artifact, or None"""
+        with self.lock:
+            index = self._load_index()
+            key = index["latest"]
+            if key is None or key not in index["entries"]:
+                return None
+            path = self._path(index["entries"][key]["digest"])
+        return path if os.path.exists(path) else None
+
+    def put(self, key, payload, source=None, params=None):
+        """
+        Store payload bytes under key and return the artifact path. Content
+        already in the store (from any key) is reused instead of rewritten.
+        """
+        digest = hashlib.sha1(payload).hexdigest()
+        path = self._path(digest)
+
+        with self.lock:
+            index = self._load_index()
+            if not os.path.exists(path):
+                os.makedirs(self.files_dir, exist_ok=True)
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(payload)
+                os.replace(tmp_path, path)
+
+            previous = index["entries"].get(key)
+            if previous is None or previous["digest"] != digest:
+                self._ref(digest, len(payload))
+                if previous is not None:
+                    self._unref(previous["digest"])
+
+            now = time.time()
+            index["entries"][key] = {
+                "digest": digest,
+                "size": len(payload),
+                "source": source,
+                "params": params or {},
+                "created": now,
+                "last_used": now,
+            }
+            index["latest"] = key
+            if index["bytes"] > self.max_bytes or now - index["swept"] > SWEEP_INTERVAL:
+                self._evict()
+            self._save_index()
+        return path
+
+    def _evict(self):
+        """
+        Drop expired entries, then least recently used ones over the byte
+        budget, then files left behind by a crash or an older index
+        """
+        entries = self.index["entries"]
+        latest = self.index["latest"]
+        now = time.time()
+        self.index["swept"] = now
+
+        for key in [k for k, e in entries.items() if now - e["last_used"] > self.max_age]:
+            if key != latest:
+                self._unref(entries.pop(key)["digest"])
+
+        for key in sorted(entries, key=lambda k: entries[k]["last_used"]):
+            if self.index["bytes"] <= self.max_bytes * EVICT_TARGET:
+                break
+            if key != latest:
+                self._unref(entries.pop(key)["digest"])
+
+        if os.path.isdir(self.files_dir):
+            for entry in os.scandir(self.files_dir):
+                digest = entry.name[:-len(self.suffix)]
+                if entry.name.endswith(self.suffix) and digest not in self.index["files"]:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+
+    def stats(self):
+        with self.lock:
+            index = self._load_index()
+            return {
+                "entries": len(index["entries"]),
+                "files": len(index["files"]),
+                "bytes": index["bytes"],
+                "latest": self.index["latest"],
+            }
+
+
+terrain_store = ArtifactStore()
@@ -0,0 +1,324 @@
+"""
+Headless batch analysis of a directory of GeoTIFFs.
+
+Runs calculate_quarry_depth and calculate_excavation_volume on every
+raster across a process pool, streams one row per file to CSV, JSONL or
+Parquet as results arrive, and records finished files in a manifest so
+an interrupted run picks up where it stopped:
+
+    python batch_analysis.py drone_dems/ --output results.csv
+    python batch_analysis.py drone_dems/ --output results.jsonl --workers 8 --recursive
+    python batch_analysis.py drone_dems/ --output results.parquet   # directory of part files
+    python batch_analysis.py drone_dems/ --output results.csv --retry-failed
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+
+OUTPUT_FORMATS = ("csv", "jsonl", "parquet")
+RASTER_EXTENSIONS = (".tif", ".tiff")
+# Files queued per worker; bounds memory on directories of any size
+QUEUE_PER_WORKER = 4
+# Rows per Parquet part file; each part is complete on disk before the
+# manifest records its rows
+PARQUET_PART_ROWS = 256
+PROGRESS_EVERY = 10
+
+DEPTH_FIELDS = ("max_depth", "mean_depth", "median_depth", "quarry_bottom_elevation",
+                "original_surface_elevation", "volume_m3", "total_area_m2", "excavated_pixels",
+                "pixel_area_m2")
+VOLUME_FIELDS = ("volume_pixel_method_m3", "volume_integral_method_m3", "average_depth_m",
+                 "max_excavation_depth_m", "excavation_area_m2")
+COLUMNS = (("file", "path", "status", "error", "width", "height", "pixels")
+           + DEPTH_FIELDS + VOLUME_FIELDS + ("seconds",))
+
+
+def find_rasters(directory, recursive=False):
+    """GeoTIFFs under directory, sorted so runs process files in a stable order"""
+    pattern = os.path.join(directory, "**", "*") if recursive else os.path.join(directory, "*")
+    return sorted(path for path in glob.glob(pattern, recursive=recursive)
+                  if path.lower().endswith(RASTER_EXTENSIONS) and os.path.isfile(path))
+
+
+def file_key(path):
+    """Manifest identity of a file: a raster replaced in place is analysed again"""
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+def analyze_file(path, fill_voids=False, use_cache=True):
+    """
+    Depth and volume figures for one raster, as one output row. Runs in a
+    worker process; failures become rows with status "failed".
+    """
+    import rasterio
+
+    from depth_analysis import calculate_quarry_depth
+    from volume_calculator import calculate_excavation_volume
+
+    start = time.perf_counter()
+    row = {"file": os.path.basename(path), "path": os.path.abspath(path), "status": "done", "error": None}
+    try:
+        with rasterio.open(path) as src:
+            row.update(width=src.width, height=src.height, pixels=src.width * src.height)
+
+        depth = calculate_quarry_depth if use_cache else calculate_quarry_depth.uncached
+        volume = calculate_excavation_volume if use_cache else calculate_excavation_volume.uncached
+        _, stats, _, _ = depth(path, fill_voids=fill_voids)
+        # Same reference surface as the depth figures, so the two agree
+        volumes = volume(path, reference_elevation=stats["original_surface_elevation"],
+                         fill_voids=fill_voids)
+        row.update({field: stats.get(field) for field in DEPTH_FIELDS})
+        row.update({field: volumes.get(field) for field in VOLUME_FIELDS})
+    except Exception as e:
+        row.update(status="failed", error=f"{type(e).__name__}: {e}")
+    row["seconds"] = round(time.perf_counter() - start, 3)
+    return row
+
+
+def _quiet_worker():
+    # The analysis functions narrate every step; keep the batch log readable
+    sys.stdout = open(os.devnull, "w")
+
+
+class Manifest:
+    """Append-only JSONL record of processed files, replayed on resume"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        partial = False
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    partial = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # a line cut short by the interruption
+                    self.entries[entry["key"]] = entry
+        self.file = open(path, "a")
+        if partial:
+            self.file.write("\n")
+
+    def status(self, key):
+        entry = self.entries.get(key)
+        return entry["status"] if entry else None
+
+    def add(self, key, row):
+        entry = {"key": key, "status": row["status"], "error": row["error"],
+                 "at": datetime.now().isoformat(timespec="seconds")}
+        self.entries[key] = entry
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CSVResults:
+    """Writers return the rows that are safely on disk, for the manifest"""
+
+    def __init__(self, path):
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "a", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=COLUMNS)
+        if new:
+            self.writer.writeheader()
+
+    def write(self, row):
+        self.writer.writerow(row)
+        self.file.flush()
+        return [row]
+
+    def close(self):
+        self.file.close()
+        return []
+
+
+class JSONLResults:
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def write(self, row):
+        self.file.write(json.dumps(row) + "\n")
+        self.file.flush()
+        return [row]
+
+    def close(self):
+        self.file.close()
+        return []
+
+
+class ParquetResults:
+    """
+    A directory of Parquet part files, read back as one table by
+    pyarrow/pandas. Parquet files cannot be appended to, and one left
+    open by an interruption is unreadable, so rows are written as small
+    complete parts.
+    """
+
+    def __init__(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet output needs pyarrow (pip install pyarrow); use .csv or .jsonl")
+        self.pa, self.pq = pa, pq
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.run = f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}"
+        self.parts = 0
+        numeric = pa.float64()
+        self.schema = pa.schema(
+            [(name, pa.string()) for name in ("file", "path", "status", "error")]
+            + [(name, pa.int64()) for name in ("width", "height", "pixels", "excavated_pixels")]
+            + [(name, numeric) for name in COLUMNS
+               if name not in ("file", "path", "status", "error", "width", "height", "pixels",
+                               "excavated_pixels")])
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+        return self.flush() if len(self.rows) >= PARQUET_PART_ROWS else []
+
+    def flush(self):
+        rows, self.rows = self.rows, []
+        if rows:
+            part = os.path.join(self.path, f"part-{self.run}-{self.parts:05d}.parquet")
+            self.pq.write_table(self.pa.Table.from_pylist(rows, schema=self.schema), part)
+            self.parts += 1
+        return rows
+
+    def close(self):
+        return self.flush()
+
+
+RESULT_WRITERS = {"csv": CSVResults, "jsonl": JSONLResults, "parquet": ParquetResults}
+
+
+def output_format(path, fmt=None):
+    if fmt:
+        return fmt
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    if extension == "json":
+        return "jsonl"
+    if extension in OUTPUT_FORMATS:
+        return extension
+    raise ValueError(f"Cannot tell the output format of {path}; pass --format")
+
+
+def run_batch(paths, output, fmt=None, workers=None, manifest_path=None, retry_failed=False,
+              fill_voids=False, use_cache=True, verbose=False):
+    """
+    Analyse paths on a process pool and stream rows to output. Files the
+    manifest already records as done (or failed, unless retry_failed) are
+    skipped. Returns the run summary with throughput figures.
+    """
+    fmt = output_format(output, fmt)
+    workers = workers or os.cpu_count() or 1
+    writer = RESULT_WRITERS[fmt](output)
+    manifest = Manifest(manifest_path or f"{output.rstrip(os.sep)}.manifest.jsonl")
+
+    keys = {os.path.abspath(path): file_key(path) for path in paths}
+    skip = {"done"} | (set() if retry_failed else {"failed"})
+    pending = [path for path in paths if manifest.status(keys[os.path.abspath(path)]) not in skip]
+    print(f"📂 {len(paths)} rasters, {len(paths) - len(pending)} already in the manifest, "
+          f"{len(pending)} to analyse on {workers} workers")
+
+    done = failed = pixels = 0
+    durations = []
+    start = time.perf_counter()
+    queue = iter(pending)
+    try:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=None if verbose else _quiet_worker) as pool:
+            running = {}
+
+            def submit():
+                for path in queue:
+                    running[pool.submit(analyze_file, path, fill_voids, use_cache)] = path
+                    if len(running) >= workers * QUEUE_PER_WORKER:
+                        break
+
+            submit()
+            while running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    running.pop(future)
+                    row = future.result()
+                    for stored in writer.write(row):
+                        manifest.add(keys[stored["path"]], stored)
+                    if row["status"] == "done":
+                        done += 1
+                        pixels += row.get("pixels") or 0
+                        durations.append(row["seconds"])
+                    else:
+                        failed += 1
+                        print(f"❌ {row['file']}: {row['error']}")
+                    if (done + failed) % PROGRESS_EVERY == 0:
+                        elapsed = time.perf_counter() - start
+                        print(f"⏱️ {done + failed}/{len(pending)} files, "
+                              f"{(done + failed) / elapsed:.2f} files/s, {pixels / elapsed / 1e6:.1f} Mpx/s")
+                submit()
+    finally:
+        for stored in writer.close():
+            manifest.add(keys[stored["path"]], stored)
+        manifest.close()
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "files": len(paths),
+        "skipped": len(paths) - len(pending),
+        "done": done,
+        "failed": failed,
+        "workers": workers,
+        "seconds": round(elapsed, 2),
+        "files_per_second": round((done + failed) / elapsed, 3) if elapsed else None,
+        "megapixels_per_second": round(pixels / elapsed / 1e6, 3) if elapsed else None,
+        "median_file_seconds": round(statistics.median(durations), 3) if durations else None,
+        "output": output,
+        "format": fmt,
+    }
+    print(f"✅ Batch done: {done} analysed, {failed} failed in {elapsed:.1f} s "
+          f"({summary['files_per_second']} files/s, {summary['megapixels_per_second']} Mpx/s)")
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyse a directory of GeoTIFF DEMs")
+    parser.add_argument("directory")
+    parser.add_argument("--output", required=True, help="results file (.csv, .jsonl) or .parquet directory")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, help="default: from the output extension")
+    parser.add_argument("--workers", type=int, help="default: one per core")
+    parser.add_argument("--recursive", action="store_true")
+    parser.add_argument("--manifest", help="default: <output>.manifest.jsonl")
+    parser.add_argument("--retry-failed", action="store_true", help="analyse files that failed last time again")
+    parser.add_argument("--fill-voids", action="store_true")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the analysis result cache")
+    parser.add_argument("--verbose", action="store_true", help="keep the workers' analysis log")
+    args = parser.parse_args(argv)
+
+    paths = find_rasters(args.directory, args.recursive)
+    if not paths:
+        print(f"❌ No GeoTIFFs found in {args.directory}")
+        return 1
+    try:
+        summary = run_batch(paths, args.output, args.format, args.workers, args.manifest,
+                            args.retry_failed, args.fill_voids, not args.no_cache, args.verbose)
+    except (ValueError, RuntimeError) as e:
+        print(f"❌ {e}")
+        return 2
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
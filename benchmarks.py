@@ -0,0 +1,455 @@
+"""
+Benchmark suite for the analysis stages.
+
+Times and memory-profiles each stage on synthetic quarries (256² up to
+8192², float32 and int16) and on the bundled rasters, and stores the
+results per commit so runs can be compared:
+
+    python benchmarks.py                          # default sizes, save results
+    python benchmarks.py --sizes 256 1024 8192 --dtypes float32 int16
+    python benchmarks.py --stages calculate_quarry_depth calculate_slope_simple
+    python benchmarks.py --compare                # latest two saved runs
+    python benchmarks.py --compare old.json new.json
+    python benchmarks.py --precision --sizes 1024 4096   # float32 vs float64 volumes and peak RSS
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".benchmarks")
+BUNDLED_RASTERS = ("cropped.tif", "dem_tile.tif")
+DEFAULT_SIZES = (256, 1024, 2048)
+ALL_SIZES = (256, 1024, 2048, 4096, 8192)
+# A stage is flagged when its median time grows by more than this factor
+REGRESSION_THRESHOLD = 1.2
+# tracemalloc slows pure-Python code by 10-20x, so slower stages skip the
+# traced memory run
+MAX_TRACED_SECONDS = 2.0
+# float32 and float64 runs of the same raster must agree on every volume
+# figure to this relative tolerance
+PRECISION_VOLUME_TOLERANCE = 1e-5
+PRECISION_FIELDS = ("volume_m3", "total_area_m2", "max_depth", "mean_depth",
+                    "volume_pixel_method_m3", "volume_integral_method_m3")
+
+
+# === STAGES ===
+# Each stage takes the DEM path (already copied into the scratch working
+# directory) and returns (setup, run): setup() prepares state that is not
+# being measured and runs before every repeat, run(state) is timed.
+# Memoised analyses are called through `.uncached` so the computation is
+# measured, not the result cache.
+
+def _stage_crop_dem(dem_file):
+    import rasterio
+
+    from geodesy import transform_bounds
+
+    with rasterio.open(dem_file) as src:
+        west, south, east, north = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+    # Crop the central 80% of the raster, as drawn on the Leaflet map
+    dx, dy = (east - west) * 0.1, (north - south) * 0.1
+    polygon = [
+        {"lat": south + dy, "lng": west + dx}, {"lat": north - dy, "lng": west + dx},
+        {"lat": north - dy, "lng": east - dx}, {"lat": south + dy, "lng": east - dx},
+    ]
+
+    def setup():
+        shutil.copyfile(dem_file, "dem_tile.tif")
+        return polygon
+
+    def run(state):
+        from extraFunctions import crop_dem
+        return crop_dem(state)
+
+    return setup, run
+
+
+def _stage_calculate_quarry_depth(dem_file):
+    from depth_analysis import calculate_quarry_depth
+    return (lambda: None), (lambda state: calculate_quarry_depth.uncached(dem_file))
+
+
+def _stage_calculate_excavation_volume(dem_file):
+    from volume_calculator import calculate_excavation_volume
+    return (lambda: None), (lambda state: calculate_excavation_volume.uncached(dem_file))
+
+
+def _stage_calculate_slope_simple(dem_file):
+    from slope_analysis import calculate_slope_simple
+    return (lambda: None), (lambda state: calculate_slope_simple.uncached(dem_file))
+
+
+def _stage_analyze_depressions(dem_file):
+    from hydrology import analyze_depressions
+    return (lambda: None), (lambda state: analyze_depressions.uncached(dem_file))
+
+
+def _stage_generate_3d_terrain_data(dem_file):
+    import artifact_store
+    from three_visualization import generate_3d_terrain_data
+
+    def setup():
+        # Measure generation, not an artifact-store hit
+        shutil.rmtree(artifact_store.terrain_store.root, ignore_errors=True)
+        artifact_store.terrain_store.index = None
+
+    return setup, (lambda state: generate_3d_terrain_data(dem_file))
+
+
+def _stage_generate_depth_visualization(dem_file):
+    from depth_analysis import calculate_quarry_depth, generate_depth_visualization
+
+    depth_data = calculate_quarry_depth(dem_file)[0]
+    output = os.path.join("static", "Figure", "benchmark_depth.png")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    return (lambda: None), (lambda state: generate_depth_visualization(depth_data, output))
+
+
+def _stage_generate_pdf_report(dem_file):
+    from depth_analysis import calculate_quarry_depth, generate_depth_visualization
+    from report_generator import generate_pdf_report
+
+    depth_data, stats = calculate_quarry_depth(dem_file)[:2]
+    image_path = os.path.join("static", "Figure", "benchmark_report.png")
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+    generate_depth_visualization(depth_data, image_path)
+    data = {"sitename": "Benchmark", "stats": stats, "image_path": image_path}
+    return (lambda: None), (lambda state: generate_pdf_report(data, "benchmark.pdf"))
+
+
+# Depth, volume and slope as separate endpoint calls, against the one-shot
+# pipeline that reads the DEM once (stability zones are left out: their
+# polygon vectorisation is the same work either way and dominates the time)
+PIPELINE_PRODUCTS = ("depth", "volume", "slope")
+
+
+def _stage_analysis_sequential(dem_file):
+    from depth_analysis import calculate_quarry_depth
+    from slope_analysis import calculate_slope_simple
+    from volume_calculator import calculate_excavation_volume
+
+    def run(state):
+        calculate_quarry_depth.uncached(dem_file)
+        calculate_excavation_volume.uncached(dem_file)
+        calculate_slope_simple.uncached(dem_file)
+
+    return (lambda: None), run
+
+
+def _stage_analysis_pipeline(dem_file):
+    from analysis_pipeline import run_analysis
+    return (lambda: None), (lambda state: run_analysis(dem_file, PIPELINE_PRODUCTS))
+
+
+STAGES = {
+    "calculate_quarry_depth": _stage_calculate_quarry_depth,
+    "calculate_excavation_volume": _stage_calculate_excavation_volume,
+    "calculate_slope_simple": _stage_calculate_slope_simple,
+    "analyze_depressions": _stage_analyze_depressions,
+    "generate_3d_terrain_data": _stage_generate_3d_terrain_data,
+    "analysis_sequential": _stage_analysis_sequential,
+    "analysis_pipeline": _stage_analysis_pipeline,
+    "generate_depth_visualization": _stage_generate_depth_visualization,
+    "generate_pdf_report": _stage_generate_pdf_report,
+    # Last: importing extraFunctions repoints PROJ_LIB for the process
+    "crop_dem": _stage_crop_dem,
+}
+
+
+# === RUNNER ===
+
+def measure(setup, run, repeat=3, memory=True):
+    """Median/min wall time over `repeat` runs, then one traced run for peak Python-heap memory"""
+    times = []
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+
+    peak = None
+    if memory and statistics.median(times) <= MAX_TRACED_SECONDS:
+        state = setup()
+        tracemalloc.start()
+        run(state)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "median_s": round(statistics.median(times), 4),
+        "min_s": round(min(times), 4),
+        "peak_mb": round(peak / 1e6, 2) if peak is not None else None,
+    }
+
+
+def prepare_datasets(workdir, sizes, dtypes, bundled=True):
+    """Write synthetic rasters (and copy the bundled ones) into workdir"""
+    from synthetic_quarry import write_synthetic_quarry
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    datasets = []
+    for name in BUNDLED_RASTERS if bundled else ():
+        source = os.path.join(repo_dir, name)
+        if os.path.exists(source):
+            target = os.path.join(workdir, f"bundled_{name}")
+            shutil.copyfile(source, target)
+            datasets.append({"name": name, "path": target})
+
+    for dtype in dtypes:
+        for size in sizes:
+            path = os.path.join(workdir, f"synthetic_{size}_{dtype}.tif")
+            write_synthetic_quarry(path, size, size, seed=0, dtype=dtype, void_fraction=0.01)
+            datasets.append({"name": f"synthetic_{size}_{dtype}", "path": path})
+    return datasets
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, dtypes=("float32",), stages=None, repeat=3,
+                   bundled=True, memory=True):
+    """Run every stage on every dataset in a scratch directory, return the results dict"""
+    import rasterio
+
+    stages = stages or list(STAGES)
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+
+    results = {"meta": run_metadata(repeat), "results": {}}
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="qdf_bench_") as workdir:
+        os.chdir(workdir)
+        try:
+            datasets = prepare_datasets(workdir, sizes, dtypes, bundled)
+            shapes = {}
+            for dataset in datasets:
+                with rasterio.open(dataset["path"]) as src:
+                    shapes[dataset["name"]] = (src.height, src.width, src.dtypes[0])
+
+            for stage in (name for name in STAGES if name in stages):
+                for dataset in datasets:
+                    height, width, dtype = shapes[dataset["name"]]
+                    key = f"{stage}[{dataset['name']}]"
+                    print(f"⏱️ {key} ({width} x {height} {dtype})", flush=True)
+                    try:
+                        setup, run = STAGES[stage](dataset["path"])
+                        result = measure(setup, run, repeat, memory)
+                        result["mpixels_per_s"] = round(width * height / 1e6 / max(result["median_s"], 1e-9), 2)
+                    except Exception as e:
+                        print(f"❌ {key} failed: {e}")
+                        result = {"error": str(e)}
+                    result.update({"stage": stage, "dataset": dataset["name"],
+                                   "width": width, "height": height, "dtype": dtype})
+                    results["results"][key] = result
+        finally:
+            os.chdir(previous_dir)
+
+    return results
+
+
+def _precision_child(dem_file, output):
+    """
+    Depth and volume figures of one raster under the QDF_PRECISION of this
+    process, plus its peak RSS. Runs in a fresh subprocess so the peak
+    belongs to one precision only.
+    """
+    import resource
+
+    from depth_analysis import calculate_quarry_depth
+    from precision import ANALYSIS_DTYPE
+    from volume_calculator import calculate_excavation_volume
+
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    imported = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    start = time.perf_counter()
+    stats = calculate_quarry_depth.uncached(dem_file)[1]
+    volumes = calculate_excavation_volume.uncached(
+        dem_file, reference_elevation=stats["original_surface_elevation"])
+    seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+
+    figures = {field: stats[field] for field in PRECISION_FIELDS if field in stats}
+    figures.update({field: volumes[field] for field in PRECISION_FIELDS if field in volumes})
+    with open(output, "w") as f:
+        json.dump({"precision": ANALYSIS_DTYPE.name, "figures": figures, "seconds": seconds,
+                   "peak_rss_mb": peak / 1e6, "analysis_rss_mb": (peak - imported) / 1e6}, f)
+
+
+def run_precision_check(sizes=DEFAULT_SIZES, dtypes=("float32",), bundled=True,
+                        tolerance=PRECISION_VOLUME_TOLERANCE):
+    """
+    Analyse every dataset under QDF_PRECISION=float64 and float32, each in
+    its own process, and compare the figures and peak RSS. Returns the
+    per-dataset results; "agrees" is False when a figure differs by more
+    than tolerance (relative).
+    """
+    script = os.path.abspath(__file__)
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="qdf_precision_") as workdir:
+        for dataset in prepare_datasets(workdir, sizes, dtypes, bundled):
+            runs = {}
+            for precision in ("float64", "float32"):
+                output = os.path.join(workdir, f"{dataset['name']}_{precision}.json")
+                print(f"⏱️ {dataset['name']} ({precision})", flush=True)
+                subprocess.run([sys.executable, script, "--precision-child", dataset["path"], output],
+                               cwd=workdir, env={**os.environ, "QDF_PRECISION": precision},
+                               stdout=subprocess.DEVNULL, check=True)
+                runs[precision] = load_results(output)
+
+            reference, working = runs["float64"]["figures"], runs["float32"]["figures"]
+            differences = {field: abs(working[field] - reference[field]) / max(abs(reference[field]), 1e-9)
+                           for field in reference}
+            results[dataset["name"]] = {
+                "runs": runs,
+                "relative_difference": differences,
+                "agrees": all(difference <= tolerance for difference in differences.values()),
+                # Rasters small enough to fit under the import peak have no ratio
+                "rss_ratio": (runs["float32"]["analysis_rss_mb"] / runs["float64"]["analysis_rss_mb"]
+                              if runs["float64"]["analysis_rss_mb"] >= 1 else None),
+            }
+    return results
+
+
+def print_precision_results(results, tolerance=PRECISION_VOLUME_TOLERANCE):
+    print(f"\n🎯 float32 vs float64 (tolerance {tolerance:g})")
+    print(f"{'dataset':32s} {'volume m³ (f64)':>16s} {'max rel diff':>13s} "
+          f"{'RSS MB f64':>11s} {'RSS MB f32':>11s} {'ratio':>6s}")
+    for name, result in results.items():
+        runs = result["runs"]
+        worst = max(result["relative_difference"].values(), default=0.0)
+        flag = "" if result["agrees"] else " ❌ disagrees"
+        ratio = f"{result['rss_ratio']:6.2f}" if result["rss_ratio"] is not None else f"{'-':>6s}"
+        print(f"{name:32s} {runs['float64']['figures']['volume_m3']:16.1f} {worst:13.2e} "
+              f"{runs['float64']['analysis_rss_mb']:11.1f} {runs['float32']['analysis_rss_mb']:11.1f} "
+              f"{ratio}{flag}")
+
+
+def run_metadata(repeat):
+    def git(*args):
+        try:
+            return subprocess.check_output(["git", *args], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                           stderr=subprocess.DEVNULL, text=True).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {
+        "commit": git("rev-parse", "--short", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": f"{platform.system()} {platform.machine()} ({os.cpu_count()} CPUs)",
+        "repeat": repeat,
+    }
+
+
+def save_results(results, results_dir=RESULTS_DIR):
+    os.makedirs(results_dir, exist_ok=True)
+    meta = results["meta"]
+    stamp = meta["timestamp"].replace(":", "").replace("-", "")
+    path = os.path.join(results_dir, f"{stamp}_{meta['commit'] or 'nogit'}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"💾 Benchmark results saved: {path}")
+    return path
+
+
+def print_results(results):
+    print(f"\n📊 Benchmarks @ {results['meta']['commit']} ({results['meta']['machine']})")
+    print(f"{'stage[dataset]':60s} {'median s':>10s} {'peak MB':>10s} {'Mpx/s':>8s}")
+    for key, result in results["results"].items():
+        if "error" in result:
+            print(f"{key:60s} {'error':>10s}  {result['error'][:40]}")
+        else:
+            peak = f"{result['peak_mb']:10.1f}" if result["peak_mb"] is not None else f"{'-':>10s}"
+            print(f"{key:60s} {result['median_s']:10.4f} {peak} {result['mpixels_per_s']:8.2f}")
+
+
+def compare_results(baseline, current, threshold=REGRESSION_THRESHOLD):
+    """Print time/memory ratios between two runs, return the regressed keys"""
+    print(f"\n🔍 {baseline['meta']['commit']} → {current['meta']['commit']}")
+    print(f"{'stage[dataset]':60s} {'before s':>10s} {'after s':>10s} {'ratio':>7s} {'mem':>7s}")
+    regressions = []
+    for key, after in current["results"].items():
+        before = baseline["results"].get(key)
+        if not before or "error" in before or "error" in after:
+            continue
+        ratio = after["median_s"] / max(before["median_s"], 1e-9)
+        if after["peak_mb"] is not None and before["peak_mb"] is not None:
+            memory = f"{after['peak_mb'] / max(before['peak_mb'], 1e-9):6.2f}x"
+        else:
+            memory = f"{'-':>7s}"
+        flag = ""
+        if ratio > threshold:
+            flag = " ⚠️ slower"
+            regressions.append(key)
+        elif ratio < 1 / threshold:
+            flag = " ✅ faster"
+        print(f"{key:60s} {before['median_s']:10.4f} {after['median_s']:10.4f} "
+              f"{ratio:6.2f}x {memory}{flag}")
+    return regressions
+
+
+def load_results(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="QuarryDepthFinder analysis benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help=f"synthetic raster sizes (e.g. {' '.join(map(str, ALL_SIZES))})")
+    parser.add_argument("--dtypes", nargs="+", default=["float32"], choices=["float32", "int16"])
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-bundled", action="store_true", help="skip cropped.tif / dem_tile.tif")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced memory run")
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--compare", nargs="*", metavar="RESULT_JSON",
+                        help="compare two saved runs (default: the latest two)")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--precision", action="store_true",
+                        help="compare float32 and float64 analysis figures and peak RSS")
+    parser.add_argument("--precision-child", nargs=2, metavar=("DEM", "OUTPUT"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.precision_child:
+        _precision_child(*args.precision_child)
+        return 0
+
+    if args.precision:
+        results = run_precision_check(args.sizes, args.dtypes, not args.no_bundled)
+        print_precision_results(results)
+        return 0 if all(result["agrees"] for result in results.values()) else 1
+
+    if args.compare is not None:
+        paths = args.compare or sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json")))[-2:]
+        if len(paths) != 2:
+            parser.error("need two result files to compare")
+        regressions = compare_results(load_results(paths[0]), load_results(paths[1]), args.threshold)
+        return 1 if regressions else 0
+
+    results = run_benchmarks(args.sizes, args.dtypes, args.stages, args.repeat,
+                             not args.no_bundled, not args.no_memory)
+    print_results(results)
+    if not args.no_save:
+        saved = save_results(results)
+        previous = [p for p in sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json"))) if p != saved]
+        if previous:
+            compare_results(load_results(previous[-1]), results, args.threshold)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+from affine import Affine
+from contourpy import LineType, contour_generator  # ships with matplotlib
+from rasterio.enums import Resampling
+
+from geodesy import get_transformer
+from metrics import record_cache, stage
+from raster_store import raster_hash
+
+CONTOUR_CACHE_DIR = os.path.join("static", "contours")
+MEMORY_CACHE_ENTRIES = 64
+# Contouring runs on at most this many pixels per side; finer rasters are
+# averaged down first, which is far below the visible contour detail
+MAX_CONTOUR_SIZE = 1024
+
+
+_contour_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def simplify_line(points, tolerance):
+    """
+    Douglas-Peucker simplification of an (N, 2) polyline. Uses an explicit
+    stack and vectorised perpendicular distances per segment.
+    """
+    if len(points) < 3 or tolerance <= 0:
+        return points
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[start + 1:end]
+        a, b = points[start], points[end]
+        direction = b - a
+        length = np.hypot(direction[0], direction[1])
+        if length == 0:
+            distances = np.hypot(segment[:, 0] - a[0], segment[:, 1] - a[1])
+        else:
+            distances = np.abs(direction[0] * (segment[:, 1] - a[1]) -
+                               direction[1] * (segment[:, 0] - a[0])) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+
+    return points[keep]
+
+
+def load_contour_surface(dem_file, layer="depth", reference_elevation=None):
+    """
+    Read the raster (downsampled if large) and build the surface to
+    contour. Returns (values, affine transform of the values, crs).
+    """
+    with rasterio.open(dem_file) as src:
+        # Averaged decimated read: GDAL uses overviews when present and
+        # never materialises the full-resolution raster
+        factor = max(1, int(np.ceil(max(src.width, src.height) / MAX_CONTOUR_SIZE)))
+        out_shape = (max(1, src.height // factor), max(1, src.width // factor))
+        data = src.read(1, out_shape=out_shape, resampling=Resampling.average,
+                        masked=True).astype(np.float32).filled(np.nan)
+        transform = src.transform * Affine.scale(src.width / out_shape[1],
+                                                 src.height / out_shape[0])
+        crs = src.crs
+
+    if layer == "depth":
+        if reference_elevation is None:
+            from depth_analysis import estimate_original_surface
+            reference_elevation = estimate_original_surface(data)
+        data = reference_elevation - data
+        data[data < 0] = 0
+
+    return data, transform, crs
+
+
+def extract_contours(values, transform, crs, interval, tolerance=0.5):
+    """
+    Marching-squares contours at every multiple of `interval`, simplified
+    with Douglas-Peucker (tolerance in pixels) and converted to lat/lng.
+    Returns a GeoJSON FeatureCollection of LineStrings.
+    """
+    low, high = np.nanmin(values), np.nanmax(values)
+    if np.isnan(low) or high <= low:
+        return {"type": "FeatureCollection", "features": []}
+
+    # Levels strictly above the minimum, so flat floors don't trace noise
+    first = (np.floor(low / interval) + 1) * interval
+    levels = np.arange(first, high + interval * 0.5, interval)
+    if len(levels) > 500:
+        raise ValueError(f"Contour interval {interval} is too small ({len(levels)} levels)")
+
+    generator = contour_generator(z=np.ma.masked_invalid(values), line_type=LineType.SeparateCode)
+    to_lnglat = None
+    if crs is not None and not crs.is_geographic:
+        to_lnglat = get_transformer(crs, "EPSG:4326")
+
+    features = []
+    for level in levels:
+        lines, _ = generator.lines(level)
+        for line in lines:
+            line = simplify_line(line, tolerance)
+            if len(line) < 2:
+                continue
+            # contourpy returns (col, row) at pixel centres
+            cols, rows = line[:, 0] + 0.5, line[:, 1] + 0.5
+            xs = transform[2] + cols * transform[0] + rows * transform[1]
+            ys = transform[5] + cols * transform[3] + rows * transform[4]
+            if to_lnglat is not None:
+                xs, ys = to_lnglat.transform(xs, ys)
+            coordinates = np.round(np.column_stack([xs, ys]), 6).tolist()
+            features.append({
+                "type": "Feature",
+                "geometry": {"type": "LineString", "coordinates": coordinates},
+                "properties": {"level": float(level)},
+            })
+
+    return {"type": "FeatureCollection", "features": features}
+
+
+def get_contours(dem_file="cropped.tif", layer="depth", interval=5.0,
+                 tolerance=0.5, reference_elevation=None):
+    """
+    Contours for a raster as compact GeoJSON text, cached in memory and on
+    disk by raster content hash, layer, interval and tolerance
+    """
+    interval = float(interval)
+    if interval <= 0:
+        raise ValueError("Contour interval must be positive")
+    if layer not in ("depth", "elevation"):
+        raise ValueError(f"Unknown contour layer: {layer}")
+
+    key_parts = [raster_hash(dem_file), layer, f"{interval:g}", f"{float(tolerance):g}"]
+    if layer == "depth" and reference_elevation is not None:
+        key_parts.append(f"{float(reference_elevation):g}")
+    cache_key = hashlib.sha1(":".join(key_parts).encode()).hexdigest()
+
+    with _cache_lock:
+        if cache_key in _contour_cache:
+            _contour_cache.move_to_end(cache_key)
+            record_cache("contours", True)
+            return _contour_cache[cache_key], cache_key
+
+    cache_path = os.path.join(CONTOUR_CACHE_DIR, f"{cache_key}.geojson")
+    record_cache("contours", os.path.exists(cache_path))
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            geojson_text = f.read()
+    else:
+        with stage("contours"):
+            values, transform, crs = load_contour_surface(dem_file, layer, reference_elevation)
+            contours = extract_contours(values, transform, crs, interval, tolerance)
+        contours["properties"] = {"layer": layer, "interval": interval}
+        geojson_text = json.dumps(contours, separators=(",", ":"))
+
+        os.makedirs(CONTOUR_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(geojson_text)
+        os.replace(tmp_path, cache_path)
+        print(f"🗺️ Contours saved: {cache_path} ({len(contours['features'])} lines)")
+
+    with _cache_lock:
+        _contour_cache[cache_key] = geojson_text
+        while len(_contour_cache) > MEMORY_CACHE_ENTRIES:
+            _contour_cache.popitem(last=False)
+
+    return geojson_text, cache_key
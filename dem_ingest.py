@@ -0,0 +1,369 @@
+import math
+import os
+import threading
+import time
+import uuid
+
+import rasterio
+from rasterio import shutil as rio_shutil
+from rasterio.enums import Resampling
+from rasterio.errors import RasterioError
+from rasterio.transform import Affine
+from werkzeug.utils import secure_filename
+
+from geodesy import pixel_area_m2
+from precision import read_elevation
+
+MAX_UPLOAD_BYTES = 2 * 1024 * 1024 * 1024
+MAX_UPLOAD_PIXELS = 2_000_000_000
+INGEST_CHUNK_SIZE = 8 * 1024 * 1024
+# The header is checked once this much has arrived: GDAL and most drone
+# software write the IFD first, so bad files are refused mid-upload
+HEADER_PROBE_BYTES = 4 * 1024 * 1024
+TIFF_SIGNATURES = (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+")  # TIFF and BigTIFF
+RASTER_EXTENSIONS = (".tif", ".tiff")
+# Above this size the upload answers with statistics from an overview
+# read and the full analysis continues in the background
+PREVIEW_PIXELS = 64 * 1024 * 1024
+PREVIEW_MAX_SIDE = 2048
+# Rasters smaller than this are read whole quickly and left as uploaded
+OPTIMIZE_MIN_PIXELS = 4096 * 4096
+OVERVIEW_MIN_SIDE = 512
+TILE_SIZE = 512
+# Finished background jobs kept for /api/uploads/<upload_id>
+KEEP_JOBS = 50
+
+
+class IngestError(Exception):
+    """Upload refused; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def read_header(path):
+    """
+    Georeferencing and layout of a GeoTIFF from its IFD only (no pixel
+    data is read), or None if GDAL cannot open it (yet)
+    """
+    try:
+        with rasterio.open(path) as src:
+            return {
+                "width": src.width,
+                "height": src.height,
+                "count": src.count,
+                "dtype": src.dtypes[0],
+                "crs": src.crs.to_string() if src.crs else None,
+                "transform": list(src.transform)[:6],
+                "nodata": src.nodata,
+                "tiled": bool(src.profile.get("tiled")),
+                "block_shape": list(src.block_shapes[0]),
+                "overviews": src.overviews(1),
+            }
+    except RasterioError:
+        return None
+
+
+def validate_header(header):
+    """
+    Refuse rasters the analysis cannot use; returns warnings for the
+    ones it can use with care
+    """
+    if header["width"] * header["height"] > MAX_UPLOAD_PIXELS:
+        raise IngestError(f"Raster is {header['width']} x {header['height']} pixels, "
+                          f"the limit is {MAX_UPLOAD_PIXELS:,}", 413)
+    if header["dtype"].startswith("complex"):
+        raise IngestError(f"Band type {header['dtype']} is not an elevation band", 422)
+    if header["count"] >= 3 and header["dtype"] == "uint8":
+        raise IngestError("This looks like an RGB orthophoto, not an elevation model", 422)
+    if not header["crs"]:
+        raise IngestError("The GeoTIFF has no coordinate reference system", 422)
+    a, b, _, d, e, _ = header["transform"]
+    if (a, b, d, e) == (1.0, 0.0, 0.0, 1.0):
+        raise IngestError("The GeoTIFF is not georeferenced (identity geotransform)", 422)
+
+    warnings = []
+    if header["nodata"] is None:
+        warnings.append("No NoData value set; voids will be analysed as real elevations")
+    if header["count"] > 1:
+        warnings.append(f"{header['count']} bands found, only band 1 is analysed")
+    return warnings
+
+
+def ingest_upload(stream, filename, store=None, max_bytes=MAX_UPLOAD_BYTES,
+                  content_length=None, chunk_size=INGEST_CHUNK_SIZE):
+    """
+    Stream an upload to disk in large chunks, hashing it on the way and
+    validating the TIFF signature, size limit and georeferencing as soon
+    as the bytes for each check have arrived. A refused upload stops
+    reading at once and leaves nothing behind. Accepted rasters go into
+    the content-addressed raster store, once per content.
+    Returns {path, filename, bytes, sha1, deduplicated, header, warnings, seconds}.
+    """
+    from raster_store import content_digest, raster_store
+
+    store = store or raster_store
+    if not filename or not filename.lower().endswith(RASTER_EXTENSIONS):
+        raise IngestError("Invalid file type. Only .tif allowed", 415)
+    if content_length and content_length > max_bytes:
+        raise IngestError(f"Upload is {content_length:,} bytes, the limit is {max_bytes:,}", 413)
+
+    safe_name = secure_filename(filename)
+    partial = store.temp_path("upload")
+
+    start = time.perf_counter()
+    digest = content_digest()
+    written = 0
+    head = b""
+    header = None
+    try:
+        with open(partial, "wb") as f:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > max_bytes:
+                    raise IngestError(f"Upload exceeds the {max_bytes:,} byte limit", 413)
+                if len(head) < 4:
+                    head += chunk[:4]
+                    if len(head) >= 4 and head[:4] not in TIFF_SIGNATURES:
+                        raise IngestError("The file is not a TIFF", 415)
+                digest.update(chunk)
+                f.write(chunk)
+                if header is None and written >= HEADER_PROBE_BYTES:
+                    f.flush()
+                    header = read_header(partial)
+                    if header is not None:
+                        validate_header(header)
+
+        if written < 4:
+            raise IngestError("The upload is empty", 400)
+        if header is None:
+            # Small file, or the IFD was written after the pixel data
+            header = read_header(partial)
+            if header is None:
+                raise IngestError("The file is not a readable GeoTIFF", 422)
+        warnings = validate_header(header)
+    except BaseException:
+        try:
+            os.remove(partial)
+        except OSError:
+            pass
+        raise
+
+    sha1 = digest.hexdigest()
+    path, deduplicated = store.add_file(partial, sha1, name=safe_name, source="upload")
+
+    seconds = time.perf_counter() - start
+    print(f"📥 Ingested {safe_name}: {written / 1e6:.1f} MB in {seconds:.2f} s "
+          f"({written / 1e6 / max(seconds, 1e-6):.0f} MB/s), {header['width']} x {header['height']}")
+    return {
+        "path": path,
+        "filename": safe_name,
+        "bytes": written,
+        "sha1": sha1,
+        "deduplicated": deduplicated,
+        "header": header,
+        "warnings": warnings,
+        "seconds": round(seconds, 3),
+    }
+
+
+def stored_upload(sha1, filename, store=None):
+    """
+    An upload of a raster the store already holds, named by its SHA-1 so
+    the client can skip sending the bytes. None if it is not stored.
+    """
+    from raster_store import raster_store
+
+    store = store or raster_store
+    path = store.get(sha1)
+    header = read_header(path) if path else None
+    if header is None:
+        return None
+    return {
+        "path": path,
+        "filename": secure_filename(filename or f"{sha1}.tif"),
+        "bytes": os.path.getsize(path),
+        "sha1": sha1,
+        "deduplicated": True,
+        "header": header,
+        "warnings": validate_header(header),
+        "seconds": 0.0,
+    }
+
+
+def tiled_path(path):
+    return f"{os.path.splitext(path)[0]}.tiled.tif"
+
+
+def overview_factors(width, height):
+    factors, factor = [], 2
+    while max(width, height) / factor >= OVERVIEW_MIN_SIDE:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def optimize_upload(path):
+    """
+    Make a large upload cheap to read at any scale. Striped rasters get a
+    tiled, compressed copy with internal overviews next to the upload;
+    tiled ones without overviews get an external .ovr. The upload's own
+    bytes never change, so its content hash stays its identity.
+    Returns the raster to read previews and tiles from.
+    """
+    from raster_store import raster_store
+
+    header = read_header(path)
+    if header is None or header["width"] * header["height"] < OPTIMIZE_MIN_PIXELS:
+        return path
+    factors = overview_factors(header["width"], header["height"])
+    start = time.perf_counter()
+
+    if not header["tiled"]:
+        target = tiled_path(path)
+        if os.path.exists(target):
+            return target
+        temporary = f"{target}.{threading.get_ident()}.tmp"
+        predictor = 3 if header["dtype"].startswith("float") else 2
+        try:
+            rio_shutil.copy(path, temporary, driver="GTiff", tiled=True, blockxsize=TILE_SIZE,
+                            blockysize=TILE_SIZE, compress="deflate", predictor=predictor,
+                            BIGTIFF="IF_SAFER")
+            with rasterio.open(temporary, "r+") as dst:
+                dst.build_overviews(factors, Resampling.average)
+                dst.update_tags(ns="rio_overview", resampling="average")
+            os.replace(temporary, target)
+        except Exception:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        raster_store.refresh_size(path)
+        print(f"🧱 Tiled copy with overviews {factors} of {path} in {time.perf_counter() - start:.1f} s")
+        return target
+
+    if factors and not header["overviews"]:
+        # TIFF_USE_OVR writes the overviews to <path>.ovr instead of the file
+        with rasterio.Env(TIFF_USE_OVR=True):
+            with rasterio.open(path, "r+") as dst:
+                dst.build_overviews(factors, Resampling.average)
+        raster_store.refresh_size(path)
+        print(f"🧱 External overviews {factors} for {path} in {time.perf_counter() - start:.1f} s")
+    return path
+
+
+def preview_statistics(dem_file, reference_point=None, max_side=PREVIEW_MAX_SIDE):
+    """
+    Depth statistics from an averaged read of at most max_side pixels per
+    side. GDAL serves it from overviews when the raster has them; pixel
+    areas are scaled, so area and volume stay in full-resolution units.
+    """
+    from depth_analysis import (depth_statistics, estimate_original_surface,
+                                reference_point_elevation)
+
+    with rasterio.open(dem_file) as src:
+        factor = max(1, math.ceil(max(src.width, src.height) / max_side))
+        out_shape = (max(1, math.ceil(src.height / factor)), max(1, math.ceil(src.width / factor)))
+        dem_data = read_elevation(src, out_shape=out_shape, resampling=Resampling.average)
+        transform = src.transform * Affine.scale(src.width / out_shape[1], src.height / out_shape[0])
+        crs = src.crs
+
+    estimated_surface = estimate_original_surface(dem_data)
+    surface = None
+    if reference_point:
+        surface = reference_point_elevation(dem_data, transform, crs, reference_point)
+    if surface is None:
+        surface = estimated_surface
+    pixel_area = pixel_area_m2(transform, crs, dem_data.shape[0])
+    _, stats = depth_statistics(dem_data, surface, pixel_area, estimated_surface)
+    stats["preview"] = True
+    stats["preview_factor"] = factor
+    return stats
+
+
+def upload_preview(path, reference_point=None):
+    """
+    Preview statistics of a large upload. Its overviews (for striped
+    rasters, a tiled copy with overviews) are built first: without them
+    the averaged read would decode the whole raster inside the request.
+    Returns (stats, optimised raster, or None if optimising failed).
+    """
+    try:
+        optimized = optimize_upload(path)
+    except Exception as e:
+        # Overviews only speed up reads; the preview still works without
+        print(f"⚠️ Could not optimise {path}: {e}")
+        optimized = None
+    return preview_statistics(optimized or path, reference_point), optimized
+
+
+class UploadJob:
+    """Background full analysis of one large upload, optimising it first if still needed"""
+
+    def __init__(self, upload, analyze, optimized=None):
+        self.id = uuid.uuid4().hex[:16]
+        self.upload = upload
+        self.analyze = analyze
+        self.state = "queued"
+        self.optimized = optimized
+        self.result = None
+        self.error = None
+        self.started = time.perf_counter()
+        self.seconds = None
+
+    def run(self):
+        if self.optimized is None:
+            self.state = "optimizing"
+            try:
+                self.optimized = optimize_upload(self.upload["path"])
+            except Exception as e:
+                # Overviews only speed up later reads; the analysis still runs
+                print(f"⚠️ Could not optimise {self.upload['path']}: {e}")
+        self.state = "analyzing"
+        try:
+            self.result = self.analyze(self.upload)
+            self.state = "finished"
+        except Exception as e:
+            print(f"❌ Background analysis of {self.upload['path']} failed: {e}")
+            self.error = str(e)
+            self.state = "failed"
+        self.seconds = round(time.perf_counter() - self.started, 2)
+
+    def status(self):
+        return {
+            "upload_id": self.id,
+            "state": self.state,
+            "filename": self.upload["filename"],
+            "sha1": self.upload["sha1"],
+            "optimized": self.optimized,
+            "result": self.result,
+            "error": self.error,
+            "seconds": self.seconds,
+        }
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def start_upload_job(upload, analyze, optimized=None):
+    """Run analyze(upload) on a background thread, optimising the upload first unless already done"""
+    job = UploadJob(upload, analyze, optimized)
+    with _jobs_lock:
+        _jobs[job.id] = job
+        while len(_jobs) > KEEP_JOBS:
+            oldest = next((job_id for job_id, old in _jobs.items()
+                           if old.state in ("finished", "failed")), None)
+            if oldest is None:
+                break
+            del _jobs[oldest]
+    threading.Thread(target=job.run, daemon=True).start()
+    return job
+
+
+def get_upload_job(upload_id):
+    with _jobs_lock:
+        return _jobs.get(upload_id)
@@ -4,9 +4,18 @@ import matplotlib.colors
 import matplotlib.pyplot as plt
 import numpy as np
 import rasterio
-from rasterio.warp import transform
+from rasterio.transform import rowcol
 from scipy import ndimage
 
+from geodesy import pixel_area_m2, transform_points
+from metrics import RASTER_PIXELS
+from precision import as_working, depth_totals, read_elevation
+from result_cache import memoize_analysis
+
+# Depth figures are stored per raster content and parameters, so a stored
+# analysis (and its PDF report) keeps pointing at its own image
+DEPTH_FIGURE_DIR = "static/Figure/depth"
+
 
 # === IMPROVED GRADIENT DESCENT OPTIMIZATION ===
 def gradient_descent_surface_optimization(dem_data, learning_rate=0.1, iterations=1000):
@@ -83,10 +92,15 @@ def gradient_descent_surface_optimization(dem_data, learning_rate=0.1, iteration
 
 
 
-def calculate_quarry_depth(dem_file, reference_point=None):
+@memoize_analysis("quarry_depth")
+def calculate_quarry_depth(dem_file, reference_point=None, fill_voids=False, boundary=None):
     """
     Calculate quarry depth using an optional manual reference point.
     reference_point should be a dict: {'lat': 20.5, 'lng': 78.9}
+    With fill_voids, NoData holes are inpainted so they count towards
+    area and volume instead of being skipped. With a boundary (Leaflet
+    coordinates or GeoJSON), only the polygon is measured, boundary
+    pixels by the fraction inside it.
     """
     try:
         print(f"🔍 Analyzing DEM file: {dem_file}")
@@ -96,92 +110,41 @@ def calculate_quarry_depth(dem_file, reference_point=None):
             return create_fallback_data()
         
         with rasterio.open(dem_file) as src:
-            dem_data = src.read(1)
+            # Working dtype with NoData as NaN
+            dem_data = read_elevation(src)
             transform_affine = src.transform
             crs = src.crs
+            RASTER_PIXELS.observe(dem_data.size, stage="depth")
             
-            # Convert NoData values to NaN
-            dem_data = dem_data.astype(float)
-            dem_data[dem_data == src.nodata] = np.nan
+            filled_pixels = 0
+            if fill_voids:
+                from nodata_fill import fill_nodata
+                void_mask = np.isnan(dem_data)
+                filled_pixels = int(void_mask.sum())
+                fill_nodata(dem_data, void_mask)
+                print(f"🕳️ Filled {filled_pixels} NoData pixels")
             
             # --- 📍 NEW LOGIC: Manual Reference Point ---
             surface_elevation = None
             
             if reference_point:
-                print(f"📍 User provided reference point: {reference_point}")
-                try:
-                    # 1. Convert Lat/Lon (EPSG:4326) to the DEM's Coordinate System
-                    # Note: transform() takes lists of coordinates
-                    xs, ys = transform('EPSG:4326', crs, [reference_point['lng']], [reference_point['lat']])
-                    proj_x, proj_y = xs[0], ys[0]
-                    
-                    # 2. Find which pixel corresponds to that coordinate
-                    row, col = src.index(proj_x, proj_y)
-                    print(f"   Mapped to Pixel: Row {row}, Col {col}")
-                    
-                    # 3. Read the elevation at that pixel
-                    # Check if the point is actually inside the cropped image
-                    if 0 <= row < dem_data.shape[0] and 0 <= col < dem_data.shape[1]:
-                        manual_elevation = dem_data[row, col]
-                        
-                        # Validate the value (not NaN)
-                        if not np.isnan(manual_elevation):
-                            surface_elevation = manual_elevation
-                            print(f"✅ MANUAL REFERENCE SET: {surface_elevation} meters")
-                        else:
-                            print("⚠️ Selected point is NaN (No Data). Using auto-estimation.")
-                    else:
-                        print("⚠️ Reference point is OUTSIDE the cropped quarry area. Using auto-estimation.")
-                        
-                except Exception as e:
-                    print(f"❌ Error processing reference point: {e}")
+                surface_elevation = reference_point_elevation(dem_data, transform_affine, crs, reference_point)
             
             # --- Fallback to Auto-Estimation if no valid manual point ---
+            estimated_surface = estimate_original_surface(dem_data)
             if surface_elevation is None:
                 print("⚙️ Using automatic surface estimation...")
-                surface_elevation = estimate_original_surface(dem_data)
+                surface_elevation = estimated_surface
 
-            # --- STANDARD CALCULATION (Same as before) ---
-            quarry_bottom = np.nanmin(dem_data)
-            
-            # Calculate depth map (Surface - Current)
-            depth_map = surface_elevation - dem_data
-            depth_map[depth_map < 0] = 0  # Ignore things higher than reference
-            depth_map[np.isnan(dem_data)] = np.nan
-            
-            # Calculate Area & Volume
-            pixel_width = abs(transform_affine[0])
-            pixel_height = abs(transform_affine[4])
-            pixel_area = pixel_width * pixel_height
-            
-            valid_depth_mask = (depth_map > 0) & (~np.isnan(depth_map))
-            excavated_pixels = np.sum(valid_depth_mask)
-            total_area_m2 = excavated_pixels * pixel_area
-            volume_m3 = np.nansum(depth_map) * pixel_area
-            
-            # Statistics
-            if excavated_pixels > 0:
-                max_depth = np.nanmax(depth_map)
-                mean_depth = np.nanmean(depth_map[valid_depth_mask])
-                median_depth = np.nanmedian(depth_map[valid_depth_mask])
-            else:
-                max_depth = 0
-                mean_depth = 0
-                median_depth = 0
-            
-            stats = {
-                'max_depth': float(max_depth) if not np.isnan(max_depth) else 0.0,
-                'mean_depth': float(mean_depth) if not np.isnan(mean_depth) else 0.0,
-                'median_depth': float(median_depth) if not np.isnan(median_depth) else 0.0,
-                'quarry_bottom_elevation': float(quarry_bottom) if not np.isnan(quarry_bottom) else 0.0,
-                'original_surface_elevation': float(surface_elevation) if not np.isnan(surface_elevation) else 0.0,
-                'volume_m3': float(volume_m3) if not np.isnan(volume_m3) else 0.0,
-                'total_area_m2': float(total_area_m2) if not np.isnan(total_area_m2) else 0.0,
-                'excavated_pixels': int(excavated_pixels),
-                'pixel_area_m2': float(pixel_area) if not np.isnan(pixel_area) else 0.0,
-                'surface_original_method': float(estimate_original_surface(dem_data)), # For comparison
-                'surface_gradient_descent': float(surface_elevation) # Using manual as the "optimized" value
-            }
+            # m² per pixel, one value per row for geographic (degree) grids
+            pixel_area = pixel_area_m2(transform_affine, crs, dem_data.shape[0])
+            coverage = None
+            if boundary:
+                from pixel_coverage import pixel_coverage
+                coverage = pixel_coverage(boundary, transform_affine, crs, dem_data.shape)
+            depth_map, stats = depth_statistics(dem_data, surface_elevation, pixel_area,
+                                                estimated_surface, coverage)
+            stats['filled_void_pixels'] = filled_pixels
             
             return depth_map, stats, transform_affine, crs
             
@@ -191,6 +154,102 @@ def calculate_quarry_depth(dem_file, reference_point=None):
         traceback.print_exc()
         return create_fallback_data()
 
+def reference_point_elevation(dem_data, transform_affine, crs, reference_point):
+    """
+    Elevation of the DEM under a manual reference point {'lat': .., 'lng': ..},
+    or None when the point is outside the raster or on NoData
+    """
+    print(f"📍 User provided reference point: {reference_point}")
+    try:
+        # 1. Convert Lat/Lon (EPSG:4326) to the DEM's Coordinate System
+        # Note: transform_points() takes lists of coordinates
+        xs, ys = transform_points('EPSG:4326', crs, [reference_point['lng']], [reference_point['lat']])
+        proj_x, proj_y = xs[0], ys[0]
+        
+        # 2. Find which pixel corresponds to that coordinate
+        row, col = rowcol(transform_affine, proj_x, proj_y)
+        print(f"   Mapped to Pixel: Row {row}, Col {col}")
+        
+        # 3. Read the elevation at that pixel
+        # Check if the point is actually inside the cropped image
+        if 0 <= row < dem_data.shape[0] and 0 <= col < dem_data.shape[1]:
+            manual_elevation = dem_data[row, col]
+            
+            # Validate the value (not NaN)
+            if not np.isnan(manual_elevation):
+                print(f"✅ MANUAL REFERENCE SET: {manual_elevation} meters")
+                return manual_elevation
+            print("⚠️ Selected point is NaN (No Data). Using auto-estimation.")
+        else:
+            print("⚠️ Reference point is OUTSIDE the cropped quarry area. Using auto-estimation.")
+            
+    except Exception as e:
+        print(f"❌ Error processing reference point: {e}")
+    return None
+
+
+def depth_statistics(dem_data, surface_elevation, pixel_area, estimated_surface=None,
+                     coverage=None):
+    """
+    Depth map below a reference surface and its summary statistics.
+    pixel_area is in m², a float or one value per row (geodesy.pixel_area_m2).
+    With a pixel_coverage.PixelCoverage, the depth map is NaN outside the polygon
+    and boundary pixels are weighted by their covered fraction.
+    Returns (depth_map, stats).
+    """
+    if coverage is None:
+        quarry_bottom = np.nanmin(dem_data)
+    else:
+        quarry_bottom = np.nanmin(dem_data, where=coverage.covered, initial=np.inf)
+        if np.isinf(quarry_bottom):
+            quarry_bottom = np.nan
+    
+    # Calculate depth map (Surface - Current) in the DEM's dtype; NoData
+    # stays NaN because NaN propagates through the subtraction and maximum
+    depth_map = np.subtract(as_working(surface_elevation, dem_data), dem_data)
+    np.maximum(depth_map, 0, out=depth_map)  # Ignore things higher than reference
+    if coverage is not None:
+        depth_map[~coverage.covered] = np.nan
+    
+    # Calculate Area & Volume (NaN compares False, so the mask skips NoData)
+    valid_depth_mask = depth_map > 0
+    excavated_pixels, depth_sum, total_area_m2, volume_m3 = depth_totals(
+        depth_map, valid_depth_mask, pixel_area, coverage)
+    
+    # Statistics
+    if excavated_pixels > 0:
+        max_depth = np.max(depth_map, where=valid_depth_mask, initial=0)
+        if coverage is None:
+            mean_depth = depth_sum / excavated_pixels
+            median_depth = np.median(depth_map[valid_depth_mask])
+        else:
+            mean_depth = depth_sum / coverage.weight_sum(valid_depth_mask)
+            median_depth = coverage.weighted_median(depth_map, valid_depth_mask)
+    else:
+        max_depth = 0
+        mean_depth = 0
+        median_depth = 0
+    
+    if estimated_surface is None:
+        estimated_surface = estimate_original_surface(dem_data)
+    
+    stats = {
+        'max_depth': float(max_depth) if not np.isnan(max_depth) else 0.0,
+        'mean_depth': float(mean_depth) if not np.isnan(mean_depth) else 0.0,
+        'median_depth': float(median_depth) if not np.isnan(median_depth) else 0.0,
+        'quarry_bottom_elevation': float(quarry_bottom) if not np.isnan(quarry_bottom) else 0.0,
+        'original_surface_elevation': float(surface_elevation) if not np.isnan(surface_elevation) else 0.0,
+        'volume_m3': float(volume_m3) if not np.isnan(volume_m3) else 0.0,
+        'total_area_m2': float(total_area_m2) if not np.isnan(total_area_m2) else 0.0,
+        'excavated_pixels': int(excavated_pixels),
+        'pixel_area_m2': float(np.mean(pixel_area)),
+        'surface_original_method': float(estimated_surface), # For comparison
+        'surface_gradient_descent': float(surface_elevation) # Using manual as the "optimized" value
+    }
+    if coverage is not None:
+        stats['boundary'] = coverage.summary(pixel_area)
+    return depth_map, stats
+
 def estimate_original_surface(dem_data):
     """
     Estimate original ground surface before excavation
@@ -347,3 +406,36 @@ def generate_depth_visualization(depth_data, output_path):
         print(f"❌ Error generating visualization: {e}")
         import traceback
         traceback.print_exc()
+
+
+@memoize_analysis("depth_visualization")
+def render_depth_visualization(dem_file, reference_point=None, fill_voids=False, boundary=None):
+    """PNG bytes of the depth visualization for a DEM, memoised per raster content"""
+    import tempfile
+
+    depth_data = calculate_quarry_depth(dem_file, reference_point, fill_voids, boundary)[0]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        png_path = os.path.join(tmp_dir, "depth.png")
+        generate_depth_visualization(depth_data, png_path)
+        with open(png_path, "rb") as f:
+            return f.read()
+
+
+def depth_visualization_path(dem_file, **params):
+    """Figure path unique to the DEM's content and the depth parameters"""
+    from artifact_store import artifact_key
+    from raster_store import raster_hash
+
+    return os.path.join(DEPTH_FIGURE_DIR, f"{artifact_key(raster_hash(dem_file), params)}.png")
+
+
+def save_depth_visualization(dem_file, output_path, reference_point=None, fill_voids=False,
+                             boundary=None):
+    """Write the (memoised) depth visualization of a DEM to output_path"""
+    png = render_depth_visualization(dem_file, reference_point, fill_voids, boundary)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(png)
+    os.replace(tmp_path, output_path)
+    return output_path
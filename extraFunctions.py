@@ -1,12 +1,17 @@
 import os
+import shutil
 
 import matplotlib.pyplot as plt
 import pyproj
 import rasterio
 import requests
-from rasterio.warp import transform_bounds
 from rasterio.windows import from_bounds
 
+from dem_ingest import read_header
+from geodesy import transform_bounds
+from metrics import DOWNLOAD_BYTES, RASTER_PIXELS
+from raster_store import content_digest, raster_store
+
 # Set PROJ_LIB path
 try:
     os.environ['PROJ_LIB'] = pyproj.datadir.get_data_dir()
@@ -52,14 +57,33 @@ def download_dem(south, west, north, east, typeofdem="COP", output_file='dem_til
             if data.get('items'):
                 # Download the first available product
                 download_url = data['items'][0]['downloadURL']
+                # The same product was downloaded before: copy it from the raster store
+                if copy_stored_download(f"download:{download_url}", output_file):
+                    return
                 print(f"⬇️ Downloading 1m DEM from: {download_url}")
                 
                 file_response = requests.get(download_url, stream=True)
+                # An error page must not be stored as the product's DEM
+                file_response.raise_for_status()
                 
-                # FIX 2: Save directly to 'output_file' (dem_tile.tif) so crop_dem finds it
-                with open(output_file, 'wb') as f:
-                    for chunk in file_response.iter_content(chunk_size=8192):
+                # Hashed while streaming, so it goes into the raster store by rename
+                downloaded = 0
+                digest = content_digest()
+                temp_path = raster_store.temp_path("download")
+                with open(temp_path, 'wb') as f:
+                    for chunk in file_response.iter_content(chunk_size=1024 * 1024):
                         f.write(chunk)
+                        digest.update(chunk)
+                        downloaded += len(chunk)
+                DOWNLOAD_BYTES.observe(downloaded, source=typeofdem)
+                if read_header(temp_path) is None:
+                    os.remove(temp_path)
+                    print(f"❌ Downloaded 1m DEM is not a readable raster: {download_url}")
+                    return
+                stored, _ = raster_store.add_file(temp_path, digest.hexdigest(), name=os.path.basename(download_url),
+                                                  source=typeofdem, alias=f"download:{download_url}")
+                # FIX 2: Save to 'output_file' (dem_tile.tif) so crop_dem finds it
+                shutil.copyfile(stored, output_file)
                 
                 print(f"✅ Downloaded 1m DEM to: {output_file}")
                 return # STOP here! Do not run the code below.
@@ -92,20 +116,47 @@ def download_dem(south, west, north, east, typeofdem="COP", output_file='dem_til
             f"&outputFormat={output_format}&API_Key={dem_key}"
         )
         
+    # Same dataset and bounding box as an earlier download: no request at all
+    alias = f"download:{typeofdem}:{south:.6f},{west:.6f},{north:.6f},{east:.6f}"
+    if copy_stored_download(alias, output_file):
+        return
+
     print(f"Requesting DEM data from: {url}")
 
     # Send GET request for Cases 2 & 3
     response = requests.get(url, verify=True)
 
     if response.status_code == 200:
-        with open(output_file, "wb") as f:
+        DOWNLOAD_BYTES.observe(len(response.content), source=typeofdem)
+        # An error body served with 200 must not be replayed for this bbox
+        temp_path = raster_store.temp_path("download")
+        with open(temp_path, "wb") as f:
             f.write(response.content)
+        if read_header(temp_path) is None:
+            os.remove(temp_path)
+            print(f"❌ Downloaded DEM is not a readable raster: {response.text[:200]}")
+            return
+        shutil.copyfile(temp_path, output_file)
+        try:
+            raster_store.add_file(temp_path, content_digest(response.content).hexdigest(),
+                                  name=os.path.basename(output_file), source=typeofdem, alias=alias)
+        except OSError as e:
+            print(f"⚠️ Could not keep the download in the raster store: {e}")
         print(f"✅ DEM saved successfully to {output_file}")
     else:
         print(f"❌ Failed to download DEM. Status code: {response.status_code}")
         print("Response message:", response.text)
 
-def crop_dem(leaflet_polygon_coords):
+def copy_stored_download(alias, output_file):
+    """Copy a previously downloaded DEM from the raster store; False if there is none"""
+    stored = raster_store.resolve(alias)
+    if stored is None:
+        return False
+    shutil.copyfile(stored, output_file)
+    print(f"♻️ Reusing stored DEM for {alias} -> {output_file}")
+    return True
+
+def crop_dem(leaflet_polygon_coords, input_tif="dem_tile.tif", output_tif="cropped.tif"):
     # ... (Keep your existing crop_dem code exactly as is) ...
     # Step 1: Extract all lats and lngs
     lats = [pt["lat"] for pt in leaflet_polygon_coords]
@@ -115,9 +166,6 @@ def crop_dem(leaflet_polygon_coords):
     min_lon, max_lon = min(lons), max(lons)
     min_lat, max_lat = min(lats), max(lats)
 
-    input_tif = "dem_tile.tif"
-    output_tif = "cropped.tif"
-
     # Check if input file exists before trying to open
     if not os.path.exists(input_tif):
         print(f"❌ Error: {input_tif} was not created. Download failed.")
@@ -137,6 +185,7 @@ def crop_dem(leaflet_polygon_coords):
 
             # Step 5: Read cropped data
             data = src.read(window=window)
+            RASTER_PIXELS.observe(data.shape[-1] * data.shape[-2], stage="crop")
 
             # Step 6: Update metadata
             out_meta = src.meta.copy()
@@ -0,0 +1,114 @@
+"""
+Coordinate transforms and ground pixel sizes.
+
+pyproj Transformers are cached per CRS pair for the life of the process:
+building one resolves the operation in proj.db, which costs more than
+transforming thousands of points. Geographic rasters (COP30, SRTM) keep
+their degree grid; their pixel sizes and areas are computed per row on
+the WGS84 ellipsoid, which is exact for a north-up grid and avoids
+resampling the DEM to UTM.
+"""
+import functools
+
+import numpy as np
+from pyproj import Transformer
+
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+
+
+def _crs_key(crs):
+    # rasterio and pyproj CRS objects both export WKT; strings pass through
+    return crs if isinstance(crs, str) else crs.to_wkt()
+
+
+@functools.lru_cache(maxsize=64)
+def _transformer(source, target):
+    return Transformer.from_crs(source, target, always_xy=True)
+
+
+def get_transformer(source_crs, target_crs):
+    """Cached x/y (lng/lat) order Transformer between two CRSs"""
+    return _transformer(_crs_key(source_crs), _crs_key(target_crs))
+
+
+def transform_points(source_crs, target_crs, xs, ys):
+    """Coordinate arrays transformed between CRSs, as float arrays"""
+    xs, ys = get_transformer(source_crs, target_crs).transform(
+        np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+    return np.asarray(xs), np.asarray(ys)
+
+
+def transform_bounds(source_crs, target_crs, left, bottom, right, top, densify_pts=21):
+    """Bounding box in another CRS, densified along the edges like rasterio's"""
+    return get_transformer(source_crs, target_crs).transform_bounds(
+        left, bottom, right, top, densify_pts=densify_pts)
+
+
+def transform_geometry(source_crs, target_crs, geometry):
+    """A GeoJSON geometry (any type) with every coordinate transformed"""
+    transformer = get_transformer(source_crs, target_crs)
+
+    def convert(coordinates):
+        if np.isscalar(coordinates[0]):  # one position
+            return list(transformer.transform(coordinates[0], coordinates[1]))
+        if np.isscalar(coordinates[0][0]):  # a ring or line, in one call
+            array = np.asarray(coordinates, dtype=np.float64)
+            xs, ys = transformer.transform(array[:, 0], array[:, 1])
+            return np.column_stack([xs, ys]).tolist()
+        return [convert(part) for part in coordinates]
+
+    if geometry["type"] == "GeometryCollection":
+        return {"type": "GeometryCollection",
+                "geometries": [transform_geometry(source_crs, target_crs, g)
+                               for g in geometry["geometries"]]}
+    return {"type": geometry["type"], "coordinates": convert(geometry["coordinates"])}
+
+
+def is_geographic(crs):
+    return bool(getattr(crs, "is_geographic", False))
+
+
+def row_latitudes(transform, height, edges=False):
+    """Latitude of every row centre (or the height + 1 row edges) of a north-up grid"""
+    offsets = np.arange(height + 1, dtype=np.float64) if edges else np.arange(height) + 0.5
+    return transform[5] + offsets * transform[4]
+
+
+def _authalic_q(latitudes):
+    # Snyder (1987) eq. 3-12: q, proportional to the ellipsoid area from
+    # the equator to each latitude
+    sin = np.sin(np.radians(np.clip(latitudes, -90.0, 90.0)))
+    e = np.sqrt(WGS84_E2)
+    return (1 - WGS84_E2) * (sin / (1 - WGS84_E2 * sin ** 2)
+                             - np.log((1 - e * sin) / (1 + e * sin)) / (2 * e))
+
+
+def pixel_area_m2(transform, crs, height):
+    """
+    Ground area of a pixel in m². A float for projected rasters (the grid
+    unit squared); for geographic rasters an array with one area per row,
+    since a pixel of fixed degrees shrinks towards the poles.
+    """
+    if not is_geographic(crs):
+        return abs(transform[0] * transform[4] - transform[1] * transform[3])
+    q = _authalic_q(row_latitudes(transform, height, edges=True))
+    return (WGS84_A ** 2 / 2) * np.radians(abs(transform[0])) * np.abs(np.diff(q))
+
+
+def pixel_size_m(transform, crs, height):
+    """
+    (x size, y size) of a pixel in metres: floats for projected rasters,
+    one value per row for geographic ones (parallel and meridian arcs at
+    the row centre latitude)
+    """
+    if not is_geographic(crs):
+        return abs(transform[0]), abs(transform[4])
+    latitudes = np.radians(row_latitudes(transform, height))
+    denominator = 1 - WGS84_E2 * np.sin(latitudes) ** 2
+    prime_vertical = WGS84_A / np.sqrt(denominator)
+    meridian = WGS84_A * (1 - WGS84_E2) / denominator ** 1.5
+    x_size = np.radians(abs(transform[0])) * prime_vertical * np.cos(latitudes)
+    y_size = np.radians(abs(transform[4])) * meridian
+    return x_size, y_size
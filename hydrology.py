@@ -0,0 +1,454 @@
+"""
+Depression filling: spill level, lake area and ponded volume of pits.
+
+A priority flood from the raster edge (and NoData) gives every pixel the
+lowest level water can drain at; where that is above the ground, the
+pixel holds water. Flooding pixel by pixel from a Python heap would take
+minutes on a multi-million-pixel DEM, so the flood runs on drainage
+basins instead:
+
+1. every pixel follows its steepest downhill neighbour (D8) to a pit;
+   pointer jumping labels each pixel with its pit in a few vectorised
+   passes, and adjacent pits (flats) are merged into one basin;
+2. neighbouring pixels in different basins give the saddle heights
+   between basins, pixels on the raster edge or next to NoData the
+   heights water leaves at;
+3. flooding that basin graph from the outside gives each basin its
+   spill level, the lowest level at which water escapes: the highest
+   saddle on its path out along the minimum spanning tree (O(E log E)
+   for E saddles, in compiled code). The filled surface is max(ground,
+   spill level of the pixel's basin), exactly what a pixel-level
+   priority flood produces.
+
+Flooded basins that share a level and connect below it form one
+depression (a pond or pit lake), reported with its spill elevation, fill
+depth, stored volume and outlet. The raster is processed in square
+blocks: basins stop at block edges and the seams between blocks add
+their saddles to the graph, which keeps the temporary arrays to one
+block. Only the basin labels (4 bytes a pixel) are kept between the two
+passes, on disk for rasters over MAX_IN_MEMORY_PIXELS.
+
+    python hydrology.py cropped.tif
+    python hydrology.py big_dem.tif --labels depressions.tif --block-size 2048
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import breadth_first_order, connected_components, minimum_spanning_tree
+
+from geodesy import is_geographic, pixel_area_m2, transform_points
+from precision import ACCUMULATOR_DTYPE, read_elevation
+from result_cache import memoize_analysis
+
+# Pixels per block side; larger blocks only add temporary memory
+DEFAULT_BLOCK_SIZE = 1024
+# Basin labels of larger rasters go to a temporary file between the passes
+MAX_IN_MEMORY_PIXELS = 4096 * 4096
+# Depressions shallower than this (DEM noise) are filled but not reported
+MIN_FILL_DEPTH = 0.05
+MAX_REPORTED_DEPRESSIONS = 100
+
+# Each undirected 8-neighbour pair is visited once through these offsets
+FORWARD_OFFSETS = ((0, 1), (1, -1), (1, 0), (1, 1))
+ALL_OFFSETS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+
+
+def _shifted(shape, dr, dc):
+    """Slices a, b of an array such that b[i] is a[i]'s (dr, dc) neighbour"""
+    height, width = shape
+    rows_a = slice(max(0, -dr), height - max(0, dr))
+    rows_b = slice(max(0, dr), height - max(0, -dr))
+    cols_a = slice(max(0, -dc), width - max(0, dc))
+    cols_b = slice(max(0, dc), width - max(0, -dc))
+    return (rows_a, cols_a), (rows_b, cols_b)
+
+
+def descent_basins(z):
+    """
+    Basin of every pixel of an elevation block, following the steepest
+    downhill neighbour inside the block. Returns (labels, pit_elevations):
+    labels 1..B (0 on NoData), pit_elevations[b] the lowest ground of
+    basin b (index 0 unused).
+    """
+    index_dtype = np.int32 if z.size < 2 ** 31 else np.int64
+    own = np.arange(z.size, dtype=index_dtype).reshape(z.shape)
+    receiver = own.copy()
+    best_drop = np.zeros(z.shape, dtype=np.float32)
+    for dr, dc in ALL_OFFSETS:
+        a, b = _shifted(z.shape, dr, dc)
+        drop = (z[a] - z[b]).astype(np.float32, copy=False)
+        if dr and dc:
+            drop /= np.float32(np.sqrt(2))
+        steeper = drop > best_drop[a]  # False on NaN
+        np.copyto(best_drop[a], drop, where=steeper)
+        np.copyto(receiver[a], own[a] + index_dtype(dr * z.shape[1] + dc), where=steeper)
+    del best_drop
+
+    # Pointer jumping: every pass doubles the distance each pointer covers
+    receiver = receiver.reshape(-1)
+    while True:
+        jumped = receiver[receiver]
+        if np.array_equal(jumped, receiver):
+            break
+        receiver = jumped
+
+    # Adjacent pits have equal elevation (neither is lower), so 8-connected
+    # pits form one flat and one basin
+    pits = (receiver == own.reshape(-1)).reshape(z.shape) & ~np.isnan(z)
+    pit_labels, count = ndimage.label(pits, structure=np.ones((3, 3), dtype=bool))
+    pit_elevations = np.zeros(count + 1, dtype=ACCUMULATOR_DTYPE)
+    pit_elevations[pit_labels[pits]] = z[pits]
+    labels = pit_labels.reshape(-1)[receiver].reshape(z.shape)
+    return labels, pit_elevations
+
+
+def reduce_edges(low, high, height, pixel):
+    """
+    Keep the lowest saddle (and its pixel) of every basin pair, as
+    (low, high, height, pixel) sorted by (low, high)
+    """
+    low, high = np.minimum(low, high), np.maximum(low, high)
+    if not len(low):
+        return low, high, height, pixel
+    key = (low.astype(np.int64) << 32) | high.astype(np.int64)
+    order = np.argsort(key)
+    key, height = key[order], height[order]
+    group = np.cumsum(np.r_[False, key[1:] != key[:-1]])
+    lowest = np.minimum.reduceat(height, np.flatnonzero(np.r_[True, np.diff(group) > 0]))
+    # First edge of each pair at its lowest height
+    candidates = np.flatnonzero(height == lowest[group])
+    keep = candidates[np.r_[True, np.diff(group[candidates]) > 0]]
+    return low[order[keep]], high[order[keep]], height[keep], pixel[order[keep]]
+
+
+def _empty_edges():
+    return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+            np.zeros(0, dtype=ACCUMULATOR_DTYPE), np.zeros(0, dtype=np.int64))
+
+
+def neighbour_edges(z, labels, row0, col0, width, offsets=FORWARD_OFFSETS):
+    """
+    Saddles between 8-neighbours of a block in different basins, as
+    (basin, basin, height, pixel) with the pixel a flat index into the
+    full raster. Label 0 is NoData, which is outside: water drains into it.
+    """
+    edges = []
+    for dr, dc in offsets:
+        a, b = _shifted(z.shape, dr, dc)
+        label_a, label_b = labels[a], labels[b]
+        differ = label_a != label_b
+        if not differ.any():
+            continue
+        rows, cols = np.nonzero(differ)
+        z_a, z_b = z[a][differ], z[b][differ]
+        # The saddle is the higher pixel of the pair (never the NoData one)
+        a_higher = np.isnan(z_b) | (z_a >= z_b)
+        rows = rows + row0 + a[0].start
+        cols = cols + col0 + a[1].start
+        pixel_a = rows.astype(np.int64) * width + cols
+        edges.append((label_a[differ], label_b[differ],
+                      np.where(a_higher, z_a, z_b).astype(ACCUMULATOR_DTYPE),
+                      np.where(a_higher, pixel_a, pixel_a + dr * width + dc)))
+    return reduce_edges(*_concat_edges(edges))
+
+
+def border_edges(z, labels, row0, col0, shape):
+    """Outflow over the raster edge: edge pixels of a block connect to outside (0) at their elevation"""
+    height, width = shape
+    mask = np.zeros(z.shape, dtype=bool)
+    if row0 == 0:
+        mask[0] = True
+    if col0 == 0:
+        mask[:, 0] = True
+    if row0 + z.shape[0] == height:
+        mask[-1] = True
+    if col0 + z.shape[1] == width:
+        mask[:, -1] = True
+    mask &= labels > 0
+    rows, cols = np.nonzero(mask)
+    return reduce_edges(labels[mask], np.zeros(len(rows), dtype=labels.dtype),
+                        z[mask].astype(ACCUMULATOR_DTYPE),
+                        (rows + row0).astype(np.int64) * width + cols + col0)
+
+
+def _concat_edges(edges):
+    if not edges:
+        return _empty_edges()
+    return tuple(np.concatenate([edge[i] for edge in edges]) for i in range(4))
+
+
+def spill_levels(n_nodes, low, high, height):
+    """
+    Spill level of every basin: the lowest level at which water gets from
+    it to the outside (node 0), i.e. the highest saddle on the best path
+    out, which is what a priority flood from the outside assigns. That
+    path runs along the minimum spanning tree of the basin graph, so the
+    tree is built in compiled code and the levels propagated down it by
+    pointer doubling. Edges must come from reduce_edges. Returns (level,
+    parent, via): the level, the next basin towards the outside and the
+    index of the edge to it.
+    """
+    level = np.full(n_nodes, np.inf)
+    parent = np.arange(n_nodes)
+    via = np.full(n_nodes, -1)
+    level[0] = -np.inf
+    if not len(low):
+        return level, parent, via
+
+    # csgraph drops zero weights, so heights are shifted to start at 1
+    weights = height - height.min() + 1
+    tree = minimum_spanning_tree(coo_matrix((weights, (low, high)), shape=(n_nodes, n_nodes)).tocsr())
+    order, predecessor = breadth_first_order(tree, 0, directed=False, return_predecessors=True)
+    children = order[1:]
+    parent[children] = predecessor[children]
+    # Edge of each tree link, looked up in the (low, high) sorted edge list
+    keys = (low.astype(np.int64) << 32) | high.astype(np.int64)
+    child_keys = ((np.minimum(children, parent[children]).astype(np.int64) << 32)
+                  | np.maximum(children, parent[children]))
+    via[children] = np.searchsorted(keys, child_keys)
+    level[children] = height[via[children]]
+
+    # Highest saddle on the way out: double the covered path each pass
+    ancestor = parent.copy()
+    while True:
+        np.maximum(level, level[ancestor], out=level)
+        jumped = ancestor[ancestor]
+        if np.array_equal(jumped, ancestor):
+            break
+        ancestor = jumped
+    return level, parent, via
+
+
+def _blocks(shape, block_size):
+    for row0 in range(0, shape[0], block_size):
+        for col0 in range(0, shape[1], block_size):
+            yield row0, col0, min(block_size, shape[0] - row0), min(block_size, shape[1] - col0)
+
+
+def flood_depressions(read, shape, transform, crs, block_size=DEFAULT_BLOCK_SIZE, min_depth=MIN_FILL_DEPTH,
+                      labels=None, write_labels=None):
+    """
+    Depressions of a raster read block by block through read(row0, col0,
+    rows, cols), which returns float elevations with NoData as NaN.
+    labels is the int32 basin label buffer (a memmap for large rasters);
+    write_labels(row0, col0, block) receives the depression labels.
+    """
+    start = time.perf_counter()
+    height, width = shape
+    block_size = block_size or DEFAULT_BLOCK_SIZE
+    if labels is None:
+        labels = np.zeros(shape, dtype=np.int32)
+
+    # Pass 1: basins per block, their saddles inside blocks and over the edge
+    edges = []
+    pit_elevations = [np.zeros(1)]
+    offset = 0
+    blocks = list(_blocks(shape, block_size))
+    for row0, col0, rows, cols in blocks:
+        z = read(row0, col0, rows, cols)
+        block_labels, block_pits = descent_basins(z)
+        block_labels = np.where(block_labels > 0, block_labels + offset, 0).astype(np.int32)
+        labels[row0:row0 + rows, col0:col0 + cols] = block_labels
+        pit_elevations.append(block_pits[1:])
+        offset += len(block_pits) - 1
+        edges.append(neighbour_edges(z, block_labels, row0, col0, width))
+        edges.append(border_edges(z, block_labels, row0, col0, shape))
+
+    # Seams between blocks: two-pixel strips, pairs that cross the seam only
+    for seam in range(block_size, height, block_size):
+        for col0 in range(0, width, block_size):
+            cols = min(block_size + 1, width - col0)
+            z = read(seam - 1, col0, 2, cols)
+            edges.append(neighbour_edges(z, labels[seam - 1:seam + 1, col0:col0 + cols],
+                                         seam - 1, col0, width, offsets=((1, -1), (1, 0), (1, 1))))
+    for seam in range(block_size, width, block_size):
+        for row0 in range(0, height, block_size):
+            rows = min(block_size + 1, height - row0)
+            z = read(row0, seam - 1, rows, 2)
+            edges.append(neighbour_edges(z, labels[row0:row0 + rows, seam - 1:seam + 1],
+                                         row0, seam - 1, width, offsets=((0, 1), (1, 1), (1, -1))))
+
+    low, high, saddle, saddle_pixel = reduce_edges(*_concat_edges(edges))
+    del edges
+    pit_elevations = np.concatenate(pit_elevations)
+    n_nodes = len(pit_elevations)
+    level, parent, via = spill_levels(n_nodes, low, high, saddle)
+    # A basin the flood never reached (cut off by NoData) holds no water
+    unreached = np.isinf(level)
+    level[unreached] = pit_elevations[unreached]
+    level[0] = -np.inf
+
+    # Depressions: flooded basins at one level that connect below it
+    flooded = level > pit_elevations
+    flooded[0] = False
+    joined = flooded[low] & flooded[high] & (level[low] == level[high]) & (saddle < level[low])
+    graph = coo_matrix((np.ones(np.count_nonzero(joined)), (low[joined], high[joined])),
+                       shape=(n_nodes, n_nodes))
+    _, component = connected_components(graph, directed=False)
+    depression_of = np.zeros(n_nodes, dtype=np.int64)
+    _, depression_of[flooded] = np.unique(component[flooded], return_inverse=True)
+    depression_of[flooded] += 1
+    n_depressions = int(depression_of.max()) if n_nodes else 0
+
+    # Deepest fill per depression decides whether it is reported
+    bottom = np.full(n_depressions + 1, np.inf)
+    np.minimum.at(bottom, depression_of[flooded], pit_elevations[flooded])
+    spill = np.zeros(n_depressions + 1)
+    spill[depression_of[flooded]] = level[flooded]
+    reported = spill - bottom >= min_depth
+    reported[0] = True
+    renumber = np.cumsum(reported) - 1
+    renumber[~reported] = 0
+    depression_of = renumber[depression_of]
+    bottom, spill = bottom[reported], spill[reported]
+    n_depressions = len(spill) - 1
+
+    # Outlet: where the flood entered the depression from outside it
+    outlet_pixel = np.full(n_depressions + 1, -1, dtype=np.int64)
+    entry = np.flatnonzero((depression_of > 0) & (depression_of[parent] != depression_of)
+                           & (via >= 0))
+    outlet_pixel[depression_of[entry]] = saddle_pixel[via[entry]]
+
+    # Pass 2: fill depth per pixel, summed per basin then per depression
+    areas = np.broadcast_to(pixel_area_m2(transform, crs, height), (height,))
+    basin_pixels = np.zeros(n_nodes)
+    basin_area = np.zeros(n_nodes)
+    basin_volume = np.zeros(n_nodes)
+    for row0, col0, rows, cols in blocks:
+        z = read(row0, col0, rows, cols)
+        block_labels = labels[row0:row0 + rows, col0:col0 + cols]
+        fill = level[block_labels] - z
+        wet = fill > 0  # False on NoData
+        wet_labels = block_labels[wet]
+        row_area = np.broadcast_to(areas[row0:row0 + rows, None], z.shape)[wet]
+        basin_pixels += np.bincount(wet_labels, minlength=n_nodes)
+        basin_area += np.bincount(wet_labels, weights=row_area, minlength=n_nodes)
+        basin_volume += np.bincount(wet_labels, weights=fill[wet] * row_area, minlength=n_nodes)
+        if write_labels is not None:
+            write_labels(row0, col0, np.where(wet, depression_of[block_labels], 0).astype(np.int32))
+
+    pixels = np.bincount(depression_of, weights=basin_pixels, minlength=n_depressions + 1)
+    area = np.bincount(depression_of, weights=basin_area, minlength=n_depressions + 1)
+    volume = np.bincount(depression_of, weights=basin_volume, minlength=n_depressions + 1)
+
+    outlet_rows, outlet_cols = np.divmod(outlet_pixel, width)
+    outlet_x = transform[2] + (outlet_cols + 0.5) * transform[0] + (outlet_rows + 0.5) * transform[1]
+    outlet_y = transform[5] + (outlet_cols + 0.5) * transform[3] + (outlet_rows + 0.5) * transform[4]
+    if crs is not None and not is_geographic(crs) and n_depressions:
+        outlet_x, outlet_y = transform_points(crs, "EPSG:4326", outlet_x, outlet_y)
+
+    depressions = []
+    for depression in np.argsort(-volume[1:])[:MAX_REPORTED_DEPRESSIONS] + 1:
+        outlet = None
+        if outlet_pixel[depression] >= 0:
+            outlet = {"lng": float(outlet_x[depression]), "lat": float(outlet_y[depression]),
+                      "row": int(outlet_rows[depression]), "col": int(outlet_cols[depression])}
+        depressions.append({
+            "id": int(depression),
+            "spill_elevation": float(spill[depression]),
+            "bottom_elevation": float(bottom[depression]),
+            "max_fill_depth_m": float(spill[depression] - bottom[depression]),
+            "mean_fill_depth_m": float(volume[depression] / area[depression]) if area[depression] else 0.0,
+            "area_m2": float(area[depression]),
+            "volume_m3": float(volume[depression]),
+            "pixels": int(pixels[depression]),
+            "outlet": outlet,
+        })
+
+    seconds = time.perf_counter() - start
+    print(f"💧 Priority flood: {n_nodes - 1} basins, {n_depressions} depressions "
+          f"({float(volume[1:].sum()):.0f} m³) in {seconds:.2f} s")
+    return {
+        "depressions": depressions,
+        "depression_count": n_depressions,
+        "total_volume_m3": float(volume[1:].sum()),
+        "total_area_m2": float(area[1:].sum()),
+        "basins": n_nodes - 1,
+        "blocks": len(blocks),
+        "block_size": block_size,
+        "min_depth_m": min_depth,
+        "seconds": round(seconds, 3),
+    }
+
+
+def depressions_from_array(dem_data, transform, crs, min_depth=MIN_FILL_DEPTH):
+    """Depressions of an elevation array already in memory (NoData as NaN)"""
+    def read(row0, col0, rows, cols):
+        return dem_data[row0:row0 + rows, col0:col0 + cols]
+
+    return flood_depressions(read, dem_data.shape, transform, crs, min_depth=min_depth)
+
+
+def _flood_file(dem_file, block_size=DEFAULT_BLOCK_SIZE, min_depth=MIN_FILL_DEPTH, labels_path=None):
+    with rasterio.open(dem_file) as src:
+        shape = (src.height, src.width)
+
+        def read(row0, col0, rows, cols):
+            return read_elevation(src, window=Window(col0, row0, cols, rows))
+
+        output = None
+        if labels_path:
+            profile = src.profile.copy()
+            profile.update(driver="GTiff", dtype="int32", count=1, nodata=0, compress="deflate",
+                           tiled=True, blockxsize=256, blockysize=256, BIGTIFF="IF_SAFER")
+            output = rasterio.open(labels_path, "w", **profile)
+
+        def write_labels(row0, col0, block):
+            output.write(block, 1, window=Window(col0, row0, block.shape[1], block.shape[0]))
+
+        with tempfile.TemporaryDirectory(prefix="qdf_flood_") as tmp_dir:
+            labels = None
+            if src.width * src.height > MAX_IN_MEMORY_PIXELS:
+                labels = np.lib.format.open_memmap(os.path.join(tmp_dir, "basins.npy"), mode="w+",
+                                                   dtype=np.int32, shape=shape)
+            try:
+                result = flood_depressions(read, shape, src.transform, src.crs, block_size, min_depth,
+                                           labels, write_labels if output else None)
+            finally:
+                if output is not None:
+                    output.close()
+                del labels
+        if labels_path:
+            result["labels_path"] = labels_path
+        return result
+
+
+@memoize_analysis("depressions")
+def analyze_depressions(dem_file, block_size=DEFAULT_BLOCK_SIZE, min_depth=MIN_FILL_DEPTH):
+    """Depressions of a DEM file: spill level, fill depth, ponded volume and outlet"""
+    return _flood_file(dem_file, block_size, min_depth)
+
+
+def label_depressions(dem_file, labels_path, block_size=DEFAULT_BLOCK_SIZE, min_depth=MIN_FILL_DEPTH):
+    """analyze_depressions, also writing an int32 GeoTIFF of depression ids (0 = dry)"""
+    return _flood_file(dem_file, block_size, min_depth, labels_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pit lake spill levels and ponded volumes of a DEM")
+    parser.add_argument("dem")
+    parser.add_argument("--labels", help="write depression ids to this GeoTIFF")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE,
+                        help="pixels per block side (default %(default)s)")
+    parser.add_argument("--min-depth", type=float, default=MIN_FILL_DEPTH)
+    args = parser.parse_args(argv)
+
+    if args.labels:
+        result = label_depressions(args.dem, args.labels, args.block_size, args.min_depth)
+    else:
+        result = analyze_depressions.uncached(args.dem, args.block_size, args.min_depth)
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,6 +9,20 @@ def createApp():
     app.config["MONGO_URI"] = os.environ.get("MONGO_URI", "mongodb://localhost:27017/QuarryDepthFinder")
     mongo = PyMongo(app)
     app.secret_key = "vanakam"
+    # Opt-in request profiling (?profile=1 or X-Profile: 1), off by default
+    app.config["PROFILING_ENABLED"] = os.environ.get("QDF_PROFILING") == "1"
+    app.config["PROFILING_TOKEN"] = os.environ.get("QDF_PROFILING_TOKEN")
+    app.config["PROFILING_KEEP"] = int(os.environ.get("QDF_PROFILING_KEEP", 5))
+    # DEM uploads larger than this are refused while streaming (default 2GB)
+    if os.environ.get("MAX_FILE_SIZE"):
+        app.config["MAX_UPLOAD_BYTES"] = int(os.environ["MAX_FILE_SIZE"])
+
+    try:
+        from metrics import init_metrics
+        init_metrics(app)
+        print("✅ Metrics enabled at /metrics")
+    except Exception as e:
+        print(f"❌ Metrics error: {e}")
 
     try:
         from routes import callRoutes
@@ -43,6 +57,25 @@ def createApp():
     except Exception as e:
         print(f"❌ Test routes error: {e}")
 
+    try:
+        from tile_server import create_tile_routes
+        tiles_bp = create_tile_routes(app)
+        if tiles_bp:
+            app.register_blueprint(tiles_bp)
+            print("✅ Map tile routes enabled!")
+        else:
+            print("❌ Map tile routes failed to initialize")
+    except Exception as e:
+        print(f"❌ Map tile routes error: {e}")
+
+    try:
+        from profiling import create_profiling_routes
+        app.register_blueprint(create_profiling_routes(app))
+        if app.config["PROFILING_ENABLED"]:
+            print("✅ Request profiling enabled!")
+    except Exception as e:
+        print(f"❌ Profiling routes error: {e}")
+
 
 
     return app
@@ -0,0 +1,240 @@
+import bisect
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from cached tile hits up to full DEM pipelines
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = (1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+PIXEL_BUCKETS = (1e4, 1e5, 1e6, 1e7, 1e8, 4e8)
+# Requests slower than this are logged even when they ran no pipeline stage
+SLOW_REQUEST_SECONDS = 1.0
+
+
+class Metric:
+    """A labelled metric family rendered in the Prometheus text format"""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.label_names, key)) + (extra or [])
+        if not pairs:
+            return ""
+        escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                   for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{self._format_labels(key)} {value:g}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', le)])} {cumulative}")
+                lines.append(f"{self.name}_sum{self._format_labels(key)} {total:g}")
+                lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+
+REGISTRY = []
+_collectors = []
+
+
+def _register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+STAGE_SECONDS = _register(Histogram(
+    "qdf_stage_seconds", "Latency of DEM pipeline stages", ["stage"]))
+STAGES_IN_FLIGHT = _register(Gauge(
+    "qdf_stage_in_flight", "Pipeline stages currently running", ["stage"]))
+REQUEST_SECONDS = _register(Histogram(
+    "qdf_http_request_seconds", "HTTP request latency", ["endpoint", "method", "status"]))
+REQUESTS_IN_FLIGHT = _register(Gauge(
+    "qdf_http_requests_in_flight", "HTTP requests currently being served"))
+DOWNLOAD_BYTES = _register(Histogram(
+    "qdf_download_bytes", "Size of downloaded DEM files", ["source"], BYTES_BUCKETS))
+RASTER_PIXELS = _register(Histogram(
+    "qdf_raster_pixels", "Pixels processed per raster stage", ["stage"], PIXEL_BUCKETS))
+CACHE_REQUESTS = _register(Counter(
+    "qdf_cache_requests_total", "Cache lookups by result", ["cache", "result"]))
+CACHE_HIT_RATIO = _register(Gauge(
+    "qdf_cache_hit_ratio", "Cache hit ratio since start", ["cache"]))
+
+
+def register_collector(callback):
+    """Call `callback()` before every scrape, e.g. to copy a cache's own counters into gauges"""
+    _collectors.append(callback)
+    return callback
+
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def _update_hit_ratios():
+    totals = {}
+    with CACHE_REQUESTS.lock:
+        for (cache, result), count in CACHE_REQUESTS.values.items():
+            hits, lookups = totals.get(cache, (0, 0))
+            totals[cache] = (hits + (count if result == "hit" else 0), lookups + count)
+    for cache, (hits, lookups) in totals.items():
+        CACHE_HIT_RATIO.set(hits / lookups if lookups else 0.0, cache=cache)
+
+
+def render_metrics():
+    for callback in _collectors:
+        try:
+            callback()
+        except Exception as e:
+            print(f"⚠️ Metrics collector error: {e}")
+    _update_hit_ratios()
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def stage(name, pixels=None):
+    """
+    Time one pipeline stage: records the latency histogram and in-flight
+    gauge, and adds the duration to the current request's timing log
+    """
+    STAGES_IN_FLIGHT.inc(stage=name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGES_IN_FLIGHT.dec(stage=name)
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        if pixels is not None:
+            RASTER_PIXELS.observe(pixels, stage=name)
+        _add_request_timing(name, elapsed)
+
+
+def _add_request_timing(name, elapsed):
+    from flask import g, has_request_context
+
+    if has_request_context() and "stage_timings" in g:
+        g.stage_timings[name] = round(g.stage_timings.get(name, 0.0) + elapsed * 1000, 2)
+
+
+def current_request_id():
+    from flask import g, has_request_context
+
+    if has_request_context():
+        return g.get("request_id")
+    return None
+
+
+def init_metrics(app):
+    """Request ids, per-request timing logs and the /metrics endpoint"""
+    from flask import Response, g, request
+
+    @app.before_request
+    def start_request_timer():
+        g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+        g.request_start = time.perf_counter()
+        g.stage_timings = {}
+        REQUESTS_IN_FLIGHT.inc()
+
+    @app.after_request
+    def record_request(response):
+        if "request_start" not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_start
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, method=request.method,
+                                status=response.status_code)
+        response.headers["X-Request-ID"] = g.request_id
+
+        if g.stage_timings or elapsed > SLOW_REQUEST_SECONDS:
+            print("⏱️ " + json.dumps({
+                "request_id": g.request_id,
+                "method": request.method,
+                "endpoint": endpoint,
+                "status": response.status_code,
+                "ms": round(elapsed * 1000, 2),
+                "stages": g.stage_timings,
+            }, separators=(",", ":")))
+        return response
+
+    @app.teardown_request
+    def finish_request(exc):
+        if g.pop("request_start", None) is not None:
+            REQUESTS_IN_FLIGHT.dec()
+
+    @app.route("/metrics")
+    def metrics():
+        """Prometheus scrape endpoint"""
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+    return app
@@ -0,0 +1,240 @@
+"""
+Fraction of every pixel covered by a site boundary polygon.
+
+A binary mask counts each pixel whole or not at all, so on 30 m COP30
+pixels a small quarry's area and volume swing by 10-20% with how the
+polygon meets the grid. Here pixels whose centre is inside and that no
+edge crosses weigh 1, exactly as in a binary mask; only the band of
+pixels an edge crosses is supersampled, its sample points tested
+against the nearby edges in vectorised calls. The extra work scales
+with the perimeter, so large polygons cost about the same as a binary
+mask.
+"""
+import numpy as np
+from affine import Affine
+from rasterio import features
+
+from geodesy import transform_points
+from precision import ACCUMULATOR_DTYPE
+
+# Boundary pixels are sampled at SUPERSAMPLE² points of a rank-1 lattice:
+# unlike a square grid every point has its own x and y offset, so edges
+# along the grid axes are resolved to 1/256 of a pixel instead of 1/16
+# (within 0.2% of the exact area on polygons of a few pixels)
+SUPERSAMPLE = 16
+LATTICE_GENERATOR = 117
+# Boundary pixels are tested tile by tile against the edges near the tile
+COVERAGE_TILE = 16
+# Pixel × sample × edge tests per vectorised call, which bounds the
+# temporaries however densely the outline is digitised
+CROSSING_BATCH = 1 << 18
+
+
+def boundary_polygons(boundary):
+    """
+    Polygons of a boundary as lists of (lng, lat) rings: Leaflet
+    [{'lat', 'lng'}, ...] coordinates or a GeoJSON Polygon/MultiPolygon
+    """
+    if isinstance(boundary, dict):
+        if boundary.get("type") == "Polygon":
+            return [boundary["coordinates"]]
+        if boundary.get("type") == "MultiPolygon":
+            return boundary["coordinates"]
+        raise ValueError(f"Unsupported boundary geometry {boundary.get('type')!r}")
+    ring = [(float(point["lng"]), float(point["lat"])) for point in boundary]
+    return [[ring]]
+
+
+class PixelCoverage:
+    """
+    Coverage of a raster grid by a polygon: `covered` marks every pixel
+    with any part inside, and the boundary band (flat indices, sorted)
+    carries the fractional weights; every other covered pixel weighs 1.
+    """
+
+    def __init__(self, covered, band_index, band_fraction):
+        self.covered = covered
+        self.shape = covered.shape
+        self.band_index = band_index
+        self.band_fraction = band_fraction
+
+    def _band_areas(self, pixel_area, index):
+        if np.ndim(pixel_area) == 0:
+            return pixel_area
+        return pixel_area[index // self.shape[1]]
+
+    def corrections(self, data, where, pixel_area):
+        """
+        What fractional weights change in the (data sum, area, data x area
+        sum) over the where pixels, compared with counting them whole
+        """
+        selected = where.reshape(-1)[self.band_index]
+        index = self.band_index[selected]
+        if not len(index):
+            return 0.0, 0.0, 0.0
+        weight = self.band_fraction[selected] - 1
+        values = data.reshape(-1)[index].astype(ACCUMULATOR_DTYPE)
+        areas = weight * self._band_areas(pixel_area, index)
+        return float(weight @ values), float(np.sum(areas)), float(areas @ values)
+
+    def weight_sum(self, where):
+        """Pixels in where, counting boundary pixels by their fractions"""
+        selected = where.reshape(-1)[self.band_index]
+        return float(np.count_nonzero(where) + np.sum(self.band_fraction[selected] - 1))
+
+    def covered_area(self, pixel_area):
+        """Polygon area on the grid in m², fractions included"""
+        if np.ndim(pixel_area) == 0:
+            area = np.count_nonzero(self.covered) * pixel_area
+        else:
+            area = np.count_nonzero(self.covered, axis=1) @ pixel_area
+        correction = (self.band_fraction - 1) * self._band_areas(pixel_area, self.band_index)
+        return float(area + np.sum(correction))
+
+    def weight_rows(self, block, start_row):
+        """Scale band pixels of a block of rows (starting at start_row) by their fractions, in place"""
+        width = self.shape[1]
+        first, last = np.searchsorted(self.band_index, [start_row * width, (start_row + len(block)) * width])
+        index = self.band_index[first:last] - start_row * width
+        flat = block.reshape(-1)
+        flat[index] *= self.band_fraction[first:last].astype(block.dtype)
+        return block
+
+    def weighted_median(self, data, where):
+        """
+        Median of data over the where pixels, boundary pixels weighted by
+        their fractions. The fractions can only move the median up by the
+        weight they drop, so a partition around the unweighted median and
+        a walk over those few order statistics replace a full sort.
+        """
+        values = data[where]
+        selected = where.reshape(-1)[self.band_index]
+        band_values = data.reshape(-1)[self.band_index[selected]]
+        order = np.argsort(band_values, kind="stable")
+        band_values = band_values[order]
+        band_deficit = np.cumsum(1 - self.band_fraction[selected][order])
+        deficit = band_deficit[-1] if len(band_deficit) else 0.0
+
+        half = (len(values) - deficit) / 2
+        low = int(np.clip(np.floor(half) - 1, 0, len(values) - 1))
+        high = int(np.clip(np.ceil(half + deficit) + 1, 0, len(values) - 1))
+        values.partition([low, high])
+        candidates = np.sort(values[low:high + 1])
+        # Weight at or below each candidate: its rank less the fractions dropped
+        ranks = low + 1 + np.arange(len(candidates))
+        dropped = np.r_[0.0, band_deficit][np.searchsorted(band_values, candidates, side="right")]
+        reached = np.flatnonzero(ranks - dropped >= half)
+        return candidates[reached[0]] if len(reached) else candidates[-1]
+
+    def summary(self, pixel_area):
+        return {
+            "covered_pixels": int(np.count_nonzero(self.covered)),
+            "boundary_pixels": len(self.band_index),
+            "polygon_area_m2": self.covered_area(pixel_area),
+        }
+
+
+def _crosses(ax, ay, bx, by, cx, cy, dx, dy):
+    # Segments a-b and c-d properly intersect (touching cases have zero measure)
+    def orientation(px, py, qx, qy, rx, ry):
+        return np.sign((qx - px) * (ry - py) - (qy - py) * (rx - px))
+
+    return ((orientation(ax, ay, bx, by, cx, cy) != orientation(ax, ay, bx, by, dx, dy))
+            & (orientation(cx, cy, dx, dy, ax, ay) != orientation(cx, cy, dx, dy, bx, by)))
+
+
+def _band_fractions(edges, band_index, centre_inside, width, supersample):
+    """
+    Covered fraction of each boundary pixel from supersample² points. A
+    point is inside when its pixel centre is (known from the rasterised
+    mask) and an even number of edges cross the centre-to-point segment;
+    that segment stays inside the pixel, so only the edges near the pixel
+    are tested, tile by tile and in batches of at most CROSSING_BATCH tests.
+    """
+    samples = supersample ** 2
+    lattice = np.arange(samples)
+    sub_x = (lattice + 0.5) / samples - 0.5
+    sub_y = ((lattice * LATTICE_GENERATOR) % samples + 0.5) / samples - 0.5
+    rows, cols = np.divmod(band_index, width)
+    tiles = (rows // COVERAGE_TILE) * (width // COVERAGE_TILE + 1) + cols // COVERAGE_TILE
+    order = np.argsort(tiles, kind="stable")
+    starts = np.flatnonzero(np.r_[True, np.diff(tiles[order]) != 0])
+    edge_min_x = np.minimum(edges[:, 0], edges[:, 2])
+    edge_max_x = np.maximum(edges[:, 0], edges[:, 2])
+    edge_min_y = np.minimum(edges[:, 1], edges[:, 3])
+    edge_max_y = np.maximum(edges[:, 1], edges[:, 3])
+
+    fractions = np.empty(len(band_index))
+    for start, stop in zip(starts, np.r_[starts[1:], len(order)]):
+        members = order[start:stop]
+        row0 = rows[members[0]] // COVERAGE_TILE * COVERAGE_TILE
+        col0 = cols[members[0]] // COVERAGE_TILE * COVERAGE_TILE
+        near = ((edge_max_x >= col0) & (edge_min_x <= col0 + COVERAGE_TILE)
+                & (edge_max_y >= row0) & (edge_min_y <= row0 + COVERAGE_TILE))
+        local = edges[near]
+        edge_step = max(1, CROSSING_BATCH // samples)
+        member_step = max(1, CROSSING_BATCH // (samples * max(1, min(len(local), edge_step))))
+        for first in range(0, len(members), member_step):
+            batch = members[first:first + member_step]
+            centre_x = (cols[batch] + 0.5)[:, None, None]
+            centre_y = (rows[batch] + 0.5)[:, None, None]
+            point_x = centre_x + sub_x[None, :, None]
+            point_y = centre_y + sub_y[None, :, None]
+            crossings = np.zeros((len(batch), samples), dtype=np.int64)
+            for edge in range(0, len(local), edge_step):
+                part = local[edge:edge + edge_step]
+                crossings += np.count_nonzero(
+                    _crosses(centre_x, centre_y, point_x, point_y,
+                             part[:, 0], part[:, 1], part[:, 2], part[:, 3]), axis=2)
+            inside = (crossings % 2 == 1) != centre_inside[batch][:, None]
+            fractions[batch] = inside.mean(axis=1)
+    return fractions
+
+
+def pixel_coverage(boundary, transform, crs, shape, supersample=SUPERSAMPLE):
+    """
+    PixelCoverage of a raster grid by a boundary in EPSG:4326 (Leaflet
+    coordinates or GeoJSON), or None when the boundary has no area
+    """
+    to_pixels = ~transform
+    polygons = []
+    for polygon in boundary_polygons(boundary):
+        rings = []
+        for ring in polygon:
+            ring = np.asarray(ring, dtype=np.float64)[:, :2]
+            if len(ring) < 3:
+                continue
+            if not np.array_equal(ring[0], ring[-1]):
+                ring = np.vstack([ring, ring[:1]])  # Leaflet rings are open
+            xs, ys = ring[:, 0], ring[:, 1]
+            if crs is not None:
+                xs, ys = transform_points("EPSG:4326", crs, xs, ys)
+            cols, rows = to_pixels * (xs, ys)
+            rings.append(np.column_stack([cols, rows]))
+        if rings:
+            polygons.append(rings)
+    if not polygons:
+        return None
+
+    # Everything below works in pixel space: (col, row), pixel (0, 0)
+    # spans [0, 1) x [0, 1)
+    identity = Affine.identity()
+    geometries = [{"type": "Polygon", "coordinates": [ring.tolist() for ring in rings]}
+                  for rings in polygons]
+    covered = features.rasterize(((geometry, 1) for geometry in geometries), out_shape=shape,
+                                 transform=identity, dtype="uint8").astype(bool)
+    lines = [{"type": "LineString", "coordinates": ring.tolist()}
+             for rings in polygons for ring in rings]
+    band = features.rasterize(((line, 1) for line in lines), out_shape=shape,
+                              transform=identity, all_touched=True, dtype="uint8")
+    band_index = np.flatnonzero(band)
+    del band
+
+    edges = np.concatenate([np.column_stack([ring[:-1], ring[1:]])
+                            for rings in polygons for ring in rings])
+    centre_inside = covered.reshape(-1)[band_index]
+    band_fraction = _band_fractions(edges, band_index, centre_inside, shape[1], supersample)
+
+    covered.reshape(-1)[band_index] = band_fraction > 0
+    keep = band_fraction > 0
+    return PixelCoverage(covered, band_index[keep], band_fraction[keep])
@@ -0,0 +1,70 @@
+"""
+Numeric precision of the analysis stack.
+
+Elevation rasters are read straight into ANALYSIS_DTYPE (float32 unless
+QDF_PRECISION=float64) and depth and slope arrays stay in it, which halves
+their memory; DEM sources are float32 or integer, so nothing is lost.
+Sums, means and volumes accumulate in ACCUMULATOR_DTYPE so totals over
+millions of pixels do not drift.
+"""
+import os
+
+import numpy as np
+
+PRECISION_MODES = ("float32", "float64")
+ACCUMULATOR_DTYPE = np.dtype(np.float64)
+
+_mode = os.environ.get("QDF_PRECISION", "float32")
+if _mode not in PRECISION_MODES:
+    print(f"⚠️ Unknown QDF_PRECISION {_mode!r}, using float32 (choose from {PRECISION_MODES})")
+    _mode = "float32"
+ANALYSIS_DTYPE = np.dtype(_mode)
+
+
+def read_elevation(src, band=1, dtype=None, **kwargs):
+    """
+    Band of an open rasterio dataset as a float array with NoData set to
+    NaN. GDAL converts to the working dtype during the read, so no
+    second full-size copy is made; kwargs (window, out_shape,
+    resampling) are passed to src.read.
+    """
+    dtype = np.dtype(dtype or ANALYSIS_DTYPE)
+    data = src.read(band, out_dtype=dtype, **kwargs)
+    nodata = src.nodata
+    if nodata is not None and not np.isnan(nodata):
+        data[data == dtype.type(nodata)] = np.nan
+    return data
+
+
+def as_working(value, like):
+    """A scalar in the dtype of the array it is combined with (numpy keeps
+    float64 scalars float64, which would upcast the whole result)"""
+    return like.dtype.type(value)
+
+
+def total(data, where=None):
+    """Sum accumulated in ACCUMULATOR_DTYPE, over the where mask only"""
+    return np.sum(data, where=True if where is None else where, dtype=ACCUMULATOR_DTYPE)
+
+
+def depth_totals(depth, where, pixel_area, coverage=None):
+    """
+    (pixels, depth sum, area, volume) over the where pixels of a depth
+    map. pixel_area is a float, or one area per row for geographic
+    rasters (geodesy.pixel_area_m2), in which case rows are weighted.
+    With a pixel_coverage.PixelCoverage, boundary pixels count by the fraction
+    inside the polygon (depth outside it is expected to be NaN already).
+    """
+    if np.ndim(pixel_area) == 0:
+        pixels = np.count_nonzero(where)
+        depth_sum = total(depth, where)
+        area, volume = pixels * pixel_area, depth_sum * pixel_area
+    else:
+        row_pixels = np.count_nonzero(where, axis=1)
+        row_sums = np.sum(depth, axis=1, where=where, dtype=ACCUMULATOR_DTYPE)
+        pixels, depth_sum = int(row_pixels.sum()), row_sums.sum()
+        area, volume = row_pixels @ pixel_area, row_sums @ pixel_area
+    if coverage is not None:
+        sum_change, area_change, volume_change = coverage.corrections(depth, where, pixel_area)
+        depth_sum, area, volume = depth_sum + sum_change, area + area_change, volume + volume_change
+    return pixels, depth_sum, area, volume
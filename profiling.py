@@ -0,0 +1,241 @@
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+
+from flask import Blueprint, Response, current_app, g, jsonify, request
+
+SAMPLE_INTERVAL = 0.005
+# Slowest profiles kept per endpoint
+KEEP_PER_ENDPOINT = 5
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class StackSampler:
+    """
+    Samples one thread's Python stack from a background thread at a fixed
+    interval. Unlike cProfile this keeps whole call stacks (needed for flame
+    graphs) and costs the profiled thread almost nothing.
+    """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.started
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+
+def _frame_name(frame):
+    name, filename, line = frame
+    if filename.startswith(REPO_DIR):
+        filename = os.path.relpath(filename, REPO_DIR)
+    else:
+        filename = os.path.basename(filename)
+    return f"{name} ({filename}:{line})"
+
+
+def to_collapsed(stacks):
+    """Brendan Gregg collapsed-stack text: 'root;child;leaf count' per line"""
+    return "\n".join(
+        ";".join(_frame_name(frame) for frame in stack) + f" {count}"
+        for stack, count in stacks.most_common()
+    ) + "\n"
+
+
+def to_speedscope(stacks, name, interval, duration):
+    """Speedscope 'sampled' profile, one sample per distinct stack weighted by its time"""
+    frames, frame_index = [], {}
+    samples, weights = [], []
+    for stack, count in stacks.most_common():
+        indices = []
+        for frame in stack:
+            if frame not in frame_index:
+                frame_index[frame] = len(frames)
+                frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+            indices.append(frame_index[frame])
+        samples.append(indices)
+        weights.append(count * interval)
+
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": "QuarryDepthFinder",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "seconds",
+            "startValue": 0,
+            "endValue": max(duration, sum(weights)),
+            "samples": samples,
+            "weights": weights,
+        }],
+    }
+
+
+class ProfileStore:
+    """Keeps the N slowest profiles per endpoint (a min-heap on duration)"""
+
+    def __init__(self, keep=KEEP_PER_ENDPOINT):
+        self.keep = keep
+        self.by_endpoint = {}
+        self.profiles = {}
+        self.lock = threading.Lock()
+
+    def add(self, profile):
+        with self.lock:
+            heap = self.by_endpoint.setdefault(profile["endpoint"], [])
+            entry = (profile["duration_ms"], profile["id"])
+            if len(heap) < self.keep:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                _, evicted = heapq.heapreplace(heap, entry)
+                self.profiles.pop(evicted, None)
+            else:
+                return False
+            self.profiles[profile["id"]] = profile
+            return True
+
+    def get(self, profile_id):
+        with self.lock:
+            return self.profiles.get(profile_id)
+
+    def summary(self):
+        with self.lock:
+            return {
+                endpoint: [
+                    {key: self.profiles[profile_id][key]
+                     for key in ("id", "request_id", "path", "method", "status", "duration_ms", "samples", "timestamp")}
+                    for _, profile_id in sorted(heap, reverse=True)
+                ]
+                for endpoint, heap in self.by_endpoint.items()
+            }
+
+
+profile_store = ProfileStore()
+
+
+def profiling_authorized():
+    """Profiling is enabled in config and, with PROFILING_TOKEN set, the request carries it"""
+    if not current_app.config.get("PROFILING_ENABLED"):
+        return False
+    token = current_app.config.get("PROFILING_TOKEN")
+    return not token or request.headers.get("X-Profile-Token") == token
+
+
+def profiling_requested():
+    """Profiling runs only when authorized and asked for by ?profile=1 or X-Profile: 1"""
+    if not profiling_authorized():
+        return False
+    return request.args.get("profile") == "1" or request.headers.get("X-Profile") == "1"
+
+
+def enable_profiling(blueprint):
+    """Attach the opt-in profiling hooks to a blueprint's routes"""
+
+    @blueprint.before_request
+    def start_profiler():
+        if profiling_requested():
+            g.profiler = StackSampler(threading.get_ident(),
+                                      current_app.config.get("PROFILING_INTERVAL", SAMPLE_INTERVAL)).start()
+
+    @blueprint.after_request
+    def stop_profiler(response):
+        sampler = g.pop("profiler", None)
+        if sampler is None:
+            return response
+        sampler.stop()
+
+        from metrics import current_request_id
+        # Request ids come from the client and may repeat; profile ids must not
+        profile_id = uuid.uuid4().hex[:16]
+        endpoint = request.url_rule.rule if request.url_rule else request.path
+        profile_store.keep = current_app.config.get("PROFILING_KEEP", KEEP_PER_ENDPOINT)
+        kept = profile_store.add({
+            "id": profile_id,
+            "request_id": current_request_id(),
+            "endpoint": endpoint,
+            "path": request.full_path,
+            "method": request.method,
+            "status": response.status_code,
+            "duration_ms": round(sampler.duration * 1000, 2),
+            "samples": sum(sampler.stacks.values()),
+            "interval": sampler.interval,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "stacks": sampler.stacks,
+        })
+
+        response.headers["X-Profile-Id"] = profile_id
+        if kept:
+            response.headers["X-Profile-Url"] = f"/api/profiles/{profile_id}?format=speedscope"
+        print(f"🔬 Profiled {request.method} {endpoint}: {sampler.duration * 1000:.0f} ms, "
+              f"{sum(sampler.stacks.values())} samples ({'kept' if kept else 'not among slowest'})")
+        return response
+
+    @blueprint.teardown_request
+    def discard_profiler(exc):
+        # after_request is skipped when the view raised
+        sampler = g.pop("profiler", None)
+        if sampler is not None:
+            sampler.stop()
+
+    return blueprint
+
+
+def create_profiling_routes(app):
+    profiling_bp = Blueprint("profiling", __name__)
+
+    @profiling_bp.route("/api/profiles")
+    def list_profiles():
+        """Slowest profiled requests per endpoint"""
+        if not profiling_authorized():
+            return jsonify({"status": "error", "message": "Profiling is disabled"}), 404
+        return jsonify({"status": "success", "profiles": profile_store.summary()})
+
+    @profiling_bp.route("/api/profiles/<profile_id>")
+    def get_profile(profile_id):
+        """One stored profile as speedscope JSON (default) or collapsed stacks"""
+        if not profiling_authorized():
+            return jsonify({"status": "error", "message": "Profiling is disabled"}), 404
+        profile = profile_store.get(profile_id)
+        if profile is None:
+            return jsonify({"status": "error", "message": "Profile not found"}), 404
+
+        if request.args.get("format") == "collapsed":
+            return Response(to_collapsed(profile["stacks"]), mimetype="text/plain")
+
+        name = f"{profile['method']} {profile['path']} ({profile['duration_ms']} ms)"
+        document = to_speedscope(profile["stacks"], name, profile["interval"], profile["duration_ms"] / 1000)
+        response = Response(json.dumps(document, separators=(",", ":")), mimetype="application/json")
+        response.headers["Content-Disposition"] = f'attachment; filename="{profile_id}.speedscope.json"'
+        return response
+
+    return profiling_bp
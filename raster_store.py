@@ -0,0 +1,260 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from metrics import record_cache
+
+RASTER_STORE_DIR = os.path.join("uploads", "store")
+MAX_RASTER_STORE_BYTES = 20 * 1024 * 1024 * 1024
+# Rasters used this recently are never evicted, so an analysis reading
+# one cannot lose its file halfway
+MIN_RETENTION_SECONDS = 3600
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def content_digest(data=b""):
+    """New hash object of the kind rasters are identified by everywhere:
+    store objects, result cache and artifact keys, analysis records"""
+    return hashlib.sha1(data)
+
+
+def raster_hash(dem_file):
+    """SHA-1 of the raster bytes, memoised on (path, size, mtime)"""
+    stat = os.stat(dem_file)
+    identity = (os.path.abspath(dem_file), stat.st_size, stat.st_mtime_ns)
+    with _hash_lock:
+        if identity in _hash_cache:
+            return _hash_cache[identity]
+
+    digest = content_digest()
+    with open(dem_file, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    with _hash_lock:
+        _hash_cache[identity] = digest.hexdigest()
+    return _hash_cache[identity]
+
+
+def remember_raster_hash(dem_file, digest):
+    """Record a hash computed elsewhere (e.g. while an upload streamed in)"""
+    stat = os.stat(dem_file)
+    with _hash_lock:
+        _hash_cache[(os.path.abspath(dem_file), stat.st_size, stat.st_mtime_ns)] = digest
+
+
+_hash_cache = {}
+_hash_lock = threading.Lock()
+
+
+class RasterStore:
+    """
+    Content-addressed store of uploaded and downloaded rasters. Each
+    raster is kept once under its SHA-1 (objects/<ab>/<sha1>.tif); a
+    JSON index records its size on disk (sidecars included), names,
+    sources and last use, plus aliases such as a DEM download request, so
+    a repeated upload or download resolves to the stored file. The index
+    keeps a running byte total; least recently used rasters are evicted
+    once it is over budget.
+    """
+
+    def __init__(self, root=RASTER_STORE_DIR, max_bytes=MAX_RASTER_STORE_BYTES,
+                 min_retention=MIN_RETENTION_SECONDS):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.tmp_dir = os.path.join(root, "tmp")
+        self.index_path = os.path.join(root, "index.json")
+        self.max_bytes = max_bytes
+        self.min_retention = min_retention
+        self.lock = threading.Lock()
+        self.index = None
+
+    def _load_index(self):
+        if self.index is not None:
+            return self.index
+        try:
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {"rasters": {}, "aliases": {}}
+        if "bytes" not in self.index:
+            # Index written before the running total: measure once
+            for digest, entry in self.index["rasters"].items():
+                entry["size"] = self._disk_size(digest)
+            self.index["bytes"] = sum(entry["size"] for entry in self.index["rasters"].values())
+        return self.index
+
+    def _save_index(self):
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f"{self.index_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f, separators=(",", ":"))
+        os.replace(tmp_path, self.index_path)
+
+    def path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], f"{digest}.tif")
+
+    def files(self, digest):
+        """The raster and the sidecars written next to it (overviews, tiled copy)"""
+        path = self.path(digest)
+        return [path, f"{path}.ovr", f"{os.path.splitext(path)[0]}.tiled.tif"]
+
+    def temp_path(self, name="raster"):
+        """A scratch path on the store's filesystem, so add_file is a rename"""
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        return os.path.join(self.tmp_dir, f"{name}.{threading.get_ident()}.{time.time_ns()}.part")
+
+    def get(self, digest):
+        """Path of the stored raster with this SHA-1, or None"""
+        with self.lock:
+            entry = self._load_index()["rasters"].get(digest)
+            path = self.path(digest)
+            if entry is None or not os.path.exists(path):
+                if entry is not None:
+                    self._forget(digest)
+                    self._save_index()
+                record_cache("raster_store", False)
+                return None
+            record_cache("raster_store", True)
+            self._touch(entry)
+        remember_raster_hash(path, digest)
+        return path
+
+    def _touch(self, entry):
+        # The index is rewritten at most once a minute per raster on reads
+        now = time.time()
+        if now - entry["last_used"] > 60:
+            entry["last_used"] = now
+            self._save_index()
+
+    def add_file(self, temp_path, digest, name=None, source=None, alias=None):
+        """
+        Move a fully written, already hashed file into the store. If the
+        content is stored already the new copy is discarded.
+        Returns (path, deduplicated).
+        """
+        path = self.path(digest)
+        size = os.path.getsize(temp_path)
+        with self.lock:
+            index = self._load_index()
+            deduplicated = digest in index["rasters"] and os.path.exists(path)
+            if deduplicated:
+                os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+
+            now = time.time()
+            entry = index["rasters"].get(digest)
+            if entry is None:
+                entry = index["rasters"][digest] = {
+                    "size": size, "names": [], "sources": [], "created": now, "uses": 0}
+                index["bytes"] += size
+            elif not deduplicated:
+                # Re-added after its file went missing (sidecars with it)
+                index["bytes"] += size - entry["size"]
+                entry["size"] = size
+            entry["last_used"] = now
+            entry["uses"] += 1
+            if name and name not in entry["names"]:
+                entry["names"] = (entry["names"] + [name])[-10:]
+            if source and source not in entry["sources"]:
+                entry["sources"].append(source)
+            if alias:
+                index["aliases"][alias] = digest
+            if index["bytes"] > self.max_bytes:
+                self._evict(keep=digest)
+            self._save_index()
+        record_cache("raster_store", deduplicated)
+        print(f"🗄️ {'Already stored' if deduplicated else 'Stored'} raster {digest[:12]} "
+              f"({size / 1e6:.1f} MB{', ' + name if name else ''})")
+        remember_raster_hash(path, digest)
+        return path, deduplicated
+
+    def refresh_size(self, path):
+        """
+        Re-measure a stored raster after sidecars (overviews, tiled copy)
+        were written next to it. Paths outside the store are ignored.
+        """
+        digest = os.path.splitext(os.path.basename(path))[0]
+        if os.path.abspath(path) != os.path.abspath(self.path(digest)):
+            return
+        with self.lock:
+            index = self._load_index()
+            entry = index["rasters"].get(digest)
+            if entry is None:
+                return
+            size = self._disk_size(digest)
+            index["bytes"] += size - entry["size"]
+            entry["size"] = size
+            if index["bytes"] > self.max_bytes:
+                self._evict(keep=digest)
+            self._save_index()
+
+    def put_bytes(self, payload, name=None, source=None, alias=None):
+        """Store an in-memory raster (e.g. a DEM download). Returns (path, digest)."""
+        digest = content_digest(payload).hexdigest()
+        temp_path = self.temp_path()
+        with open(temp_path, "wb") as f:
+            f.write(payload)
+        path, _ = self.add_file(temp_path, digest, name, source, alias)
+        return path, digest
+
+    def resolve(self, alias):
+        """Stored raster path for an alias (e.g. a download request key), or None"""
+        with self.lock:
+            digest = self._load_index()["aliases"].get(alias)
+        return self.get(digest) if digest else None
+
+    def _forget(self, digest):
+        entry = self.index["rasters"].pop(digest, None)
+        if entry is not None:
+            self.index["bytes"] -= entry["size"]
+        for alias in [a for a, d in self.index["aliases"].items() if d == digest]:
+            del self.index["aliases"][alias]
+        for file_path in self.files(digest):
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+    def _disk_size(self, digest):
+        total = 0
+        for file_path in self.files(digest):
+            try:
+                total += os.path.getsize(file_path)
+            except OSError:
+                pass
+        return total
+
+    def _evict(self, keep=None):
+        """Drop least recently used rasters (with their sidecars) over the byte budget"""
+        rasters = self.index["rasters"]
+        now = time.time()
+        for digest in sorted(rasters, key=lambda d: rasters[d]["last_used"]):
+            if self.index["bytes"] <= self.max_bytes:
+                break
+            if digest == keep or now - rasters[digest]["last_used"] < self.min_retention:
+                continue
+            size = rasters[digest]["size"]
+            self._forget(digest)
+            print(f"🧹 Evicted stored raster {digest[:12]} ({size / 1e6:.1f} MB)")
+
+    def stats(self):
+        with self.lock:
+            rasters = self._load_index()["rasters"]
+            uses = sum(entry["uses"] for entry in rasters.values())
+            return {
+                "rasters": len(rasters),
+                "aliases": len(self.index["aliases"]),
+                "bytes": self.index["bytes"],
+                "max_bytes": self.max_bytes,
+                "stored_uses": uses,
+                "deduplicated_uses": uses - len(rasters),
+                "root": self.root,
+            }
+
+
+raster_store = RasterStore()
@@ -0,0 +1,257 @@
+import functools
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import record_cache
+from precision import ANALYSIS_DTYPE
+
+RESULT_CACHE_DIR = os.path.join(".cache", "results")
+MEMORY_CACHE_BYTES = 256 * 1024 * 1024
+DISK_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+# Disk eviction frees space down to this fraction of the budget, so the
+# directory is scanned once per batch of writes rather than on every one
+DISK_EVICT_TARGET = 0.9
+# Bump to drop every stored result after a change to the analysis code
+RESULT_CACHE_VERSION = 3
+
+
+class ResultCache:
+    """
+    Memoised analysis results keyed by raster content hash, function name
+    and parameters. Results are pickled once; the in-process tier keeps the
+    pickles in an LRU bounded by bytes, the disk tier keeps them under
+    <root>/<raster hash>/ so one raster's results can be dropped together.
+    Every hit unpickles a fresh copy, so callers may modify what they get.
+    """
+
+    def __init__(self, root=RESULT_CACHE_DIR, max_memory_bytes=MEMORY_CACHE_BYTES,
+                 max_disk_bytes=DISK_CACHE_BYTES):
+        self.root = root
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        # Running size of the disk tier; None until the first scan. Other
+        # processes sharing the root are picked up on the next scan.
+        self.disk_bytes = None
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def params_digest(name, params):
+        # Results computed under another QDF_PRECISION are kept apart
+        text = json.dumps({"name": name, "params": params, "version": RESULT_CACHE_VERSION,
+                           "precision": ANALYSIS_DTYPE.name},
+                          sort_keys=True, default=repr)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def _path(self, source_hash, name, digest):
+        return os.path.join(self.root, source_hash, f"{name}-{digest}.pkl")
+
+    def _count(self, name, result):
+        counts = self.counts.setdefault(name, {"memory_hits": 0, "disk_hits": 0, "misses": 0})
+        counts[result] += 1
+        record_cache(f"analysis_{name}", result != "misses")
+
+    def get(self, name, source_hash, params):
+        """(True, result) on a hit in either tier, else (False, None)"""
+        digest = self.params_digest(name, params)
+        key = (source_hash, name, digest)
+        with self.lock:
+            blob = self.memory.get(key)
+            if blob is not None:
+                self.memory.move_to_end(key)
+                self._count(name, "memory_hits")
+        if blob is not None:
+            return True, pickle.loads(blob)
+
+        path = self._path(source_hash, name, digest)
+        try:
+            with open(path, "rb") as f:
+                blob = f.read()
+            value = pickle.loads(blob)
+        except FileNotFoundError:
+            with self.lock:
+                self._count(name, "misses")
+            return False, None
+        except Exception as e:
+            print(f"⚠️ Dropping unreadable cached result {path}: {e}")
+            with self.lock:
+                self._count(name, "misses")
+            return False, None
+
+        os.utime(path)  # disk tier evicts least recently used first
+        with self.lock:
+            self._count(name, "disk_hits")
+            self._remember(key, blob)
+        return True, value
+
+    def put(self, name, source_hash, params, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = self.params_digest(name, params)
+        with self.lock:
+            self._remember((source_hash, name, digest), blob)
+
+        path = self._path(source_hash, name, digest)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                replaced = os.stat(path).st_size
+            except FileNotFoundError:
+                replaced = 0
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(blob)
+            os.replace(tmp_path, path)
+            with self.lock:
+                if self.disk_bytes is not None:
+                    self.disk_bytes += len(blob) - replaced
+            self._evict_disk()
+        except OSError as e:
+            print(f"⚠️ Could not persist cached result {name}: {e}")
+
+    def _remember(self, key, blob):
+        if len(blob) > self.max_memory_bytes:
+            return
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key))
+        self.memory[key] = blob
+        self.memory_bytes += len(blob)
+        while self.memory_bytes > self.max_memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def _disk_entries(self):
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for source in os.scandir(self.root):
+            if not source.is_dir():
+                continue
+            for entry in os.scandir(source.path):
+                if entry.name.endswith(".pkl"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _evict_disk(self):
+        """Remove least recently used results, scanning only when over budget"""
+        with self.lock:
+            if self.disk_bytes is not None and self.disk_bytes <= self.max_disk_bytes:
+                return
+        entries = self._disk_entries()
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_disk_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.max_disk_bytes * DISK_EVICT_TARGET:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+        with self.lock:
+            self.disk_bytes = total
+
+    def invalidate(self, source_hash=None, name=None):
+        """
+        Drop stored results for one raster and/or one analysis (everything
+        when both are None). Returns the number of disk entries removed.
+        """
+        with self.lock:
+            for key in [key for key in self.memory
+                        if (source_hash is None or key[0] == source_hash)
+                        and (name is None or key[1] == name)]:
+                self.memory_bytes -= len(self.memory.pop(key))
+
+        removed = 0
+        for _, _, path in self._disk_entries():
+            source, filename = os.path.basename(os.path.dirname(path)), os.path.basename(path)
+            if source_hash is not None and source != source_hash:
+                continue
+            if name is not None and not filename.startswith(f"{name}-"):
+                continue
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        if source_hash is not None and name is None:
+            source_dir = os.path.realpath(os.path.join(self.root, source_hash))
+            root = os.path.realpath(self.root)
+            if os.path.dirname(source_dir) == root:
+                shutil.rmtree(source_dir, ignore_errors=True)
+        with self.lock:
+            self.disk_bytes = None  # rescanned on the next put
+        print(f"🧹 Invalidated {removed} cached results "
+              f"(raster={source_hash or 'all'}, analysis={name or 'all'})")
+        return removed
+
+    def stats(self):
+        with self.lock:
+            analyses = {}
+            for name, counts in self.counts.items():
+                lookups = sum(counts.values())
+                hits = counts["memory_hits"] + counts["disk_hits"]
+                analyses[name] = dict(counts, hit_rate=round(hits / lookups, 4) if lookups else 0.0)
+            memory = {"entries": len(self.memory), "bytes": self.memory_bytes,
+                      "max_bytes": self.max_memory_bytes}
+        entries = self._disk_entries()
+        return {
+            "analyses": analyses,
+            "memory": memory,
+            "disk": {"entries": len(entries), "bytes": sum(size for _, size, _ in entries),
+                     "max_bytes": self.max_disk_bytes, "root": self.root},
+        }
+
+
+result_cache = ResultCache()
+
+
+def memoize_analysis(name):
+    """
+    Memoise an analysis function whose first argument is a raster path.
+    The key is the raster's content hash plus every other argument (with
+    defaults filled in), so renaming or re-downloading identical data still
+    hits. Non-file inputs and exceptions are never cached. The undecorated
+    function stays available as `.uncached`.
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+        source_arg = next(iter(signature.parameters))
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            dem_file = params.pop(source_arg)
+            if not isinstance(dem_file, str) or not os.path.isfile(dem_file):
+                return func(*args, **kwargs)
+
+            from raster_store import raster_hash
+
+            start = time.perf_counter()
+            source_hash = raster_hash(dem_file)
+            hit, value = result_cache.get(name, source_hash, params)
+            if hit:
+                print(f"⚡ Cached {name} for {dem_file} "
+                      f"({(time.perf_counter() - start) * 1000:.1f} ms)")
+                return value
+
+            value = func(*args, **kwargs)
+            result_cache.put(name, source_hash, params, value)
+            return value
+
+        wrapper.uncached = func
+        return wrapper
+
+    return decorator
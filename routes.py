@@ -7,15 +7,14 @@ import matplotlib
 from bson.objectid import ObjectId  # ✅ Required for handling MongoDB IDs
 
 matplotlib.use('Agg')
-import random
-
 import matplotlib.pyplot as plt
 import numpy as np
-from flask import (Blueprint, flash, jsonify, redirect, render_template,
-                   request, url_for)
+from flask import (Blueprint, Response, flash, jsonify, redirect,
+                   render_template, request, url_for)
 from werkzeug.utils import secure_filename
 
 from extraFunctions import crop_dem, download_dem, visualization
+from metrics import stage
 
 
 def callRoutes(app, mongo):
@@ -25,18 +24,15 @@ def callRoutes(app, mongo):
     def home():
         return render_template("home.html")
 
+    def record_analysis(dem_file, stats, data, visualization=None):
+        from analysis_store import record_analysis
+        return record_analysis(mongo, dem_file, stats, data, visualization)
+
 
     @routes.route("/ThirtyMeterDem")
     def ThirtyMeterDem():
-        boundaries = mongo.db.Boundaries.find({"userId": 1})
-        coords = []
-        sitename = []
-
-        for i in boundaries:
-            coords.append(i["coords"])
-            sitename.append(i["sitename"])
-
-        return render_template("index2.html", coords=coords, sitename=sitename)
+        # Saved sites are listed page by page through /api/sites
+        return render_template("index2.html")
 
 
     @routes.route("/usgsdem")
@@ -58,13 +54,15 @@ def callRoutes(app, mongo):
         print(coords)
         sitename = data.get("sitename")
 
+        from site_store import insert_site
+
         dataToInsert = {
             "userId": 1,
             "sitename": sitename,
             "coords": coords
         }
 
-        mongo.db.Boundaries.insert_one(dataToInsert)
+        insert_site(mongo.db.Boundaries, dataToInsert)
         return jsonify({"Message": "Success"})
 
     @routes.route("/api/get_dem", methods=["POST"])
@@ -89,27 +87,33 @@ def callRoutes(app, mongo):
         )
 
         # Downloads the dem from opentopography and stores it in a file
-        download_dem(south=minLat, west=minLng, north=maxLat, east=maxLng, typeofdem=dem)
+        with stage("download"):
+            download_dem(south=minLat, west=minLng, north=maxLat, east=maxLng, typeofdem=dem)
 
         # Takes the tif file and crops it into the user expected shape
-        CroppedFile = crop_dem(coords)
+        with stage("crop"):
+            CroppedFile = crop_dem(coords)
 
-        visualization(CroppedFile)
+        with stage("render"):
+            visualization(CroppedFile)
 
         # ✅ FIX: Import inside function to avoid circular imports
         try:
             from depth_analysis import calculate_quarry_depth
-            depth_data, depth_stats, transform, crs = calculate_quarry_depth("cropped.tif", referencePoint)
+            with stage("depth"):
+                depth_data, depth_stats, transform, crs = calculate_quarry_depth(
+                    "cropped.tif", referencePoint, boundary=coords)
             
-            return jsonify({
-                "status": "success",
-                "depth": depth_stats['max_depth'],
-                "min_elevation": float(depth_stats['quarry_bottom_elevation']),
-                "max_elevation": float(depth_stats['original_surface_elevation']),
-                "volume_m3": depth_stats['volume_m3'],
-                "area_m2": depth_stats['total_area_m2'],
-                "mean_depth": depth_stats['mean_depth']
-            })
+            with stage("json_encode"):
+                return jsonify({
+                    "status": "success",
+                    "depth": depth_stats['max_depth'],
+                    "min_elevation": float(depth_stats['quarry_bottom_elevation']),
+                    "max_elevation": float(depth_stats['original_surface_elevation']),
+                    "volume_m3": depth_stats['volume_m3'],
+                    "area_m2": depth_stats['total_area_m2'],
+                    "mean_depth": depth_stats['mean_depth']
+                })
         except Exception as e:
             print(f"Depth calculation error: {e}")
             # Fallback to basic elevation data
@@ -137,22 +141,28 @@ def callRoutes(app, mongo):
             if reference_point:
                  print(f"📍 Analyze Depth Route received reference: {reference_point}")
 
-            from depth_analysis import (calculate_quarry_depth,
-                                        generate_depth_visualization)
+            from depth_analysis import (calculate_quarry_depth, depth_visualization_path,
+                                        save_depth_visualization)
             
             dem_file = "cropped.tif"
             
-            # 3. Pass it to the function
-            depth_data, stats, transform, crs = calculate_quarry_depth(dem_file, reference_point)
+            # 3. Pass it to the function, measuring only the drawn polygon
+            boundary = data.get("coords")
+            depth_data, stats, transform, crs = calculate_quarry_depth(
+                dem_file, reference_point, boundary=boundary)
             
             # Save depth visualization
-            viz_path = "static/Figure/depth_analysis.png"
-            generate_depth_visualization(depth_data, viz_path)
+            viz_path = depth_visualization_path(dem_file, reference_point=reference_point,
+                                                boundary=boundary)
+            save_depth_visualization(dem_file, viz_path, reference_point, boundary=boundary)
+
+            analysis_id = record_analysis(dem_file, stats, data, viz_path)
             
             return jsonify({
                 "status": "success",
                 "depth_stats": stats,
-                "visualization": viz_path
+                "visualization": viz_path,
+                "analysis_id": analysis_id
             })
         except Exception as e:
             print(f"Depth analysis error: {e}")
@@ -164,176 +174,178 @@ def callRoutes(app, mongo):
 
     @routes.route('/api/quarry/terrain-data')
     def get_terrain_data():
-        """Automatically generate realistic quarry terrain data"""
+        """Seeded synthetic quarry terrain data (same terrain for the same seed)"""
         try:
-            # Generate realistic quarry data automatically
-            quarry_data = generate_quarry_data()
-            return jsonify({
+            seed = request.args.get('seed', 0, type=int)
+            quarry_data = generate_quarry_data(seed)
+            response = jsonify({
                 'success': True,
                 'data': quarry_data
             })
+            response.add_etag()
+            return response.make_conditional(request)
         except Exception as e:
             return jsonify({
                 'success': False,
                 'error': str(e)
             })
 
-    def generate_quarry_data():
-        """Generate realistic 195x85 quarry terrain data automatically"""
-        width = 195
-        height = 85
-        
-        # Create empty depth data array
-        depth_data = [[0 for _ in range(width)] for _ in range(height)]
-        
-        # Quarry center points (multiple excavation areas)
-        centers = [
-            (width // 2, height // 2),  # Main quarry pit
-            (width // 3, height // 3),  # Secondary excavation
-            (2 * width // 3, 2 * height // 3)  # Third excavation
-        ]
-        
-        # Generate realistic quarry terrain
-        for y in range(height):
-            for x in range(width):
-                depth = generate_depth_at_point(x, y, width, height, centers)
-                depth_data[y][x] = depth
-        
-        # Calculate actual min/max from generated data
-        all_depths = [depth for row in depth_data for depth in row]
-        min_depth = min(all_depths)
-        max_depth = max(all_depths)
-        
-        return {
-            'width': width,
-            'height': height,
-            'elevation_range': {
-                'min': float(min_depth),
-                'max': float(max_depth)
-            },
-            'depth_data': depth_data,
-            'timestamp': 'auto_generated',
-            'data_points': width * height
-        }
-
-    def generate_depth_at_point(x, y, width, height, centers):
-        """Generate realistic depth for a specific point in the quarry"""
-        
-        # Calculate distance to nearest quarry center
-        min_distance = float('inf')
-        for center_x, center_y in centers:
-            distance = np.sqrt((x - center_x)**2 + (y - center_y)**2)
-            min_distance = min(min_distance, distance)
-        
-        # Normalize distance (0 to 1)
-        max_possible_distance = np.sqrt((width/2)**2 + (height/2)**2)
-        normalized_dist = min_distance / max_possible_distance
-        
-        # Generate depth based on distance from center
-        if normalized_dist < 0.2:
-            # Deep pit area - maximum excavation
-            base_depth = -70 + random.uniform(-10, 5)  # Around -74m
-        elif normalized_dist < 0.4:
-            # Medium depth - sloping area
-            base_depth = -40 + (normalized_dist - 0.2) * 100
-        elif normalized_dist < 0.6:
-            # Shallow area - approaching edges
-            base_depth = 0 + (normalized_dist - 0.4) * 80
-        else:
-            # Edge/rim area - above ground level
-            base_depth = 20 + (normalized_dist - 0.6) * 130  # Up to 101m
-        
-        # Add realistic terrain variations
-        variation = (
-            np.sin(x * 0.1) * np.cos(y * 0.1) * 8 +  # Large waves
-            np.sin(x * 0.3) * np.cos(y * 0.3) * 4 +  # Medium features
-            np.sin(x * 0.8) * np.cos(y * 0.8) * 2 +  # Small details
-            random.gauss(0, 1.5)                     # Random noise
-        )
-        
-        final_depth = base_depth + variation
-        
-        return float(final_depth)
+    def generate_quarry_data(seed=0):
+        """Generate realistic 195x85 quarry terrain data (vectorised, memoised per seed)"""
+        from synthetic_quarry import demo_terrain_data
+        return demo_terrain_data(195, 85, seed)
 
     
+    def record_upload(upload, data, analysis_id=None):
+        """One Uploads document per upload, pointing at the stored raster and its analysis"""
+        try:
+            from analysis_store import to_object_id
+            mongo.db.Uploads.insert_one({
+                "sha1": upload["sha1"],
+                "filename": upload["filename"],
+                "bytes": upload["bytes"],
+                "deduplicated": upload["deduplicated"],
+                "siteId": to_object_id(data.get("site_id")),
+                "analysisId": to_object_id(analysis_id),
+                "uploadedAt": datetime.utcnow(),
+            })
+        except Exception as e:
+            print(f"❌ Could not record upload: {e}")
+
     @routes.route("/api/upload_dem", methods=["POST"])
     def upload_dem():
         """
-        1. Receives a custom .tif file from the user (Drone/Pix4D data)
-        2. Saves it locally
-        3. Runs depth analysis immediately
+        1. Streams a custom .tif from the user (Drone/Pix4D data) to disk,
+           either as the raw request body (?filename=) or a multipart "file"
+        2. Rejects it as soon as the header shows it cannot be analysed
+        3. Runs depth analysis immediately (large rasters: overviews built
+           and a preview read from them now, the full analysis in the background)
         4. Returns the stats and the heatmap image URL
         """
         try:
-            # 1. Validation: Did they send a file?
-            if 'file' not in request.files:
-                return jsonify({"status": "error", "message": "No file part"}), 400
-            
-            file = request.files['file']
-            
-            if file.filename == '':
-                return jsonify({"status": "error", "message": "No selected file"}), 400
+            from dem_ingest import (MAX_UPLOAD_BYTES, PREVIEW_PIXELS, IngestError,
+                                    ingest_upload, start_upload_job, stored_upload,
+                                    upload_preview)
+
+            # 1. Stream the upload: raw bodies are read straight off the socket
+            max_bytes = app.config.get("MAX_UPLOAD_BYTES", MAX_UPLOAD_BYTES)
+            if request.content_length and request.content_length > max_bytes:
+                # Refused before a single body byte is read
+                return jsonify({"status": "error",
+                                "message": f"Upload exceeds the {max_bytes:,} byte limit"}), 413
+            known_sha1 = request.args.get("sha1", "").lower()
+            try:
+                if known_sha1 and not request.content_length:
+                    # The client hashed the file first: a raster we already
+                    # hold needs no bytes sent at all
+                    upload = stored_upload(known_sha1, request.args.get("filename"))
+                    if upload is None:
+                        return jsonify({"status": "error", "message": "Raster not stored, send the file"}), 404
+                elif request.files:
+                    if 'file' not in request.files:
+                        return jsonify({"status": "error", "message": "No file part"}), 400
+                    file = request.files['file']
+                    if file.filename == '':
+                        return jsonify({"status": "error", "message": "No selected file"}), 400
+                    upload = ingest_upload(file.stream, file.filename, max_bytes=max_bytes)
+                else:
+                    upload = ingest_upload(request.stream, request.args.get("filename", ""),
+                                           max_bytes=max_bytes, content_length=request.content_length)
+            except IngestError as e:
+                print(f"❌ Upload refused: {e}")
+                return jsonify({"status": "error", "message": str(e)}), e.status
+
+            save_path, filename = upload["path"], upload["filename"]
+            print(f"✅ File uploaded: {save_path}" + (" (already stored)" if upload["deduplicated"] else ""))
+
+            # 2. Run Analysis 
+            # Import inside to avoid circular dependency
+            from depth_analysis import (calculate_quarry_depth,
+                                        save_depth_visualization)
+
+            # Check for optional reference point
+            ref_lat = request.values.get('ref_lat')
+            ref_lng = request.values.get('ref_lng')
+            reference_point = None
             
-            # 2. Validation: Is it a TIF?
-            if file and (file.filename.lower().endswith('.tif') or file.filename.lower().endswith('.tiff')):
-                
-                # Create uploads directory if it doesn't exist
-                upload_folder = "uploads"
-                os.makedirs(upload_folder, exist_ok=True)
-                
-                # Save the file securely
-                filename = secure_filename(file.filename)
-                timestamp = int(time.time())
-                save_path = os.path.join(upload_folder, f"{timestamp}_{filename}")
-                file.save(save_path)
-                
-                print(f"✅ File uploaded: {save_path}")
-
-                # 3. Run Analysis 
-                # Import inside to avoid circular dependency
-                from depth_analysis import (calculate_quarry_depth,
-                                            generate_depth_visualization)
-
-                # Check for optional reference point
-                ref_lat = request.form.get('ref_lat')
-                ref_lng = request.form.get('ref_lng')
-                reference_point = None
-                
-                if ref_lat and ref_lng:
-                    try:
-                        reference_point = {'lat': float(ref_lat), 'lng': float(ref_lng)}
-                    except:
-                        pass # Ignore invalid coords
+            if ref_lat and ref_lng:
+                try:
+                    reference_point = {'lat': float(ref_lat), 'lng': float(ref_lng)}
+                except:
+                    pass # Ignore invalid coords
+
+            timestamp = int(time.time())
+            viz_filename = f"heatmap_{timestamp}.png"
+            viz_folder = os.path.join("static", "Figure")
+            os.makedirs(viz_folder, exist_ok=True)
+            viz_path = os.path.join(viz_folder, viz_filename)
+            heatmap_url = url_for('static', filename=f'Figure/{viz_filename}')
+            analysis_data = {
+                "site_id": request.values.get("site_id"),
+                "sitename": request.values.get("sitename"),
+                "reference_point": reference_point,
+                "source": {"type": "upload", "filename": filename, "sha1": upload["sha1"]},
+            }
 
+            def analyze(upload):
                 # Calculate Depth
                 depth_data, stats, transform, crs = calculate_quarry_depth(save_path, reference_point)
-                
-                # 4. Generate Visualization (Heatmap)
-                viz_filename = f"heatmap_{timestamp}.png"
-                viz_folder = os.path.join("static", "Figure")
-                os.makedirs(viz_folder, exist_ok=True)
-                
-                viz_path = os.path.join(viz_folder, viz_filename)
-                
-                # Generate the heatmap
-                generate_depth_visualization(depth_data, viz_path)
-                
-                # 5. Return JSON Result
+                # 3. Generate Visualization (Heatmap)
+                save_depth_visualization(save_path, viz_path, reference_point)
+                analysis_id = record_analysis(save_path, stats, analysis_data, viz_path)
+                record_upload(upload, analysis_data, analysis_id)
+                return {
+                    "depth_stats": stats,
+                    "heatmap_url": heatmap_url,
+                    "analysis_id": analysis_id,
+                }
+
+            header = upload["header"]
+            if header["width"] * header["height"] > PREVIEW_PIXELS:
+                # Too large to answer in one request: overviews are built and
+                # statistics read from them now, the full run in the background
+                stats, optimized = upload_preview(save_path, reference_point)
+                job = start_upload_job(upload, analyze, optimized)
                 return jsonify({
                     "status": "success",
-                    "message": "Analysis Complete",
+                    "message": "Preview from overviews; full analysis running",
+                    "preview": True,
                     "depth_stats": stats,
-                    "heatmap_url": url_for('static', filename=f'Figure/{viz_filename}'),
-                    "filename": filename
-                })
+                    "filename": filename,
+                    "sha1": upload["sha1"],
+                    "deduplicated": upload["deduplicated"],
+                    "warnings": upload["warnings"],
+                    "upload_id": job.id,
+                    "job_url": f"/api/uploads/{job.id}",
+                }), 202
+
+            result = analyze(upload)
             
-            else:
-                return jsonify({"status": "error", "message": "Invalid file type. Only .tif allowed"}), 400
+            # 4. Return JSON Result
+            return jsonify({
+                "status": "success",
+                "message": "Analysis Complete",
+                "filename": filename,
+                "sha1": upload["sha1"],
+                "deduplicated": upload["deduplicated"],
+                "warnings": upload["warnings"],
+                **result,
+            })
 
         except Exception as e:
             print(f"❌ Upload Error: {e}")
             return jsonify({"status": "error", "message": str(e)}), 500
 
+    @routes.route("/api/uploads/<upload_id>", methods=["GET"])
+    def upload_status(upload_id):
+        """State of a large upload's background optimisation and full analysis"""
+        from dem_ingest import get_upload_job
+
+        job = get_upload_job(upload_id)
+        if job is None:
+            return jsonify({"status": "error", "message": "Upload not found"}), 404
+        return jsonify({"status": "success", "upload": job.status()})
+
         # === 💾 SAVED SITES API ===
 
 
@@ -348,6 +360,8 @@ def callRoutes(app, mongo):
             if not coords or not sitename:
                 return jsonify({"status": "error", "message": "Missing data"}), 400
 
+            from site_store import insert_site
+
             dataToInsert = {
                 "userId": 1,
                 "sitename": sitename,
@@ -356,35 +370,148 @@ def callRoutes(app, mongo):
                 "timestamp": time.time()
             }
 
-            mongo.db.Boundaries.insert_one(dataToInsert)
+            # Also stores the list preview and the GeoJSON geometry
+            insert_site(mongo.db.Boundaries, dataToInsert)
             return jsonify({"status": "success", "message": "Site Saved"})
         except Exception as e:
             return jsonify({"status": "error", "message": str(e)})
 
+    @routes.route("/api/sites/import", methods=["POST"])
+    def import_sites():
+        """
+        Bulk import boundaries from a GeoJSON or KML upload ("file" field,
+        or the raw request body with ?format=). With analyze=1 every
+        imported site is queued for depth analysis in the background.
+        """
+        try:
+            from site_import import (ANALYSIS_WORKERS, IMPORT_FORMATS, detect_format,
+                                     import_sites, start_analysis_job)
+
+            options = request.values
+            if "file" in request.files:
+                upload = request.files["file"]
+                filename, stream = secure_filename(upload.filename or ""), upload.stream
+            else:
+                filename, stream = None, request.stream
+            fmt = options.get("format")
+            if fmt is None:
+                fmt = detect_format(filename, stream.peek(64) if hasattr(stream, "peek") else b"")
+            if fmt not in IMPORT_FORMATS:
+                return jsonify({"status": "error",
+                                "message": f"format must be one of {list(IMPORT_FORMATS)}"}), 400
+
+            report, sites = import_sites(mongo.db.Boundaries, stream, fmt, filename)
+            response = {"status": "success", "import": report}
+
+            if options.get("analyze") in ("1", "true") and sites:
+                job = start_analysis_job(
+                    sites,
+                    dem=options.get("dem", "COP"),
+                    workers=int(options.get("workers", ANALYSIS_WORKERS)),
+                    record=record_analysis,
+                )
+                response["analysis"] = job.status()
+                response["analysis_url"] = f"/api/sites/import/{job.id}"
+                return jsonify(response), 202
+            return jsonify(response)
+        except (ValueError, SyntaxError) as e:
+            # json and ElementTree parse errors
+            return jsonify({"status": "error", "message": f"Could not read import file: {e}"}), 400
+        except Exception as e:
+            print(f"❌ Import Error: {e}")
+            return jsonify({"status": "error", "message": str(e)}), 500
+
+    @routes.route("/api/sites/import/<job_id>", methods=["GET"])
+    def import_analysis_status(job_id):
+        """Progress and throughput of a batch analysis started by an import"""
+        from site_import import get_analysis_job
+
+        job = get_analysis_job(job_id)
+        if job is None:
+            return jsonify({"status": "error", "message": "Job not found"}), 404
+        return jsonify({"status": "success", "analysis": job.status()})
+
 
 # === 📂 GET SAVED SITES FOR SIDEBAR ===
     @routes.route("/api/sites", methods=["GET"])
     def get_sites():
-        """Fetch all saved sites for the drawer"""
+        """
+        One page of saved sites for the drawer, newest first, without full
+        coordinates: ?limit=50&before=<next>&geometry=polyline|simplified|none.
+        Full boundaries come from /api/sites/<id>.
+        """
         try:
-            # Get sites, sorted by newest first (assuming _id stores timestamp roughly)
-            sites = mongo.db.Boundaries.find({"userId": 1}).sort("_id", -1)
-            
-            site_list = []
-            for site in sites:
-                # Handle cases where 'date' might not exist in old records
-                date_str = site.get("date", "Unknown Date")
-                
-                site_list.append({
+            from site_store import (SITES_PAGE_SIZE, ensure_site_indexes, page_limit,
+                                    sites_page, sites_page_etag)
+
+            collection = mongo.db.Boundaries
+            ensure_site_indexes(collection)
+            limit = page_limit(request.args.get("limit", SITES_PAGE_SIZE, type=int))
+            before = request.args.get("before")
+            geometry = request.args.get("geometry", "polyline")
+
+            # Revalidation only reads ids from the index
+            etag = sites_page_etag(collection, 1, limit, before, geometry)
+            if request.if_none_match.contains(etag):
+                return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+            page = sites_page(collection, 1, limit, before, geometry)
+            response = jsonify({"status": "success", **page})
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        except Exception as e:
+            print(f"Error fetching sites: {e}")
+            return jsonify({"status": "error", "message": str(e)})
+
+    @routes.route("/api/sites/within", methods=["GET"])
+    def sites_in_view():
+        """Saved sites intersecting the map viewport: ?bbox=west,south,east,north"""
+        try:
+            from site_store import (MAX_WITHIN_LIMIT, WITHIN_LIMIT, ensure_site_indexes,
+                                    parse_bbox, sites_within)
+
+            west, south, east, north = parse_bbox(request.args.get("bbox"))
+            limit = max(1, min(request.args.get("limit", WITHIN_LIMIT, type=int), MAX_WITHIN_LIMIT))
+            collection = mongo.db.Boundaries
+            ensure_site_indexes(collection)
+
+            result = sites_within(collection, west, south, east, north, 1, limit)
+            response = jsonify({"status": "success", **result})
+            response.add_etag()
+            response.headers["Cache-Control"] = "no-cache"
+            return response.make_conditional(request)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        except Exception as e:
+            print(f"Error fetching sites in view: {e}")
+            return jsonify({"status": "error", "message": str(e)})
+
+    @routes.route("/api/sites/<site_id>", methods=["GET"])
+    def get_site(site_id):
+        """Full boundary of one saved site, fetched when it is selected"""
+        try:
+            if not ObjectId.is_valid(site_id):
+                return jsonify({"status": "error", "message": "Invalid site id"}), 400
+            site = mongo.db.Boundaries.find_one({"_id": ObjectId(site_id)},
+                                                {"sitename": 1, "date": 1, "coords": 1})
+            if site is None:
+                return jsonify({"status": "error", "message": "Site not found"}), 404
+
+            response = jsonify({
+                "status": "success",
+                "site": {
                     "id": str(site["_id"]),
                     "name": site.get("sitename", "Unnamed Site"),
-                    "date": date_str,
+                    "date": site.get("date", "Unknown Date"),
                     "coords": site["coords"]
-                })
-            
-            return jsonify({"status": "success", "sites": site_list})
+                }
+            })
+            response.add_etag()
+            return response.make_conditional(request)
         except Exception as e:
-            print(f"Error fetching sites: {e}")
             return jsonify({"status": "error", "message": str(e)})
 
     # === 🗑️ DELETE SITE API ===
@@ -392,13 +519,78 @@ def callRoutes(app, mongo):
     def delete_site(site_id):
         from bson.objectid import \
             ObjectId  # Import here to avoid top-level dependency issues
+        from analysis_store import get_recorder
         try:
             mongo.db.Boundaries.delete_one({"_id": ObjectId(site_id)})
+            # Queued history of the site would otherwise be written after the cascade
+            get_recorder(mongo).discard_site(ObjectId(site_id))
+            mongo.db.Analyses.delete_many({"siteId": ObjectId(site_id)})
             return jsonify({"status": "success", "message": "Deleted"})
         except Exception as e:
             return jsonify({"status": "error", "message": str(e)})
 
 
+# === 📈 ANALYSIS HISTORY API ===
+    @routes.route("/api/sites/<site_id>/analyses", methods=["GET"])
+    def site_analyses(site_id):
+        """Paginated analysis history of one saved site, newest first"""
+        try:
+            from analysis_store import HISTORY_PAGE_SIZE, history_page, to_object_id
+
+            if to_object_id(site_id) is None:
+                return jsonify({"status": "error", "message": "Invalid site id"}), 400
+            fields = request.args.get("fields")
+            page = history_page(
+                mongo.db.Analyses,
+                site_id=site_id,
+                limit=request.args.get("limit", HISTORY_PAGE_SIZE, type=int),
+                before=request.args.get("before"),
+                fields=fields.split(",") if fields else None,
+            )
+            return jsonify({"status": "success", **page})
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)})
+
+    @routes.route("/api/analyses", methods=["GET"])
+    def analyses():
+        """
+        Stored analyses for dashboards: ?sites=id1,id2 gives the latest
+        summary per site, otherwise a paginated newest-first list
+        """
+        try:
+            from analysis_store import HISTORY_PAGE_SIZE, history_page, latest_per_site
+
+            fields = request.args.get("fields")
+            fields = fields.split(",") if fields else None
+            sites = request.args.get("sites")
+            if sites:
+                latest = latest_per_site(mongo.db.Analyses, sites.split(","), fields)
+                return jsonify({"status": "success", "analyses": latest})
+
+            page = history_page(
+                mongo.db.Analyses,
+                limit=request.args.get("limit", HISTORY_PAGE_SIZE, type=int),
+                before=request.args.get("before"),
+                fields=fields,
+            )
+            return jsonify({"status": "success", **page})
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)})
+
+    @routes.route("/api/analyses/<analysis_id>", methods=["GET"])
+    def get_analysis(analysis_id):
+        """One stored analysis with its full statistics"""
+        try:
+            from analysis_store import get_recorder, serialize_analysis
+
+            document = get_recorder(mongo).get(analysis_id)
+            if document is None:
+                return jsonify({"status": "error", "message": "Analysis not found"}), 404
+            return jsonify({"status": "success", "analysis": serialize_analysis(document)})
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)})
+
+
 # === 📄 DOWNLOAD REPORT API ===
     @routes.route("/api/download_report", methods=["POST"])
     def download_report():
@@ -418,9 +610,23 @@ def callRoutes(app, mongo):
             else:
                 image_path = None
 
+            stats = data.get('stats', {})
+            sitename = data.get('sitename')
+
+            # Stored analyses are the source of truth when the client names one
+            if data.get('analysis_id'):
+                from analysis_store import get_recorder
+
+                analysis = get_recorder(mongo).get(data['analysis_id'])
+                if analysis is None:
+                    return jsonify({"status": "error", "message": "Analysis not found"}), 404
+                stats = analysis['stats']
+                sitename = sitename or analysis.get('sitename')
+                image_path = image_path or analysis.get('visualization')
+
             report_data = {
-                'sitename': data.get('sitename', 'Quarry Site'),
-                'stats': data.get('stats', {}),
+                'sitename': sitename or 'Quarry Site',
+                'stats': stats,
                 'image_path': image_path
             }
 
@@ -438,4 +644,7 @@ def callRoutes(app, mongo):
             print(f"Report Generation Error: {e}")
             return jsonify({"status": "error", "message": str(e)})
 
+    from profiling import enable_profiling
+    enable_profiling(routes)
+
     return routes 
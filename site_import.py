@@ -0,0 +1,416 @@
+import argparse
+import codecs
+import json
+import os
+import shutil
+import statistics
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+from pymongo.errors import BulkWriteError
+
+from site_store import GEO_EXTRACT_ERROR, boundary_geometry, ensure_site_indexes, site_spatial_fields
+
+IMPORT_FORMATS = ("geojson", "kml")
+IMPORT_BATCH_SIZE = 500
+IMPORT_CHUNK_SIZE = 64 * 1024
+# Per-feature problems returned in the report; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+MAX_SITENAME_LENGTH = 200
+NAME_PROPERTIES = ("sitename", "name", "Name", "NAME", "title", "id")
+# OpenTopography throttles bursts, so only a few downloads run at once
+ANALYSIS_WORKERS = 4
+MAX_ANALYSIS_WORKERS = 16
+IMPORT_WORK_DIR = os.path.join(".cache", "imports")
+# Finished analysis jobs kept for /api/sites/import/<job_id>
+KEEP_JOBS = 20
+
+
+def detect_format(filename=None, head=b""):
+    """'kml' or 'geojson' from the file extension, else from the first byte"""
+    extension = os.path.splitext(filename or "")[1].lower()
+    if extension == ".kml":
+        return "kml"
+    if extension in (".geojson", ".json"):
+        return "geojson"
+    return "kml" if head.lstrip(b"\xef\xbb\xbf \t\r\n")[:1] == b"<" else "geojson"
+
+
+def _read_text(stream, decoder, chunk_size):
+    data = stream.read(chunk_size)
+    if isinstance(data, str):
+        return data
+    return decoder.decode(data or b"", final=not data)
+
+
+def iter_geojson_features(stream, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Features of a GeoJSON FeatureCollection, decoded one at a time from a
+    binary or text stream so only the current feature is held in memory.
+    A lone Feature or bare geometry is read whole.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    json_decoder = json.JSONDecoder()
+    buffer = ""
+    while True:
+        key = buffer.find('"features"')
+        bracket = buffer.find("[", key) if key >= 0 else -1
+        if bracket >= 0:
+            buffer = buffer[bracket + 1:]
+            break
+        chunk = _read_text(stream, decoder, chunk_size)
+        if not chunk:
+            document = json.loads(buffer)
+            if document.get("type") == "Feature":
+                yield document
+            else:
+                yield {"type": "Feature", "properties": {}, "geometry": document}
+            return
+        buffer += chunk
+
+    while True:
+        buffer = buffer.lstrip(" \t\r\n,")
+        if buffer.startswith("]"):
+            return
+        try:
+            feature, end = json_decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            chunk = _read_text(stream, decoder, chunk_size)
+            if not chunk:
+                raise ValueError("GeoJSON ends inside the features array")
+            buffer += chunk
+            continue
+        yield feature
+        buffer = buffer[end:]
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _kml_ring(element):
+    text = next((child.text for child in element.iter() if _local_name(child.tag) == "coordinates"), "")
+    ring = []
+    for token in (text or "").split():
+        values = token.split(",")
+        if len(values) >= 2:
+            ring.append([float(values[0]), float(values[1])])
+    return ring
+
+
+def iter_kml_features(stream):
+    """
+    Placemarks of a KML document as GeoJSON-like features (outer rings
+    only), parsed incrementally; each Placemark is freed once read
+    """
+    for _, element in ET.iterparse(stream, events=("end",)):
+        if _local_name(element.tag) != "Placemark":
+            continue
+        name = next((child.text for child in element if _local_name(child.tag) == "name"), None)
+        polygons = []
+        for polygon in element.iter():
+            if _local_name(polygon.tag) != "Polygon":
+                continue
+            outer = next((child for child in polygon if _local_name(child.tag) == "outerBoundaryIs"), None)
+            if outer is not None:
+                polygons.append([_kml_ring(outer)])
+        element.clear()
+        geometry = {"type": "MultiPolygon", "coordinates": polygons} if polygons else None
+        yield {"type": "Feature", "properties": {"name": name}, "geometry": geometry}
+
+
+def feature_boundaries(feature, index, name_prefix="Imported site"):
+    """
+    (sitename, coords) for each polygon of a feature, with coords in the
+    map's [{"lat", "lng"}] shape. Raises ValueError for anything that is
+    not a usable polygon.
+    """
+    if not isinstance(feature, dict):
+        raise ValueError("not a GeoJSON feature")
+    geometry = feature.get("geometry") or {}
+    properties = feature.get("properties") or {}
+    name = next((str(properties[key]).strip() for key in NAME_PROPERTIES if properties.get(key)), "")
+    name = (name or f"{name_prefix} {index + 1}")[:MAX_SITENAME_LENGTH]
+
+    if geometry.get("type") == "Polygon":
+        polygons = [geometry.get("coordinates")]
+    elif geometry.get("type") == "MultiPolygon":
+        polygons = geometry.get("coordinates") or []
+    else:
+        raise ValueError(f"unsupported geometry {geometry.get('type')!r}")
+    if not polygons:
+        raise ValueError("empty geometry")
+
+    boundaries = []
+    for number, rings in enumerate(polygons):
+        try:
+            ring = [(float(point[0]), float(point[1])) for point in rings[0]]
+        except (TypeError, ValueError, IndexError):
+            raise ValueError("malformed coordinates")
+        if len(ring) > 1 and ring[0] == ring[-1]:
+            ring = ring[:-1]
+        if any(not -180 <= lng <= 180 or not -90 <= lat <= 90 for lng, lat in ring):
+            raise ValueError("coordinates outside lng/lat range")
+        coords = [{"lat": lat, "lng": lng} for lng, lat in ring]
+        if boundary_geometry(coords)[0] is None:
+            raise ValueError("fewer than three distinct vertices")
+        label = name if len(polygons) == 1 else f"{name} ({number + 1})"
+        boundaries.append((label[:MAX_SITENAME_LENGTH], coords))
+    return boundaries
+
+
+def insert_batch(collection, documents):
+    """
+    insert_many one batch, unordered. Polygons the 2dsphere index rejects
+    are inserted again without geometry, like insert_site does.
+    Returns (inserted documents, [(document, message)] failures).
+    """
+    try:
+        collection.insert_many(documents, ordered=False)
+        return documents, []
+    except BulkWriteError as e:
+        errors = {error["index"]: error for error in e.details.get("writeErrors", [])}
+
+    inserted = [document for index, document in enumerate(documents) if index not in errors]
+    retry = [documents[index] for index, error in errors.items() if error.get("code") == GEO_EXTRACT_ERROR]
+    failed = [(documents[index], error.get("errmsg", "write failed"))
+              for index, error in errors.items() if error.get("code") != GEO_EXTRACT_ERROR]
+    if retry:
+        for document in retry:
+            document["geometry"] = None
+        retried, retry_failed = insert_batch(collection, retry)
+        inserted += retried
+        failed += retry_failed
+    return inserted, failed
+
+
+def import_sites(collection, stream, fmt="geojson", filename=None, user_id=1,
+                 batch_size=IMPORT_BATCH_SIZE):
+    """
+    Validate, normalise and insert every polygon of a GeoJSON or KML
+    stream in one pass, writing insert_many batches as they fill.
+    Returns (report, sites) where sites lists (id, sitename, coords) of
+    the inserted boundaries for batch analysis.
+    """
+    if fmt not in IMPORT_FORMATS:
+        raise ValueError(f"Unknown import format {fmt!r}, choose from {list(IMPORT_FORMATS)}")
+    features = iter_kml_features(stream) if fmt == "kml" else iter_geojson_features(stream)
+    ensure_site_indexes(collection)
+
+    start = time.perf_counter()
+    now = datetime.now()
+    source = {"type": "import", "format": fmt, "file": filename}
+    batch, sites, errors = [], [], []
+    feature_count = skipped = failed = 0
+
+    def flush():
+        nonlocal failed
+        inserted, batch_failed = insert_batch(collection, batch)
+        sites.extend((document["_id"], document["sitename"], document["coords"]) for document in inserted)
+        failed += len(batch_failed)
+        for document, message in batch_failed[:max(0, MAX_REPORTED_ERRORS - len(errors))]:
+            errors.append({"name": document["sitename"], "reason": message})
+        batch.clear()
+        print(f"📥 Imported {len(sites)} sites from {filename or fmt} "
+              f"({feature_count / (time.perf_counter() - start):.0f} features/s)")
+
+    for index, feature in enumerate(features):
+        feature_count += 1
+        try:
+            boundaries = feature_boundaries(feature, index)
+        except ValueError as e:
+            skipped += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({"feature": index, "reason": str(e)})
+            continue
+        for sitename, coords in boundaries:
+            document = {
+                "userId": user_id,
+                "sitename": sitename,
+                "coords": coords,
+                "date": now.strftime("%Y-%m-%d"),
+                "timestamp": time.time(),
+                "source": source,
+            }
+            document.update(site_spatial_fields(coords))
+            batch.append(document)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    seconds = time.perf_counter() - start
+    report = {
+        "format": fmt,
+        "features": feature_count,
+        "inserted": len(sites),
+        "skipped": skipped,
+        "failed": failed,
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "sites_per_second": round(len(sites) / seconds, 1) if seconds else None,
+    }
+    print(f"✅ Import of {filename or fmt}: {len(sites)} sites in {seconds:.2f} s, "
+          f"{skipped} features skipped, {failed} writes failed")
+    return report, sites
+
+
+def analyze_site(site_id, sitename, coords, dem="COP", record=None, work_dir=IMPORT_WORK_DIR):
+    """
+    Download, crop and measure one imported boundary in its own directory
+    (the interactive flow's dem_tile.tif/cropped.tif are shared files).
+    Returns the depth statistics, or raises.
+    """
+    from depth_analysis import calculate_quarry_depth
+    from extraFunctions import crop_dem, download_dem
+
+    site_dir = os.path.join(work_dir, str(site_id))
+    os.makedirs(site_dir, exist_ok=True)
+    try:
+        lats = [point["lat"] for point in coords]
+        lngs = [point["lng"] for point in coords]
+        bbox = {"minLat": min(lats), "maxLat": max(lats), "minLng": min(lngs), "maxLng": max(lngs)}
+        tile = os.path.join(site_dir, "dem_tile.tif")
+        download_dem(south=bbox["minLat"], west=bbox["minLng"], north=bbox["maxLat"],
+                     east=bbox["maxLng"], typeofdem=dem, output_file=tile)
+        cropped = crop_dem(coords, input_tif=tile, output_tif=os.path.join(site_dir, "cropped.tif"))
+        if not cropped:
+            raise RuntimeError("DEM download or crop failed")
+        _, stats, _, _ = calculate_quarry_depth(cropped, boundary=coords)
+        if record is not None:
+            record(cropped, stats, {"site_id": str(site_id), "sitename": sitename, "dem": dem,
+                                    "bbox": bbox, "source": {"type": "import", "dem": dem}})
+        return stats
+    finally:
+        shutil.rmtree(site_dir, ignore_errors=True)
+
+
+class AnalysisJob:
+    """Depth analysis of imported sites on a thread pool, with progress counters"""
+
+    def __init__(self, sites, dem="COP", workers=ANALYSIS_WORKERS, record=None):
+        self.id = uuid.uuid4().hex[:16]
+        self.sites = sites
+        self.dem = dem
+        self.workers = max(1, min(int(workers), MAX_ANALYSIS_WORKERS))
+        self.record = record
+        self.done = 0
+        self.failed = []
+        self.durations = []
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()
+
+    def _analyze(self, site):
+        site_id, sitename, coords = site
+        start = time.perf_counter()
+        try:
+            analyze_site(site_id, sitename, coords, self.dem, self.record)
+            with self.lock:
+                self.done += 1
+                self.durations.append(time.perf_counter() - start)
+        except Exception as e:
+            print(f"❌ Batch analysis of {sitename} failed: {e}")
+            with self.lock:
+                self.failed.append({"site_id": str(site_id), "name": sitename, "reason": str(e)})
+
+    def run(self):
+        self.started = time.perf_counter()
+        print(f"🧮 Analysing {len(self.sites)} imported sites on {self.workers} workers")
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(self._analyze, self.sites))
+        self.finished = time.perf_counter()
+        status = self.status()
+        print(f"✅ Batch analysis: {status['done']} done, {len(self.failed)} failed in "
+              f"{status['elapsed_seconds']} s ({status['sites_per_minute']} sites/min)")
+        return status
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def status(self):
+        with self.lock:
+            done, failed = self.done, list(self.failed)
+            durations = list(self.durations)
+        end = self.finished or time.perf_counter()
+        elapsed = end - self.started if self.started else 0.0
+        finished = done + len(failed)
+        return {
+            "job_id": self.id,
+            "state": "finished" if self.finished else ("running" if self.started else "queued"),
+            "total": len(self.sites),
+            "done": done,
+            "failed": len(failed),
+            "errors": failed[:MAX_REPORTED_ERRORS],
+            "workers": self.workers,
+            "elapsed_seconds": round(elapsed, 2),
+            "sites_per_minute": round(finished / elapsed * 60, 1) if elapsed else None,
+            "median_site_seconds": round(statistics.median(durations), 2) if durations else None,
+        }
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def start_analysis_job(sites, dem="COP", workers=ANALYSIS_WORKERS, record=None):
+    """Queue batch analysis in the background; the job stays queryable by id"""
+    job = AnalysisJob(sites, dem, workers, record)
+    with _jobs_lock:
+        _jobs[job.id] = job
+        while len(_jobs) > KEEP_JOBS:
+            oldest = next((job_id for job_id, old in _jobs.items() if old.finished), None)
+            if oldest is None:
+                break
+            del _jobs[oldest]
+    return job.start()
+
+
+def get_analysis_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import quarry boundaries from GeoJSON or KML")
+    parser.add_argument("path", help="GeoJSON (.geojson/.json) or KML file")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, help="default: from the extension")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument("--analyze", action="store_true", help="run depth analysis for every imported site")
+    parser.add_argument("--dem", default="COP", help="COP, SRTMGL1, USGS or OneMeterDem")
+    parser.add_argument("--workers", type=int, default=ANALYSIS_WORKERS)
+    parser.add_argument("--mongo-uri", default=os.environ.get(
+        "MONGO_URI", "mongodb://localhost:27017/QuarryDepthFinder"))
+    args = parser.parse_args(argv)
+
+    from pymongo import MongoClient
+
+    database = MongoClient(args.mongo_uri).get_default_database()
+    with open(args.path, "rb") as f:
+        fmt = args.format or detect_format(args.path, f.read(64))
+        f.seek(0)
+        report, sites = import_sites(database.Boundaries, f, fmt, os.path.basename(args.path),
+                                     batch_size=args.batch_size)
+    print(json.dumps({key: value for key, value in report.items() if key != "errors"}, indent=2))
+    for error in report["errors"]:
+        print(f"⚠️ {error}")
+
+    if args.analyze and sites:
+        from analysis_store import get_recorder, record_analysis
+
+        mongo = SimpleNamespace(db=database)
+        status = AnalysisJob(sites, args.dem, args.workers,
+                             lambda dem_file, stats, data: record_analysis(mongo, dem_file, stats, data)).run()
+        get_recorder(mongo).flush()
+        print(json.dumps({key: value for key, value in status.items() if key != "errors"}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,492 @@
+import argparse
+import hashlib
+import os
+import threading
+from collections import defaultdict
+
+import numpy as np
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure, WriteError
+
+SITES_PAGE_SIZE = 50
+MAX_SITES_PAGE_SIZE = 500
+# List previews are simplified to this fraction of the site's extent and
+# at most this many vertices
+PREVIEW_TOLERANCE = 0.01
+PREVIEW_MAX_POINTS = 32
+POLYLINE_PRECISION = 5
+# Bump when the listing format changes, so cached ETags stop matching
+SITES_LIST_VERSION = 1
+
+LIST_PROJECTION = {"sitename": 1, "date": 1, "preview": 1}
+GEOMETRY_FORMATS = ("polyline", "simplified", "none")
+# Viewport queries return at most this many sites (closest to the newest)
+WITHIN_LIMIT = 500
+MAX_WITHIN_LIMIT = 2000
+# Cell size of the local fallback index, in degrees
+LOCAL_INDEX_CELL = 0.5
+MIGRATION_BATCH_SIZE = 500
+# "Can't extract geo keys": MongoDB refused a polygon for the 2dsphere index
+GEO_EXTRACT_ERROR = 16755
+
+_indexed = set()
+_indexed_lock = threading.Lock()
+
+
+def ensure_site_indexes(collection):
+    """
+    (userId, _id) index for the newest-first sidebar listing and the
+    2dsphere index for viewport queries; created once per process
+    """
+    key = (collection.database.name, collection.name)
+    with _indexed_lock:
+        if key in _indexed:
+            return
+        collection.create_index([("userId", ASCENDING), ("_id", DESCENDING)], name="user_id")
+        # Sites without a geometry (not yet migrated) are simply not indexed
+        collection.create_index([("geometry", GEOSPHERE)], name="geometry_2dsphere")
+        _indexed.add(key)
+
+
+def site_points(coords):
+    """
+    Boundary vertices as an (N, 2) float array of (lat, lng). Accepts both
+    stored shapes: [{"lat": .., "lng": ..}, ...] and [[lat, lng], ...]
+    (the map saves the latter with string values).
+    """
+    points = [(point["lat"], point["lng"]) if isinstance(point, dict) else point[:2]
+              for point in coords or []]
+    return np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+
+def simplify_boundary(points, tolerance=PREVIEW_TOLERANCE, max_points=PREVIEW_MAX_POINTS):
+    """
+    Douglas-Peucker simplified ring for list views. The tolerance is
+    relative to the site's extent and doubles until the ring fits
+    max_points.
+    """
+    from contour_service import simplify_line
+
+    if len(points) <= 4:
+        return points
+    extent = float(np.max(np.ptp(points, axis=0))) or 1e-9
+    absolute = tolerance * extent
+    ring = np.vstack([points, points[:1]])
+    simplified = simplify_line(ring, absolute)
+    while len(simplified) - 1 > max_points:
+        absolute *= 2
+        simplified = simplify_line(ring, absolute)
+    return simplified[:-1]
+
+
+def encode_polyline(points, precision=POLYLINE_PRECISION):
+    """Google encoded-polyline string of (lat, lng) points"""
+    factor = 10 ** precision
+    values = np.round(np.asarray(points) * factor).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+
+    chunks = []
+    for delta in deltas.tolist():
+        value = ~(delta << 1) if delta < 0 else delta << 1
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return "".join(chunks)
+
+
+def decode_polyline(text, precision=POLYLINE_PRECISION):
+    """Inverse of encode_polyline, as a list of [lat, lng]"""
+    values, current, shift = [], 0, 0
+    for char in text:
+        byte = ord(char) - 63
+        current |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(current >> 1) if current & 1 else current >> 1)
+            current, shift = 0, 0
+    coords = np.cumsum(np.asarray(values, dtype=np.int64).reshape(-1, 2), axis=0) / 10 ** precision
+    return coords.tolist()
+
+
+def site_preview(coords):
+    """Stored list-view geometry: simplified ring as an encoded polyline plus its bbox"""
+    points = site_points(coords)
+    if len(points) == 0:
+        return None
+    simplified = simplify_boundary(points)
+    return {
+        "polyline": encode_polyline(simplified),
+        "bbox": [float(points[:, 1].min()), float(points[:, 0].min()),
+                 float(points[:, 1].max()), float(points[:, 0].max())],
+        "points": len(points),
+    }
+
+
+def _segments_cross(ring):
+    """True if any two non-adjacent edges of a closed ring intersect"""
+    starts, ends = ring[:-1], ring[1:]
+    count = len(starts)
+    if count < 4:
+        return False
+
+    def orientation(a, b, c):
+        return np.sign((b[..., 0] - a[..., 0]) * (c[..., 1] - a[..., 1]) -
+                       (b[..., 1] - a[..., 1]) * (c[..., 0] - a[..., 0]))
+
+    i, j = np.triu_indices(count, k=2)
+    # The first and last edges share the closing vertex
+    keep = ~((i == 0) & (j == count - 1))
+    i, j = i[keep], j[keep]
+    a, b, c, d = starts[i], ends[i], starts[j], ends[j]
+    return bool(np.any((orientation(a, b, c) != orientation(a, b, d)) &
+                       (orientation(c, d, a) != orientation(c, d, b))))
+
+
+def _convex_hull(points):
+    """Monotone-chain convex hull of (x, y) points, counter-clockwise"""
+    points = sorted(set(map(tuple, points)))
+    if len(points) < 3:
+        return np.asarray(points)
+
+    def half(sequence):
+        hull = []
+        for point in sequence:
+            while len(hull) >= 2 and ((hull[-1][0] - hull[-2][0]) * (point[1] - hull[-2][1]) -
+                                      (hull[-1][1] - hull[-2][1]) * (point[0] - hull[-2][0])) <= 0:
+                hull.pop()
+            hull.append(point)
+        return hull[:-1]
+
+    return np.asarray(half(points) + half(reversed(points)))
+
+
+def boundary_geometry(coords):
+    """
+    GeoJSON Polygon ([lng, lat] order, closed ring) of a saved boundary for
+    the 2dsphere index. MongoDB rejects self-intersecting rings, so those
+    are stored as their convex hull and flagged approximate.
+    Returns (geometry, approximate) or (None, False) for degenerate input.
+    """
+    points = site_points(coords)[:, ::-1]
+    if len(points):
+        # Drop repeated vertices, including an explicit closing vertex
+        distinct = np.any(np.diff(points, axis=0, append=points[:1]) != 0, axis=1)
+        points = points[distinct]
+    if len(np.unique(points, axis=0)) < 3:
+        return None, False
+
+    # Collinear points have no hull (a bowtie's signed area can also be 0,
+    # so the hull is the test for "encloses nothing")
+    hull = _convex_hull(points)
+    if len(hull) < 3:
+        return None, False
+    ring = np.vstack([points, points[:1]])
+    approximate = _segments_cross(ring)
+    if approximate:
+        ring = np.vstack([hull, hull[:1]])
+    return {"type": "Polygon", "coordinates": [ring.tolist()]}, approximate
+
+
+def site_spatial_fields(coords):
+    """Derived fields stored with every boundary: list preview and GeoJSON geometry"""
+    geometry, approximate = boundary_geometry(coords)
+    fields = {"preview": site_preview(coords), "geometry": geometry}
+    if approximate:
+        fields["geometryApproximate"] = True
+    return fields
+
+
+def insert_site(collection, document):
+    """
+    Insert a boundary with its derived preview and geometry. If the
+    2dsphere index still rejects the polygon, the site is saved without
+    geometry rather than lost.
+    """
+    document.update(site_spatial_fields(document.get("coords")))
+    try:
+        return collection.insert_one(document)
+    except WriteError as e:
+        if e.code != GEO_EXTRACT_ERROR:
+            raise
+        print(f"⚠️ Saving site without geometry: {e}")
+        document.pop("_id", None)
+        document["geometry"] = None
+        return collection.insert_one(document)
+
+
+def backfill_previews(collection, documents):
+    """Compute and store the preview of sites saved before previews existed"""
+    missing = [document["_id"] for document in documents if not document.get("preview")]
+    if not missing:
+        return
+    previews = {}
+    for document in collection.find({"_id": {"$in": missing}}, {"coords": 1}):
+        previews[document["_id"]] = site_preview(document.get("coords"))
+    updates = [UpdateOne({"_id": site_id}, {"$set": {"preview": preview}})
+               for site_id, preview in previews.items() if preview]
+    if updates:
+        collection.bulk_write(updates, ordered=False)
+        print(f"🗺️ Backfilled {len(updates)} site previews")
+    for document in documents:
+        if not document.get("preview"):
+            document["preview"] = previews.get(document["_id"])
+
+
+def page_query(user_id, before=None):
+    query = {"userId": user_id}
+    if before:
+        if not ObjectId.is_valid(before):
+            raise ValueError("Invalid cursor")
+        query["_id"] = {"$lt": ObjectId(before)}
+    return query
+
+
+def sites_page_etag(collection, user_id=1, limit=SITES_PAGE_SIZE, before=None, geometry="polyline"):
+    """
+    Validator for one page: the page's ids, read from the (userId, _id)
+    index only. Site documents are immutable apart from their derived
+    preview, so the same ids mean the same response.
+    """
+    ids = collection.find(page_query(user_id, before), {"_id": 1}) \
+        .sort("_id", DESCENDING).limit(limit + 1)
+    digest = hashlib.sha1(f"{SITES_LIST_VERSION}:{geometry}:{limit}:{before}".encode())
+    for document in ids:
+        digest.update(document["_id"].binary)
+    return digest.hexdigest()
+
+
+def sites_page(collection, user_id=1, limit=SITES_PAGE_SIZE, before=None, geometry="polyline"):
+    """
+    Newest-first page of saved sites without their full coordinates.
+    geometry: "polyline" (encoded simplified ring), "simplified" ([lat, lng]
+    list of the same ring) or "none". Pass the returned `next` as `before`.
+    """
+    if geometry not in GEOMETRY_FORMATS:
+        raise ValueError(f"Unknown geometry format {geometry}, choose from {list(GEOMETRY_FORMATS)}")
+
+    projection = dict(LIST_PROJECTION)
+    if geometry == "none":
+        projection.pop("preview")
+    documents = list(collection.find(page_query(user_id, before), projection)
+                     .sort("_id", DESCENDING).limit(limit + 1))
+    has_more = len(documents) > limit
+    documents = documents[:limit]
+    if geometry != "none":
+        backfill_previews(collection, documents)
+
+    sites = []
+    for document in documents:
+        site = {
+            "id": str(document["_id"]),
+            "name": document.get("sitename", "Unnamed Site"),
+            # Handle cases where 'date' might not exist in old records
+            "date": document.get("date", "Unknown Date"),
+        }
+        preview = document.get("preview")
+        if preview and geometry != "none":
+            site["bbox"] = preview["bbox"]
+            if geometry == "polyline":
+                site["polyline"] = preview["polyline"]
+            else:
+                site["coords"] = decode_polyline(preview["polyline"])
+        sites.append(site)
+
+    return {"sites": sites, "next": str(documents[-1]["_id"]) if has_more else None}
+
+
+def page_limit(value):
+    return max(1, min(int(value), MAX_SITES_PAGE_SIZE))
+
+
+def parse_bbox(text):
+    """'west,south,east,north' in degrees, validated"""
+    try:
+        west, south, east, north = (float(value) for value in text.split(","))
+    except (AttributeError, ValueError):
+        raise ValueError("bbox must be 'west,south,east,north'")
+    if not (-90 <= south < north <= 90) or not (-180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError("bbox is outside the valid longitude/latitude range")
+    return west, south, east, north
+
+
+def bbox_polygon(west, south, east, north):
+    return {"type": "Polygon", "coordinates": [[
+        [west, south], [east, south], [east, north], [west, north], [west, south]]]}
+
+
+def _bbox_query(west, south, east, north):
+    """Query on the 2dsphere index; viewports spanning 180°+ of longitude match everything"""
+    if east < west:
+        # Viewport across the antimeridian: one polygon per side
+        return {"$or": [_bbox_query(west, south, 180.0, north), _bbox_query(-180.0, south, east, north)]}
+    if east - west >= 180:
+        return {"geometry": {"$ne": None}}
+    return {"geometry": {"$geoIntersects": {"$geometry": bbox_polygon(west, south, east, north)}}}
+
+
+class LocalSiteIndex:
+    """
+    In-process grid index over site bounding boxes, used when the database
+    cannot run $geoIntersects (mongomock in tests, or a server without the
+    2dsphere index). Rebuilt from the stored previews whenever the number
+    of sites changes.
+    """
+
+    def __init__(self, cell=LOCAL_INDEX_CELL):
+        self.cell = cell
+        self.cells = defaultdict(set)
+        self.bboxes = {}
+        self.count = None
+        self.lock = threading.Lock()
+
+    def _cells(self, west, south, east, north):
+        x0, x1 = int(np.floor(west / self.cell)), int(np.floor(east / self.cell))
+        y0, y1 = int(np.floor(south / self.cell)), int(np.floor(north / self.cell))
+        return ((x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1))
+
+    def rebuild(self, collection, user_id=1):
+        cells, bboxes = defaultdict(set), {}
+        query = {"userId": user_id}
+        documents = list(collection.find(query, {"preview.bbox": 1}))
+        backfill_previews(collection, documents)
+        for document in documents:
+            bbox = (document.get("preview") or {}).get("bbox")
+            if not bbox:
+                continue
+            bboxes[document["_id"]] = bbox
+            for key in self._cells(*bbox):
+                cells[key].add(document["_id"])
+        self.cells, self.bboxes, self.count = cells, bboxes, len(documents)
+
+    def query(self, collection, west, south, east, north, user_id=1):
+        """Ids of sites whose bbox intersects the viewport, newest first"""
+        # A box across the antimeridian is split before taking the lock
+        # (which is not reentrant)
+        if east < west:
+            return sorted(set(self.query(collection, west, south, 180.0, north, user_id)) |
+                          set(self.query(collection, -180.0, south, east, north, user_id)),
+                          reverse=True)
+        with self.lock:
+            count = collection.count_documents({"userId": user_id})
+            if count != self.count:
+                self.rebuild(collection, user_id)
+            candidates = set()
+            if (east - west) * (north - south) / self.cell ** 2 > len(self.cells):
+                candidates = set(self.bboxes)
+            else:
+                for key in self._cells(west, south, east, north):
+                    candidates |= self.cells.get(key, set())
+            hits = [site_id for site_id in candidates
+                    if self.bboxes[site_id][0] <= east and self.bboxes[site_id][2] >= west
+                    and self.bboxes[site_id][1] <= north and self.bboxes[site_id][3] >= south]
+            return sorted(hits, reverse=True)
+
+
+local_site_index = LocalSiteIndex()
+_geo_query_supported = {}
+
+
+def sites_within(collection, west, south, east, north, user_id=1, limit=WITHIN_LIMIT):
+    """
+    Sites intersecting a viewport with their list preview (encoded
+    outline and bbox). Uses the 2dsphere index, or the local grid index
+    where the database cannot answer geo queries.
+    """
+    key = (collection.database.name, collection.name)
+    documents = None
+    if _geo_query_supported.get(key, True):
+        query = {"userId": user_id, **_bbox_query(west, south, east, north)}
+        try:
+            documents = list(collection.find(query, LIST_PROJECTION)
+                             .sort("_id", DESCENDING).limit(limit + 1))
+            _geo_query_supported[key] = True
+        except (NotImplementedError, OperationFailure) as e:
+            print(f"⚠️ Geo query unavailable, using the local site index: {e}")
+            _geo_query_supported[key] = False
+
+    if documents is None:
+        ids = local_site_index.query(collection, west, south, east, north, user_id)[:limit + 1]
+        by_id = {document["_id"]: document
+                 for document in collection.find({"_id": {"$in": ids}}, LIST_PROJECTION)}
+        documents = [by_id[site_id] for site_id in ids if site_id in by_id]
+
+    truncated = len(documents) > limit
+    documents = documents[:limit]
+    backfill_previews(collection, documents)
+    sites = [{
+        "id": str(document["_id"]),
+        "name": document.get("sitename", "Unnamed Site"),
+        "date": document.get("date", "Unknown Date"),
+        "polyline": (document.get("preview") or {}).get("polyline"),
+        "bbox": (document.get("preview") or {}).get("bbox"),
+    } for document in documents]
+    return {"sites": sites, "truncated": truncated}
+
+
+def migrate_site_geometry(collection, batch_size=MIGRATION_BATCH_SIZE):
+    """
+    Add GeoJSON geometry (and the list preview) to boundaries saved as
+    {lat, lng} lists, in bulk batches, then build the indexes. Safe to
+    re-run: only documents without a geometry are touched. Returns the
+    number of migrated documents.
+    """
+    migrated, skipped = 0, 0
+    query = {"geometry": {"$exists": False}, "coords": {"$exists": True}}
+    while True:
+        batch = list(collection.find(query, {"coords": 1}).limit(batch_size))
+        if not batch:
+            break
+        updates = []
+        for document in batch:
+            fields = site_spatial_fields(document.get("coords"))
+            if fields["geometry"] is None:
+                # Degenerate boundary: mark it so the query skips it next time
+                skipped += 1
+            updates.append(UpdateOne({"_id": document["_id"]}, {"$set": fields}))
+        try:
+            collection.bulk_write(updates, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            failed = [error for error in errors if error.get("code") != GEO_EXTRACT_ERROR]
+            if failed:
+                raise
+            # Polygons the 2dsphere index refuses keep their preview without
+            # geometry, so the next batch does not select them again
+            print(f"⚠️ Migrating {len(errors)} boundaries without geometry: rejected by the 2dsphere index")
+            collection.bulk_write([UpdateOne({"_id": batch[error["index"]]["_id"]},
+                                             {"$set": {**site_spatial_fields(batch[error["index"]].get("coords")),
+                                                       "geometry": None}})
+                                   for error in errors], ordered=False)
+            skipped += len(errors)
+        migrated += len(updates)
+        print(f"🗺️ Migrated {migrated} boundaries...")
+
+    _indexed.discard((collection.database.name, collection.name))
+    ensure_site_indexes(collection)
+    print(f"✅ Boundary migration done: {migrated} documents ({skipped} without a valid polygon)")
+    return migrated
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Saved-site maintenance")
+    parser.add_argument("--migrate", action="store_true",
+                        help="add GeoJSON geometry and previews to existing boundaries")
+    parser.add_argument("--mongo-uri", default=os.environ.get(
+        "MONGO_URI", "mongodb://localhost:27017/QuarryDepthFinder"))
+    args = parser.parse_args(argv)
+
+    if not args.migrate:
+        parser.print_help()
+        return 0
+
+    from pymongo import MongoClient
+
+    client = MongoClient(args.mongo_uri)
+    migrate_site_geometry(client.get_default_database().Boundaries)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
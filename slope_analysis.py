@@ -1,41 +1,74 @@
 import numpy as np
 import rasterio
 import matplotlib.pyplot as plt
+from rasterio import features
+from scipy import ndimage
 
+from geodesy import pixel_area_m2, pixel_size_m, transform_geometry, transform_points
+from precision import ACCUMULATOR_DTYPE, read_elevation
+from result_cache import memoize_analysis
+
+# Stability classes as (name, lower bound in degrees). A pixel belongs to the
+# last class whose lower bound it reaches.
+STABILITY_CLASSES = [
+    ('bench', 0.0),
+    ('moderate', 15.0),
+    ('steep', 35.0),
+    ('highwall', 60.0),
+]
+
+@memoize_analysis("slope")
 def calculate_slope_simple(dem_file):
     """
     Simplified slope calculation for route integration
     """
     try:
         with rasterio.open(dem_file) as src:
-            dem_data = src.read(1)
+            dem_data = read_elevation(src)
             transform = src.transform
-            
-        dem_data = dem_data.astype(np.float32)
-        dem_data[dem_data == src.nodata] = np.nan
-        
-        # Calculate slope
-        x_resolution = transform[0]
-        y_resolution = abs(transform[4])
-        
-        grad_x, grad_y = np.gradient(dem_data, x_resolution, y_resolution)
-        slope_radians = np.arctan(np.sqrt(grad_x**2 + grad_y**2))
-        slope_degrees = np.degrees(slope_radians)
-        
-        # Basic statistics
-        slope_stats = {
-            'average': float(np.nanmean(slope_degrees)),
-            'max': float(np.nanmax(slope_degrees)),
-            'min': float(np.nanmin(slope_degrees)),
-            'std': float(np.nanstd(slope_degrees))
-        }
+            crs = src.crs
         
-        return slope_degrees, slope_stats
+        return slope_from_dem(dem_data, transform, crs)
         
     except Exception as e:
         print(f"Error in calculate_slope_simple: {e}")
         raise e
 
+def slope_from_dem(dem_data, transform, crs=None):
+    """
+    Slope in degrees and its basic statistics for an elevation array.
+    Pixel spacing is in metres, per row for geographic rasters.
+    """
+    x_resolution, y_resolution = pixel_size_m(transform, crs, dem_data.shape[0])
+    
+    # Gradients keep the DEM's dtype; the slope is built in grad_x's buffer
+    if np.ndim(x_resolution) == 0:
+        grad_y, grad_x = np.gradient(dem_data, y_resolution, x_resolution)
+    else:
+        # Degree grids: pixel width shrinks with latitude, so divide per row
+        grad_y, grad_x = np.gradient(dem_data)
+        grad_y /= y_resolution[:, None].astype(grad_y.dtype)
+        grad_x /= x_resolution[:, None].astype(grad_x.dtype)
+    slope_degrees = np.hypot(grad_x, grad_y, out=grad_x)
+    del grad_y
+    np.arctan(slope_degrees, out=slope_degrees)
+    np.degrees(slope_degrees, out=slope_degrees)
+    
+    # Basic statistics, accumulated in float64 over the valid pixels only
+    # (nanmean/nanstd would copy the raster to zero out the NaNs)
+    valid = ~np.isnan(slope_degrees)
+    if valid.any():
+        slope_stats = {
+            'average': float(np.mean(slope_degrees, where=valid, dtype=ACCUMULATOR_DTYPE)),
+            'max': float(np.max(slope_degrees, where=valid, initial=-np.inf)),
+            'min': float(np.min(slope_degrees, where=valid, initial=np.inf)),
+            'std': float(np.std(slope_degrees, where=valid, dtype=ACCUMULATOR_DTYPE))
+        }
+    else:
+        slope_stats = {'average': np.nan, 'max': np.nan, 'min': np.nan, 'std': np.nan}
+    
+    return slope_degrees, slope_stats
+
 def generate_slope_map(slope_data, output_path):
     """
     Generate slope visualization map
@@ -81,4 +114,149 @@ def get_slope_profile(slope_data, start_point, end_point):
         'slope': profile_slopes.tolist(),
         'start_point': start_point,
         'end_point': end_point
-    }
\ No newline at end of file
+    }
+
+def classify_stability_zones(slope_degrees, dem_data, transform, crs=None,
+                             classes=STABILITY_CLASSES, min_pixels=4):
+    """
+    Threshold a slope raster into stability classes and measure every
+    contiguous zone (area, mean/max slope, height, width, centroid).
+    Returns a GeoJSON FeatureCollection in EPSG:4326.
+    """
+    bounds = np.array([lower for _, lower in classes], dtype=np.float32)
+    valid = ~np.isnan(slope_degrees) & ~np.isnan(dem_data)
+
+    # Class index per pixel (0 = no data, 1..N = classes)
+    class_map = np.zeros(slope_degrees.shape, dtype=np.int32)
+    class_map[valid] = np.searchsorted(bounds, slope_degrees[valid], side='right')
+
+    # Label each class separately and offset into one global label image
+    labels = np.zeros(slope_degrees.shape, dtype=np.int32)
+    zone_class = [0]
+    offset = 0
+    for class_index in range(1, len(classes) + 1):
+        class_labels, count = ndimage.label(class_map == class_index)
+        if count == 0:
+            continue
+        in_class = class_labels > 0
+        labels[in_class] = class_labels[in_class] + offset
+        zone_class.extend([class_index] * count)
+        offset += count
+
+    if offset == 0:
+        return {'type': 'FeatureCollection', 'features': [], 'summary': {}}
+
+    # Drop speckle zones with a lookup table instead of a per-zone loop
+    counts = np.bincount(labels.ravel(), minlength=offset + 1)
+    keep = counts >= min_pixels
+    keep[0] = False
+    relabel = np.zeros(offset + 1, dtype=np.int32)
+    relabel[keep] = np.arange(1, np.count_nonzero(keep) + 1)
+    labels = relabel[labels]
+    zone_class = np.asarray(zone_class)[keep]
+    n_zones = len(zone_class)
+
+    if n_zones == 0:
+        return {'type': 'FeatureCollection', 'features': [], 'summary': {}}
+
+    # Single labelled-reduction pass over all zones
+    flat_labels = labels.ravel()
+    slope_flat = np.where(valid, slope_degrees, 0).ravel()
+    rows, cols = np.indices(labels.shape)
+    pixel_count = np.bincount(flat_labels, minlength=n_zones + 1)[1:]
+    slope_sum = np.bincount(flat_labels, weights=slope_flat, minlength=n_zones + 1)[1:]
+    row_sum = np.bincount(flat_labels, weights=rows.ravel(), minlength=n_zones + 1)[1:]
+    col_sum = np.bincount(flat_labels, weights=cols.ravel(), minlength=n_zones + 1)[1:]
+
+    # Unbuffered ufunc.at keeps the per-zone extrema sort-free
+    # (output dtype must match the input or numpy falls back to a slow path)
+    in_zone = flat_labels > 0
+    zone_index = flat_labels[in_zone] - 1
+    zone_slopes = slope_flat[in_zone]
+    zone_elevations = dem_data.ravel()[in_zone]
+    slope_max = np.full(n_zones, -np.inf, dtype=zone_slopes.dtype)
+    elev_min = np.full(n_zones, np.inf, dtype=zone_elevations.dtype)
+    elev_max = np.full(n_zones, -np.inf, dtype=zone_elevations.dtype)
+    np.maximum.at(slope_max, zone_index, zone_slopes)
+    np.minimum.at(elev_min, zone_index, zone_elevations)
+    np.maximum.at(elev_max, zone_index, zone_elevations)
+
+    # Widest inscribed span (distance to the zone edge), flags narrow benches
+    interior = labels > 0
+    interior[:-1] &= labels[:-1] == labels[1:]
+    interior[1:] &= labels[1:] == labels[:-1]
+    interior[:, :-1] &= labels[:, :-1] == labels[:, 1:]
+    interior[:, 1:] &= labels[:, 1:] == labels[:, :-1]
+    interior[[0, -1], :] = False
+    interior[:, [0, -1]] = False
+    edge_distance = ndimage.distance_transform_edt(interior).ravel()
+    half_width = np.zeros(n_zones)
+    np.maximum.at(half_width, zone_index, edge_distance[in_zone])
+
+    # Ground sizes in metres; geographic rasters vary by row, so zones
+    # sum their rows' pixel areas and take the width at their centroid
+    x_size, _ = pixel_size_m(transform, crs, labels.shape[0])
+    pixel_area = pixel_area_m2(transform, crs, labels.shape[0])
+    if np.ndim(pixel_area) == 0:
+        zone_area = pixel_count * pixel_area
+    else:
+        zone_area = np.bincount(flat_labels, weights=pixel_area[rows.ravel()], minlength=n_zones + 1)[1:]
+    centroid_rows = row_sum / pixel_count + 0.5
+    centroid_cols = col_sum / pixel_count + 0.5
+    centroid_x = transform[2] + centroid_cols * transform[0] + centroid_rows * transform[1]
+    centroid_y = transform[5] + centroid_cols * transform[3] + centroid_rows * transform[4]
+
+    if np.ndim(x_size) != 0:
+        x_size = x_size[np.clip(centroid_rows.astype(int), 0, labels.shape[0] - 1)]
+    width = (2 * half_width + 1) * x_size
+
+    zone_stats = {
+        'area_m2': zone_area,
+        'mean_slope': slope_sum / pixel_count,
+        'max_slope': slope_max,
+        'height_m': elev_max - elev_min,
+        'width_m': width,
+    }
+
+    geographic = crs is None or crs.is_geographic
+    if not geographic:
+        centroid_x, centroid_y = transform_points(crs, 'EPSG:4326', centroid_x, centroid_y)
+
+    feature_list = []
+    for geom, value in features.shapes(labels, mask=labels > 0, transform=transform):
+        zone = int(value) - 1
+        if not geographic:
+            geom = transform_geometry(crs, 'EPSG:4326', geom)
+        properties = {
+            'zone_id': zone + 1,
+            'stability_class': classes[zone_class[zone] - 1][0],
+            'centroid': [float(centroid_x[zone]), float(centroid_y[zone])],
+        }
+        properties.update({key: float(values[zone]) for key, values in zone_stats.items()})
+        feature_list.append({'type': 'Feature', 'geometry': geom, 'properties': properties})
+
+    summary = {}
+    for class_index, (name, _) in enumerate(classes, start=1):
+        in_class = zone_class == class_index
+        summary[name] = {
+            'zones': int(np.count_nonzero(in_class)),
+            'area_m2': float(zone_stats['area_m2'][in_class].sum()),
+        }
+
+    return {'type': 'FeatureCollection', 'features': feature_list, 'summary': summary}
+
+@memoize_analysis("stability_zones")
+def analyze_stability_zones(dem_file, classes=STABILITY_CLASSES, min_pixels=4):
+    """
+    Slope stability zones for a DEM file as GeoJSON
+    """
+    with rasterio.open(dem_file) as src:
+        dem_data = read_elevation(src)
+        transform = src.transform
+        crs = src.crs
+
+    slope_degrees, slope_stats = calculate_slope_simple(dem_file)
+    zones = classify_stability_zones(slope_degrees, dem_data, transform, crs,
+                                     classes=classes, min_pixels=min_pixels)
+    zones['slope_stats'] = slope_stats
+    return zones
@@ -187,6 +187,7 @@ function getHeatMap(dataToSend) {
 			// Display REAL data immediately from API response
 			if (data.status === 'success') {
 				showRealTimeResults(data);
+				showAnalysisTiles();
 			}
 
 			// Also load the elevation image
@@ -218,6 +219,65 @@ function getHeatMap(dataToSend) {
 		});
 }
 
+// NOTE: Depth / slope / hillshade / elevation overlays rendered as XYZ tiles
+// by the server, so only the tiles in view are fetched at each zoom level
+var analysisTileLayers = {};
+var analysisLayerControl = null;
+
+function showAnalysisTiles() {
+	// New analysis rewrites the raster, so bust the browser cache per run
+	const version = new Date().getTime();
+	const layerNames = {
+		depth: '⛏️ Depth',
+		slope: '🏔️ Slope',
+		hillshade: '🌗 Hillshade',
+		elevation: '📍 Elevation'
+	};
+
+	Object.values(analysisTileLayers).forEach(layer => map.removeLayer(layer));
+	if (analysisLayerControl) {
+		map.removeControl(analysisLayerControl);
+	}
+
+	const overlays = {};
+	Object.keys(layerNames).forEach(name => {
+		analysisTileLayers[name] = L.tileLayer(`/tiles/${name}/{z}/{x}/{y}.png?v=${version}`, {
+			opacity: 0.7,
+			maxZoom: 20,
+			pane: 'overlayPane'
+		});
+		overlays[layerNames[name]] = analysisTileLayers[name];
+	});
+
+	analysisTileLayers.depth.addTo(map);
+	analysisLayerControl = L.control.layers(null, overlays, { collapsed: true }).addTo(map);
+
+	showDepthContours(5);
+}
+
+// NOTE: Vector depth contours so they can be toggled, styled and clicked
+function showDepthContours(interval) {
+	fetch(`/api/contours?layer=depth&interval=${interval}`)
+		.then(response => response.json())
+		.then(geojson => {
+			if (geojson.status === 'error') throw new Error(geojson.message);
+
+			const contourLayer = L.geoJSON(geojson, {
+				style: { color: '#2c3e50', weight: 1, opacity: 0.8 },
+				onEachFeature: (feature, layer) => {
+					layer.bindTooltip(`${feature.properties.level.toFixed(0)} m deep`, { sticky: true });
+				}
+			});
+
+			analysisTileLayers.contours = contourLayer;
+			contourLayer.addTo(map);
+			if (analysisLayerControl) {
+				analysisLayerControl.addOverlay(contourLayer, `〰️ Depth contours (${interval} m)`);
+			}
+		})
+		.catch(err => console.error('Contour fetch error:', err));
+}
+
 // ✅ UPDATED: Show real-time results with new color scheme
 function showRealTimeResults(data) {
 	// Safely extract values with fallbacks
@@ -276,6 +336,8 @@ function getDepthAnalysis(dataToSend) {
 			addTerminalMessage("Depth analysis completed successfully", 'success');
 
 			if (data.status === 'success') {
+				// Reports are built from the stored analysis
+				window.lastAnalysisId = data.analysis_id || null;
 				// Display depth analysis results
 				displayDepthResults(data.depth_stats, data.visualization);
 			} else {
@@ -549,6 +611,7 @@ map.on(L.Draw.Event.CREATED, function (e) {
 		drawnItems.addLayer(layer);
 
 		coords = layer.getLatLngs()[0];  // Save coordinates
+		window.currentSite = null;  // A new drawing is not a saved site
 
 		console.log('Polygon created with coordinates:', coords);
 		addTerminalMessage(`Polygon created with ${coords.length} points`);
@@ -611,7 +674,10 @@ map.on(L.Draw.Event.CREATED, function (e) {
 			dem: "COP",
 			coords: coords,
 			bbox: bbox,
-			reference_point: { lat: refLat, lng: refLng }
+			reference_point: { lat: refLat, lng: refLng },
+			// Analyses of a saved site are stored in its history
+			site_id: window.currentSite ? window.currentSite.id : null,
+			sitename: window.currentSite ? window.currentSite.name : null
 		};
 
 		// Start the analysis process
@@ -884,21 +950,51 @@ document.addEventListener('DOMContentLoaded', function () {
 		processBtn.disabled = true;
 		appendLog("🚀 Starting upload & analysis...");
 
-		// B. Prepare Data
-		const formData = new FormData();
-		formData.append('file', file);
+		// B. Prepare Data: the raw file as the body, so the server streams
+		// it to disk and can refuse a bad GeoTIFF after the first blocks
+		const params = new URLSearchParams({ filename: file.name });
+		if (window.currentSite) {
+			params.set('site_id', window.currentSite.id);
+			params.set('sitename', window.currentSite.name);
+		}
 
 		try {
-			// C. Send to Backend
-			const response = await fetch('/api/upload_dem', {
-				method: 'POST',
-				body: formData
-			});
+			// C. Send to Backend. Files the server already stores (same
+			// SHA-1) are analysed without sending the bytes again
+			let response = null;
+			const digest = await sha1Hex(file);
+			if (digest) {
+				params.set('sha1', digest);
+				response = await fetch(`/api/upload_dem?${params}`, { method: 'POST' });
+				if (response.status === 404) {
+					response = null;
+				} else {
+					appendLog("♻️ This file was uploaded before, reusing it");
+				}
+				params.delete('sha1');
+			}
+			if (!response) {
+				response = await fetch(`/api/upload_dem?${params}`, {
+					method: 'POST',
+					headers: { 'Content-Type': 'image/tiff' },
+					body: file
+				});
+			}
 
-			const data = await response.json();
+			let data = await response.json();
+
+			if (data.status === 'success' && data.preview) {
+				appendLog(`⚡ Preview from overviews (1/${data.depth_stats.preview_factor} resolution): ` +
+					`max depth ${data.depth_stats.max_depth.toFixed(2)} m`);
+				appendLog("⏳ Full-resolution analysis running...");
+				processBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Analysing...';
+				data = await waitForUpload(data.job_url);
+			}
+			(data.warnings || []).forEach(warning => appendLog(`⚠️ ${warning}`));
 
 			if (data.status === 'success') {
 				appendLog("✅ Analysis Complete!");
+				if (data.analysis_id) window.lastAnalysisId = data.analysis_id;
 
 				// D. Update Stats (Metric Cards)
 				// We use generic IDs so this works with the new layout
@@ -909,7 +1005,7 @@ document.addEventListener('DOMContentLoaded', function () {
 				if (document.getElementById('metric-area'))
 					document.getElementById('metric-area').innerText = (data.depth_stats.total_area_m2 / 10000).toFixed(2) + ' ha';
 				if (document.getElementById('metric-elev'))
-					document.getElementById('metric-elev').innerText = data.depth_stats.min_elevation.toFixed(1) + ' m';
+					document.getElementById('metric-elev').innerText = data.depth_stats.quarry_bottom_elevation.toFixed(1) + ' m';
 
 				// E. Show Heatmap & ENABLE ZOOM
 				const imgContainer = document.getElementById('img_container');
@@ -955,6 +1051,25 @@ document.addEventListener('DOMContentLoaded', function () {
 		}
 	}
 
+	// SHA-1 of a file for the re-upload check; skipped for files too big
+	// to hash comfortably in the browser (the server hashes those anyway)
+	async function sha1Hex(file) {
+		if (!window.crypto || !crypto.subtle || file.size > 512 * 1024 * 1024) return null;
+		const hash = await crypto.subtle.digest('SHA-1', await file.arrayBuffer());
+		return Array.from(new Uint8Array(hash), byte => byte.toString(16).padStart(2, '0')).join('');
+	}
+
+	// Poll a large upload's background analysis until it finishes
+	async function waitForUpload(jobUrl) {
+		while (true) {
+			await new Promise(resolve => setTimeout(resolve, 2000));
+			const job = (await (await fetch(jobUrl)).json()).upload;
+			if (!job) return { status: 'error', message: 'Upload job not found' };
+			if (job.state === 'finished') return { status: 'success', ...job.result };
+			if (job.state === 'failed') return { status: 'error', message: job.error };
+		}
+	}
+
 	// Helper: Safely append log messages without breaking existing logs
 	function appendLog(msg) {
 		const terminal = document.getElementById('terminal_output');
@@ -989,17 +1104,25 @@ document.addEventListener('DOMContentLoaded', function () {
 	fetchSavedSites();
 
 	// 2. Function to Fetch & Render
-	async function fetchSavedSites() {
+	// The list is paged; full boundaries are fetched only when a site is loaded
+	let nextSitesCursor = null;
+
+	async function fetchSavedSites(append = false) {
 		try {
-			const response = await fetch('/api/sites');
+			const params = new URLSearchParams({ limit: 50, geometry: 'none' });
+			if (append && nextSitesCursor) params.set('before', nextSitesCursor);
+			const response = await fetch('/api/sites?' + params);
 			const data = await response.json();
 
 			const listContainer = document.querySelector('.saved-sites-list');
 			if (!listContainer) return;
 
-			listContainer.innerHTML = ''; // Clear current list
+			const moreButton = listContainer.querySelector('.load-more-sites');
+			if (moreButton) moreButton.remove();
+			if (!append) listContainer.innerHTML = ''; // Clear current list
+			nextSitesCursor = data.next || null;
 
-			if (!data.sites || data.sites.length === 0) {
+			if (!append && (!data.sites || data.sites.length === 0)) {
 				listContainer.innerHTML = '<div style="padding:20px; text-align:center; color:#95a5a6; font-size: 0.9rem;">No saved sites yet.<br>Draw a polygon and click "Save".</div>';
 				return;
 			}
@@ -1008,8 +1131,6 @@ document.addEventListener('DOMContentLoaded', function () {
 			data.sites.forEach(site => {
 				const item = document.createElement('div');
 				item.className = 'site-item';
-				// Store coords in dataset for easy retrieval
-				item.dataset.coords = JSON.stringify(site.coords);
 				item.dataset.id = site.id;
 
 				item.innerHTML = `
@@ -1025,6 +1146,15 @@ document.addEventListener('DOMContentLoaded', function () {
 				listContainer.appendChild(item);
 			});
 
+			if (nextSitesCursor) {
+				const more = document.createElement('button');
+				more.className = 'load-btn load-more-sites';
+				more.style.width = '100%';
+				more.innerText = 'Load more';
+				more.onclick = () => fetchSavedSites(true);
+				listContainer.appendChild(more);
+			}
+
 		} catch (error) {
 			console.error("Error loading sites:", error);
 		}
@@ -1033,13 +1163,91 @@ document.addEventListener('DOMContentLoaded', function () {
 	// 3. Make fetch available globally so other functions (like Save) can refresh the list
 	window.fetchSavedSites = fetchSavedSites;
 
-	// 4. Function to Load a Site onto the Map
-	window.loadSiteOnMap = function (id) {
-		// Find the DOM element to get the coords
-		const item = document.querySelector(`.site-item[data-id='${id}']`);
-		if (!item) return;
+	// Saved sites inside the viewport, drawn as simplified outlines and
+	// refreshed as the map pans (only from a zoom where they are readable)
+	const SITES_IN_VIEW_MIN_ZOOM = 9;
+	const siteOutlines = L.layerGroup().addTo(map);
+	let sitesInViewRequest = 0;
+	let sitesInViewTimer = null;
+
+	function decodePolyline(text) {
+		const points = [];
+		let index = 0, lat = 0, lng = 0;
+		while (index < text.length) {
+			for (const axis of [0, 1]) {
+				let result = 0, shift = 0, byte;
+				do {
+					byte = text.charCodeAt(index++) - 63;
+					result |= (byte & 0x1f) << shift;
+					shift += 5;
+				} while (byte >= 0x20);
+				const delta = (result & 1) ? ~(result >> 1) : (result >> 1);
+				if (axis === 0) lat += delta; else lng += delta;
+			}
+			points.push([lat / 1e5, lng / 1e5]);
+		}
+		return points;
+	}
 
-		const coords = JSON.parse(item.dataset.coords);
+	async function fetchSitesInView() {
+		if (map.getZoom() < SITES_IN_VIEW_MIN_ZOOM) {
+			siteOutlines.clearLayers();
+			return;
+		}
+		const bounds = map.getBounds();
+		// Leaflet longitudes keep growing past ±180 when the world wraps
+		const wrap = lng => ((lng + 180) % 360 + 360) % 360 - 180;
+		const wide = bounds.getEast() - bounds.getWest() >= 360;
+		const bbox = [
+			wide ? -180 : wrap(bounds.getWest()),
+			Math.max(bounds.getSouth(), -90),
+			wide ? 180 : wrap(bounds.getEast()),
+			Math.min(bounds.getNorth(), 90)
+		].map(value => value.toFixed(5)).join(',');
+		const request = ++sitesInViewRequest;
+		try {
+			const response = await fetch(`/api/sites/within?bbox=${bbox}`);
+			const data = await response.json();
+			// Ignore answers to viewports the user has already left
+			if (request !== sitesInViewRequest || data.status !== 'success') return;
+
+			siteOutlines.clearLayers();
+			data.sites.forEach(site => {
+				if (!site.polyline) return;
+				L.polygon(decodePolyline(site.polyline), {
+					color: '#8e44ad',
+					weight: 1.5,
+					fillOpacity: 0.05,
+					dashArray: '4 3'
+				})
+					.bindTooltip(site.name)
+					.on('click', () => window.loadSiteOnMap(site.id))
+					.addTo(siteOutlines);
+			});
+		} catch (e) {
+			console.error("Error loading sites in view:", e);
+		}
+	}
+
+	map.on('moveend', function () {
+		clearTimeout(sitesInViewTimer);
+		sitesInViewTimer = setTimeout(fetchSitesInView, 250);
+	});
+	fetchSitesInView();
+
+	// 4. Function to Load a Site onto the Map
+	window.loadSiteOnMap = async function (id) {
+		// Fetch the full boundary of the selected site
+		let site;
+		try {
+			const response = await fetch(`/api/sites/${id}`);
+			const data = await response.json();
+			if (data.status !== 'success') throw new Error(data.message);
+			site = data.site;
+		} catch (e) {
+			alert("Error loading site");
+			return;
+		}
 
 		// Clear existing drawn items
 		if (window.drawnItems) {
@@ -1047,7 +1255,7 @@ document.addEventListener('DOMContentLoaded', function () {
 		}
 
 		// Create the polygon
-		const polygon = L.polygon(coords, {
+		const polygon = L.polygon(site.coords, {
 			color: '#16a085',
 			fillColor: '#16a085',
 			fillOpacity: 0.3,
@@ -1059,6 +1267,11 @@ document.addEventListener('DOMContentLoaded', function () {
 			window.drawnItems.addLayer(polygon);
 		}
 
+		// Remember the site so a reference point placed next is analysed
+		// into this site's history
+		coords = polygon.getLatLngs()[0];
+		window.currentSite = { id: site.id, name: site.name };
+
 		// Zoom to the site
 		map.fitBounds(polygon.getBounds());
 
@@ -1115,6 +1328,7 @@ function generateAndDownloadReport(stats, imageUrl) {
 		headers: { 'Content-Type': 'application/json' },
 		body: JSON.stringify({
 			sitename: sitename,  // Send the typed name to the PDF generator
+			analysis_id: window.lastAnalysisId || null,
 			stats: stats,
 			image_url: imageUrl
 		})
@@ -0,0 +1,283 @@
+import functools
+import math
+
+import numpy as np
+from affine import Affine
+
+# Georeferencing of generated rasters: UTM zone 44N (central India)
+SYNTHETIC_CRS = "EPSG:32644"
+SYNTHETIC_ORIGIN = (500000.0, 2300000.0)
+SYNTHETIC_NODATA = -9999.0
+SURFACE_ELEVATION = 300.0
+
+
+def pit_profile(radius, depth, bench_height=10.0, bench_width=8.0, face_angle=60.0):
+    """
+    Radial depth profile of a benched pit as (radii, depths) nodes, rim
+    first: alternating steep faces and flat benches down to a flat floor.
+    The pit is shallower than `depth` when the radius runs out first.
+    """
+    face_run = bench_height / math.tan(math.radians(face_angle))
+    radii, depths = [radius], [0.0]
+    while depths[-1] < depth:
+        drop = min(bench_height, depth - depths[-1])
+        rho = radii[-1] - face_run * drop / bench_height
+        if rho <= 0:
+            break
+        radii.append(rho)
+        depths.append(depths[-1] + drop)
+        if depths[-1] < depth and rho - bench_width > face_run:
+            radii.append(rho - bench_width)
+            depths.append(depths[-1])
+        elif depths[-1] < depth:
+            break
+    radii.append(0.0)
+    depths.append(depths[-1])
+    return np.array(radii[::-1]), np.array(depths[::-1])
+
+
+def profile_volume(radii, depths):
+    """Exact volume of revolution of a piecewise-linear radial depth profile"""
+    volume = 0.0
+    for a, b, da, db in zip(radii[:-1], radii[1:], depths[:-1], depths[1:]):
+        if b <= a:
+            continue
+        k = (db - da) / (b - a)
+        volume += 2 * math.pi * (da * (b * b - a * a) / 2 +
+                                 k * ((b ** 3 - a ** 3) / 3 - a * (b * b - a * a) / 2))
+    return volume
+
+
+def _place(rng, features, radius, width_m, height_m, margin, attempts=200):
+    """Random centre whose disc stays inside the raster and clear of the placed features"""
+    for _ in range(attempts):
+        cx = rng.uniform(radius + margin, width_m - radius - margin)
+        cy = rng.uniform(radius + margin, height_m - radius - margin)
+        if all(math.hypot(cx - f["cx"], cy - f["cy"]) > radius + f["extent"] + margin
+               for f in features):
+            return cx, cy
+    return None
+
+
+def make_quarry_spec(width, height, seed=0, pixel_size=1.0, n_pits=3, n_stockpiles=2,
+                     max_depth=60.0, bench_height=10.0, noise_sigma=1.5,
+                     void_fraction=0.0):
+    """
+    Seeded description of a synthetic quarry site with its analytic
+    volumes. Pits (with a haul-ramp trench each) and conical stockpiles
+    never overlap, so every volume is exact in closed form.
+    """
+    rng = np.random.default_rng(seed)
+    width_m, height_m = width * pixel_size, height * pixel_size
+    size_m = min(width_m, height_m)
+
+    pits, stockpiles = [], []
+    for _ in range(n_pits):
+        radius = rng.uniform(0.12, 0.22) * size_m
+        ramp_length = 0.3 * radius
+        position = _place(rng, pits, radius + ramp_length, width_m, height_m, 2 * pixel_size)
+        if position is None:
+            continue
+        radii, depths = pit_profile(radius, rng.uniform(0.6, 1.0) * max_depth, bench_height,
+                                    bench_width=max(0.08 * radius, 2 * pixel_size))
+        ramp_depth = float(min(bench_height, depths.max()))
+        ramp_width = max(0.15 * radius, 3 * pixel_size)
+        pits.append({
+            "cx": position[0], "cy": position[1], "extent": radius + ramp_length,
+            "radius": radius, "radii": radii.tolist(), "depths": depths.tolist(),
+            "depth": float(depths.max()),
+            "ramp": {"azimuth": rng.uniform(0, 2 * math.pi), "length": ramp_length,
+                     "width": ramp_width, "depth": ramp_depth},
+            "volume_m3": profile_volume(radii, depths),
+            "ramp_volume_m3": ramp_width * ramp_length * ramp_depth / 2,
+        })
+
+    for _ in range(n_stockpiles):
+        radius = rng.uniform(0.03, 0.06) * size_m
+        position = _place(rng, pits + stockpiles, radius, width_m, height_m, 2 * pixel_size)
+        if position is None:
+            continue
+        pile_height = radius * math.tan(math.radians(35.0))
+        stockpiles.append({
+            "cx": position[0], "cy": position[1], "extent": radius,
+            "radius": radius, "height": pile_height,
+            "volume_m3": math.pi * radius * radius * pile_height / 3,
+        })
+
+    # SRTM-like correlated noise: separable random-phase sinusoids
+    octaves = []
+    for wavelength, amplitude in ((size_m / 3, 0.6), (size_m / 12, 0.3), (size_m / 40, 0.1)):
+        fx, fy = rng.uniform(0.7, 1.3, 2) * 2 * math.pi / wavelength
+        octaves.append([amplitude * noise_sigma, fx, fy, *rng.uniform(0, 2 * math.pi, 2)])
+
+    # NoData voids sit in the pits, where radar shadow causes them in SRTM
+    voids = []
+    if void_fraction > 0 and pits:
+        for _ in range(3):
+            pit = pits[rng.integers(len(pits))]
+            voids.append({
+                "cx": pit["cx"] + rng.uniform(-0.5, 0.5) * pit["radius"],
+                "cy": pit["cy"] + rng.uniform(-0.5, 0.5) * pit["radius"],
+                "radius": math.sqrt(void_fraction * width_m * height_m / 6 / math.pi),
+            })
+
+    excavation = sum(p["volume_m3"] + p["ramp_volume_m3"] for p in pits)
+    stockpile = sum(s["volume_m3"] for s in stockpiles)
+    return {
+        "seed": seed,
+        "width": width,
+        "height": height,
+        "pixel_size": pixel_size,
+        "crs": SYNTHETIC_CRS,
+        "transform": list(Affine(pixel_size, 0, SYNTHETIC_ORIGIN[0],
+                                 0, -pixel_size, SYNTHETIC_ORIGIN[1] + height_m))[:6],
+        "surface_elevation": SURFACE_ELEVATION,
+        "noise_sigma": noise_sigma,
+        "void_fraction": void_fraction,
+        "octaves": octaves,
+        "pits": pits,
+        "stockpiles": stockpiles,
+        "voids": voids,
+        "volumes": {
+            "excavation_m3": excavation,
+            "stockpile_m3": stockpile,
+            "net_m3": excavation - stockpile,
+        },
+    }
+
+
+def _feature_window(feature, extent, pixel_size, row_start, row_stop, width):
+    """Pixel rows/cols of the window covered by a feature, clipped to the block"""
+    r0 = max(row_start, int((feature["cy"] - extent) / pixel_size))
+    r1 = min(row_stop, int((feature["cy"] + extent) / pixel_size) + 2)
+    c0 = max(0, int((feature["cx"] - extent) / pixel_size))
+    c1 = min(width, int((feature["cx"] + extent) / pixel_size) + 2)
+    if r0 >= r1 or c0 >= c1:
+        return None
+    ys = (np.arange(r0, r1) + 0.5) * pixel_size - feature["cy"]
+    xs = (np.arange(c0, c1) + 0.5) * pixel_size - feature["cx"]
+    return (slice(r0 - row_start, r1 - row_start), slice(c0, c1)), xs[None, :], ys[:, None]
+
+
+def render_quarry_window(spec, row_start, row_stop, with_noise=True):
+    """
+    Elevation rows [row_start, row_stop) of a quarry spec as float32, with
+    NaN voids. Rendering is deterministic per row, so any block split of
+    the raster produces identical output.
+    """
+    width, pixel_size = spec["width"], spec["pixel_size"]
+    block = np.full((row_stop - row_start, width), spec["surface_elevation"], dtype=np.float32)
+
+    for pit in spec["pits"]:
+        window = _feature_window(pit, pit["extent"], pixel_size, row_start, row_stop, width)
+        if window is None:
+            continue
+        target, xs, ys = window
+        rho = np.hypot(xs, ys)
+        depth = np.interp(rho, pit["radii"], pit["depths"], right=0.0)
+
+        ramp = pit["ramp"]
+        cos_a, sin_a = math.cos(ramp["azimuth"]), math.sin(ramp["azimuth"])
+        u = xs * cos_a + ys * sin_a - pit["radius"]
+        v = ys * cos_a - xs * sin_a
+        in_ramp = (u >= 0) & (u <= ramp["length"]) & (np.abs(v) <= ramp["width"] / 2)
+        depth += np.where(in_ramp, ramp["depth"] * (1 - u / ramp["length"]), 0.0)
+        block[target] -= depth
+
+    for pile in spec["stockpiles"]:
+        window = _feature_window(pile, pile["radius"], pixel_size, row_start, row_stop, width)
+        if window is None:
+            continue
+        target, xs, ys = window
+        rho = np.hypot(xs, ys)
+        block[target] += np.clip(pile["height"] * (1 - rho / pile["radius"]), 0, None)
+
+    if with_noise and spec["noise_sigma"] > 0:
+        xs = (np.arange(width) + 0.5) * pixel_size
+        ys = (np.arange(row_start, row_stop) + 0.5) * pixel_size
+        for amplitude, fx, fy, px, py in spec["octaves"]:
+            block += (amplitude * np.cos(fy * ys + py))[:, None].astype(np.float32) * \
+                np.sin(fx * xs + px)[None, :].astype(np.float32)
+
+    speckle = spec["void_fraction"] / 2
+    if (with_noise and spec["noise_sigma"] > 0) or speckle > 0:
+        for row in range(row_start, row_stop):
+            rng = np.random.default_rng((spec["seed"], row))
+            line = block[row - row_start]
+            if with_noise and spec["noise_sigma"] > 0:
+                line += rng.normal(0, 0.3 * spec["noise_sigma"], width).astype(np.float32)
+            if speckle > 0:
+                line[rng.random(width) < speckle] = np.nan
+
+    for void in spec["voids"]:
+        window = _feature_window(void, void["radius"], pixel_size, row_start, row_stop, width)
+        if window is None:
+            continue
+        target, xs, ys = window
+        block[target][np.hypot(xs, ys) < void["radius"]] = np.nan
+
+    return block
+
+
+def generate_synthetic_quarry(width=512, height=512, seed=0, with_noise=True, **kwargs):
+    """In-memory synthetic quarry DEM. Returns (dem float32, spec)"""
+    spec = make_quarry_spec(width, height, seed, **kwargs)
+    return render_quarry_window(spec, 0, height, with_noise), spec
+
+
+def write_synthetic_quarry(path, width=4096, height=4096, seed=0, block_rows=512,
+                           dtype="float32", **kwargs):
+    """
+    Write a synthetic quarry as a tiled, compressed GeoTIFF in row blocks,
+    so rasters up to 20k x 20k never need to fit in memory. Integer dtypes
+    are rounded to whole metres like SRTM. Returns the spec.
+    """
+    import rasterio
+
+    spec = make_quarry_spec(width, height, seed, **kwargs)
+    integer = np.issubdtype(np.dtype(dtype), np.integer)
+    nodata = float(np.iinfo(dtype).min) if integer else SYNTHETIC_NODATA
+    profile = {
+        "driver": "GTiff", "width": width, "height": height, "count": 1,
+        "dtype": dtype, "crs": spec["crs"], "transform": Affine(*spec["transform"]),
+        "nodata": nodata, "tiled": True, "blockxsize": 256, "blockysize": 256,
+        "compress": "deflate", "predictor": 2 if integer else 3, "BIGTIFF": "IF_SAFER",
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        for row_start in range(0, height, block_rows):
+            row_stop = min(row_start + block_rows, height)
+            block = render_quarry_window(spec, row_start, row_stop)
+            voids = np.isnan(block)
+            if integer:
+                block = np.rint(block)
+            block[voids] = nodata
+            dst.write(block.astype(dtype), 1, window=((row_start, row_stop), (0, width)))
+
+    print(f"🏔️ Synthetic quarry written: {path} ({width} x {height}, seed {seed}, "
+          f"{spec['volumes']['excavation_m3']:,.0f} m³ excavated)")
+    return spec
+
+
+# Seeds come from the query string, so only the most recent few are kept
+DEMO_CACHE_SIZE = 8
+
+
+@functools.lru_cache(maxsize=DEMO_CACHE_SIZE)
+def demo_terrain_data(width=195, height=85, seed=0):
+    """
+    Fixed-seed demo terrain for the 3D viewer, heights relative to the
+    original ground (pits negative), memoised for the latest sizes and seeds
+    """
+    dem, _ = generate_synthetic_quarry(width, height, seed, pixel_size=5.0, max_depth=75.0)
+    relative = dem - SURFACE_ELEVATION
+    return {
+        "width": width,
+        "height": height,
+        "elevation_range": {
+            "min": float(np.nanmin(relative)),
+            "max": float(np.nanmax(relative)),
+        },
+        "depth_data": np.round(relative, 3).tolist(),
+        "timestamp": f"synthetic_seed_{seed}",
+        "data_points": width * height,
+    }
@@ -0,0 +1,137 @@
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+from rasterio.coords import BoundingBox
+
+CHUNK_ROOT = os.path.join("static", "terrain_chunks")
+CHUNK_SIZE = 64
+# Older chunk sets are removed when a new raster is tiled
+KEEP_VERSIONS = 3
+
+_build_lock = threading.Lock()
+
+
+def downsample_half(data):
+    """2x2 mean, keeping the last row/column so chunk edges still meet"""
+    rows = (data.shape[0] + 1) // 2
+    cols = (data.shape[1] + 1) // 2
+    padded = np.pad(data, ((0, rows * 2 - data.shape[0]), (0, cols * 2 - data.shape[1])), mode="edge")
+    return padded.reshape(rows, 2, cols, 2).mean(axis=(1, 3))
+
+
+def build_pyramid(dem_data, chunk_size=CHUNK_SIZE):
+    """Full resolution first, halving until the whole raster fits in one chunk"""
+    levels = [dem_data]
+    while max(levels[-1].shape) > chunk_size + 1:
+        levels.append(downsample_half(levels[-1]))
+    return levels
+
+
+def chunk_dir(version, level):
+    return os.path.join(CHUNK_ROOT, version, str(level))
+
+
+def chunk_path(version, level, cx, cy):
+    return os.path.join(chunk_dir(version, level), f"{cx}_{cy}.bin")
+
+
+def build_terrain_chunks(dem_file="cropped.tif", chunk_size=CHUNK_SIZE):
+    """
+    Precompute heightmap chunks for every pyramid level of a raster, once
+    per raster content version. Chunks overlap by one sample so neighbours
+    share their edge vertices. Returns the manifest.
+    """
+    from raster_store import raster_hash
+    from three_visualization import encode_heightmap, load_3d_elevation
+    from volume_calculator import estimate_reference_elevation
+
+    version = raster_hash(dem_file)[:16]
+    manifest_path = os.path.join(CHUNK_ROOT, version, "manifest.json")
+
+    with _build_lock:
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                return json.load(f)
+
+        dem_data, bounds = load_3d_elevation(dem_file, downsample=False)
+        dem_data = dem_data.astype(np.float32)
+        reference = float(estimate_reference_elevation(dem_data))
+        pyramid = build_pyramid(dem_data, chunk_size)
+
+        build_dir = os.path.join(CHUNK_ROOT, f"{version}.building")
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+        levels = []
+        for level, data in enumerate(pyramid):
+            # Ground size of one sample at this level
+            x_step = (bounds.right - bounds.left) / max(data.shape[1] - 1, 1)
+            y_step = (bounds.top - bounds.bottom) / max(data.shape[0] - 1, 1)
+            chunks_x = max(1, int(np.ceil((data.shape[1] - 1) / chunk_size)))
+            chunks_y = max(1, int(np.ceil((data.shape[0] - 1) / chunk_size)))
+
+            level_dir = os.path.join(build_dir, str(level))
+            os.makedirs(level_dir, exist_ok=True)
+            for cy in range(chunks_y):
+                for cx in range(chunks_x):
+                    row0, col0 = cy * chunk_size, cx * chunk_size
+                    block = data[row0:row0 + chunk_size + 1, col0:col0 + chunk_size + 1]
+                    row1, col1 = row0 + block.shape[0] - 1, col0 + block.shape[1] - 1
+                    chunk_bounds = BoundingBox(
+                        left=bounds.left + col0 * x_step,
+                        bottom=bounds.top - row1 * y_step,
+                        right=bounds.left + col1 * x_step,
+                        top=bounds.top - row0 * y_step,
+                    )
+                    with open(os.path.join(level_dir, f"{cx}_{cy}.bin"), "wb") as f:
+                        f.write(encode_heightmap(block, chunk_bounds, "uint16", reference))
+
+            levels.append({
+                "level": level,
+                "width": int(data.shape[1]),
+                "height": int(data.shape[0]),
+                "chunks_x": chunks_x,
+                "chunks_y": chunks_y,
+            })
+
+        manifest = {
+            "version": version,
+            "chunk_size": chunk_size,
+            "levels": levels,
+            "bounds": {
+                "left": float(bounds.left),
+                "right": float(bounds.right),
+                "bottom": float(bounds.bottom),
+                "top": float(bounds.top),
+            },
+            "minElevation": float(np.nanmin(dem_data)),
+            "maxElevation": float(np.nanmax(dem_data)),
+            "referenceElevation": reference,
+        }
+        with open(os.path.join(build_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, separators=(",", ":"))
+
+        final_dir = os.path.join(CHUNK_ROOT, version)
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(build_dir, final_dir)
+        prune_chunk_versions(keep=version)
+
+        total = sum(level["chunks_x"] * level["chunks_y"] for level in levels)
+        print(f"🧩 Terrain chunks built: {total} chunks over {len(levels)} levels ({version})")
+        return manifest
+
+
+def prune_chunk_versions(keep=None, keep_count=KEEP_VERSIONS):
+    """Remove all but the most recent chunk sets"""
+    if not os.path.isdir(CHUNK_ROOT):
+        return
+    versions = [
+        entry for entry in os.scandir(CHUNK_ROOT)
+        if entry.is_dir() and not entry.name.endswith(".building")
+    ]
+    versions.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in versions[keep_count:]:
+        if entry.name != keep:
+            shutil.rmtree(entry.path, ignore_errors=True)
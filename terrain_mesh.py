@@ -0,0 +1,188 @@
+import struct
+
+import numpy as np
+
+# Default error thresholds (metres) for the LOD chain, finest first
+DEFAULT_LOD_ERRORS = (0.5, 2.0, 5.0, 15.0)
+
+
+def rtin_grid_size(height, width):
+    """Smallest 2^k + 1 grid that holds a height x width raster"""
+    size = max(height, width, 2) - 1
+    return (1 << int(np.ceil(np.log2(size)))) + 1
+
+
+def pad_to_rtin_grid(dem_data):
+    """Edge-pad a DEM to a square 2^k + 1 grid (padding is flat, so it meshes to a few triangles)"""
+    size = rtin_grid_size(*dem_data.shape)
+    pad_rows = size - dem_data.shape[0]
+    pad_cols = size - dem_data.shape[1]
+    if pad_rows == 0 and pad_cols == 0:
+        return dem_data.astype(np.float32, copy=False)
+    return np.pad(dem_data.astype(np.float32, copy=False), ((0, pad_rows), (0, pad_cols)), mode="edge")
+
+
+def _edge_level_errors(heights, errors, s):
+    """
+    Errors for midpoints of horizontal hypotenuses of length 2s (rows 0::2s,
+    cols s::2s). Vertical ones are handled by passing transposed views.
+    """
+    step = 2 * s
+    midpoints = heights[0::step, s::step]
+    left = heights[0::step, 0:-1:step]
+    right = heights[0::step, step::step]
+    level_error = np.abs(midpoints - (left + right) * 0.5)
+
+    if s > 1:
+        # Children are the centres of the four half-size squares around the midpoint
+        h = s // 2
+        below = np.maximum(errors[h::step, s - h::step], errors[h::step, s + h::step])
+        above = np.maximum(errors[step - h::step, s - h::step], errors[step - h::step, s + h::step])
+        np.maximum(level_error[:-1], below, out=level_error[:-1])
+        np.maximum(level_error[1:], above, out=level_error[1:])
+
+    errors[0::step, s::step] = level_error
+
+
+def _diagonal_level_errors(heights, errors, s):
+    """Errors for midpoints of diagonal hypotenuses, i.e. centres of 2s squares"""
+    step = 2 * s
+    centres = heights[s::step, s::step]
+    top_left = heights[0:-1:step, 0:-1:step]
+    bottom_right = heights[step::step, step::step]
+    top_right = heights[0:-1:step, step::step]
+    bottom_left = heights[step::step, 0:-1:step]
+
+    # Squares alternate between the two diagonals in a checkerboard
+    index = np.arange(centres.shape[0])
+    main_diagonal = (index[:, None] + index[None, :]) % 2 == 0
+    interpolated = np.where(main_diagonal, top_left + bottom_right, top_right + bottom_left) * 0.5
+    level_error = np.abs(centres - interpolated)
+
+    # Children are the four edge midpoints of the square
+    np.maximum(level_error, errors[s::step, 0:-1:step], out=level_error)
+    np.maximum(level_error, errors[s::step, step::step], out=level_error)
+    np.maximum(level_error, errors[0:-1:step, s::step], out=level_error)
+    np.maximum(level_error, errors[step::step, s::step], out=level_error)
+
+    errors[s::step, s::step] = level_error
+
+
+def compute_rtin_errors(heights):
+    """
+    Martini-style RTIN error map for a square 2^k + 1 height grid. Each
+    vertex holds the largest interpolation error of the triangle it splits
+    and of every triangle below it, computed one level at a time with
+    strided array operations instead of a per-triangle loop.
+    """
+    size = heights.shape[0]
+    if heights.shape != (size, size) or (size - 1) & (size - 2):
+        raise ValueError(f"RTIN grid must be square with 2^k + 1 cells, got {heights.shape}")
+
+    heights = heights.astype(np.float32, copy=False)
+    errors = np.zeros_like(heights)
+
+    s = 1
+    while s < size - 1:
+        _edge_level_errors(heights, errors, s)
+        _edge_level_errors(heights.T, errors.T, s)
+        _diagonal_level_errors(heights, errors, s)
+        s *= 2
+
+    return errors
+
+
+def extract_rtin_mesh(heights, errors, max_error, data_shape=None):
+    """
+    Error-bounded triangulation from an RTIN error map. Triangles are
+    refined breadth-first as arrays of (ax, ay, bx, by, cx, cy) with the
+    hypotenuse a-b and right angle at c.
+
+    Returns (vertices float32 (N, 3) as x, y, z in pixel units, indices uint32 (M,)).
+    """
+    size = heights.shape[0]
+    last = size - 1
+    active = np.array([
+        [0, 0, last, last, last, 0],
+        [last, last, 0, 0, 0, last],
+    ], dtype=np.int32)
+    finished = []
+
+    while len(active):
+        ax, ay, bx, by, cx, cy = active.T
+        mx = (ax + bx) // 2
+        my = (ay + by) // 2
+        split = (np.abs(ax - cx) + np.abs(ay - cy) > 1) & (errors[my, mx] > max_error)
+
+        finished.append(active[~split])
+        parents = active[split]
+        if not len(parents):
+            break
+        ax, ay, bx, by, cx, cy = parents.T
+        mx = (ax + bx) // 2
+        my = (ay + by) // 2
+        active = np.concatenate([
+            np.stack([cx, cy, ax, ay, mx, my], axis=1),
+            np.stack([bx, by, cx, cy, mx, my], axis=1),
+        ])
+
+    triangles = np.concatenate(finished).reshape(-1, 3, 2)
+
+    # Clip padding back to the raster extent and drop collapsed triangles
+    if data_shape is not None:
+        rows, cols = data_shape
+        np.minimum(triangles[..., 0], cols - 1, out=triangles[..., 0])
+        np.minimum(triangles[..., 1], rows - 1, out=triangles[..., 1])
+        edge1 = triangles[:, 1] - triangles[:, 0]
+        edge2 = triangles[:, 2] - triangles[:, 0]
+        area = edge1[:, 0] * edge2[:, 1] - edge1[:, 1] * edge2[:, 0]
+        triangles = triangles[area != 0]
+
+    vertex_ids = triangles[..., 1].astype(np.int64) * size + triangles[..., 0]
+    unique_ids, indices = np.unique(vertex_ids.ravel(), return_inverse=True)
+
+    vertex_y, vertex_x = np.divmod(unique_ids, size)
+    vertices = np.column_stack([
+        vertex_x, vertex_y, heights[vertex_y, vertex_x],
+    ]).astype(np.float32)
+
+    return vertices, indices.astype(np.uint32)
+
+
+def build_terrain_lods(dem_data, max_errors=DEFAULT_LOD_ERRORS):
+    """
+    Adaptive meshes of a (NaN-free) DEM at several vertical error bounds.
+    The error map is computed once and shared by every level.
+    """
+    heights = pad_to_rtin_grid(dem_data)
+    errors = compute_rtin_errors(heights)
+
+    lods = []
+    for max_error in max_errors:
+        vertices, indices = extract_rtin_mesh(heights, errors, max_error, dem_data.shape)
+        lods.append({
+            "max_error": float(max_error),
+            "vertices": vertices,
+            "indices": indices,
+            "vertex_count": int(len(vertices)),
+            "triangle_count": int(len(indices) // 3),
+        })
+    return lods
+
+
+# Binary mesh: little-endian 32-byte header then float32 xyz vertices and uint32 indices
+#   magic 'QDFM', uint16 version, uint16 LOD level, uint32 vertex count,
+#   uint32 index count, float32 max error, uint32 raster width, uint32 raster height,
+#   float32 reference elevation
+MESH_MAGIC = b"QDFM"
+MESH_HEADER = struct.Struct("<4sHHIIfIIf")
+
+
+def encode_mesh(lod, width, height, level=0, reference_elevation=0.0):
+    """Pack one LOD into vertex and index buffers the viewer can map directly"""
+    header = MESH_HEADER.pack(
+        MESH_MAGIC, 1, level,
+        lod["vertex_count"], len(lod["indices"]), lod["max_error"],
+        width, height, float(reference_elevation),
+    )
+    return header + lod["vertices"].astype("<f4").tobytes() + lod["indices"].astype("<u4").tobytes()
@@ -1,125 +1,166 @@
 # [file name]: three_visualization.py
 # [file content begin]
+import gzip
 import json
 import os
+import struct
+import time
 from datetime import datetime
 
 import numpy as np
 import rasterio
 
+from precision import read_elevation
+from result_cache import memoize_analysis
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is always available
+    brotli = None
+
+# Artifact parameters of the viewer's terrain JSON
+TERRAIN_JSON_PARAMS = {"format": "terrain_json", "downsample": True}
+
+
+def load_3d_elevation(dem_file="cropped.tif", downsample=True):
+    """
+    Read a DEM and prepare the elevation grid for the 3D viewer
+    (NoData filled, downsampled if too large). Returns (dem_data, bounds).
+    """
+    with rasterio.open(dem_file) as src:
+        dem_data = read_elevation(src)
+        bounds = src.bounds
+
+    print(f"🔄 Generating 3D data from: {dem_file}")
+    print(f"📊 DEM shape: {dem_data.shape}")
+
+    return prepare_3d_elevation(dem_data, downsample), bounds
+
+
+def prepare_3d_elevation(dem_data, downsample=True):
+    """NoData fill and downsampling of an already-loaded float DEM for the viewer"""
+    # Fill NaN values
+    dem_data = fill_nan_values(dem_data)
+
+    # Downsample if too large for better performance (grid formats only,
+    # the adaptive mesh works on the full-resolution DEM)
+    if downsample and (dem_data.shape[0] > 150 or dem_data.shape[1] > 150):
+        dem_data = dem_data[::2, ::2]
+        print(f"📏 Downsampled to: {dem_data.shape}")
+
+    return dem_data
+
 
 def generate_3d_terrain_data(dem_file="cropped.tif"):
     """
-    Generate fresh 3D terrain data for Three.js visualization
+    Generate 3D terrain data for Three.js visualization, stored once per
+    raster version in the terrain artifact store
     """
     try:
         # Always use the latest cropped file
         if not os.path.exists(dem_file):
             print(f"DEM file not found: {dem_file}")
             return generate_sample_3d_data()
-        
-        with rasterio.open(dem_file) as src:
-            dem_data = src.read(1)
-            transform = src.transform
-            bounds = src.bounds
-            
-        print(f"🔄 Generating 3D data from: {dem_file}")
-        print(f"📊 DEM shape: {dem_data.shape}")
-        
-        # Process DEM data
-        dem_data = dem_data.astype(np.float64)
-        dem_data[dem_data == src.nodata] = np.nan
-        
-        # Fill NaN values
-        dem_data = fill_nan_values(dem_data)
-        
-        # Downsample if too large for better performance
-        if dem_data.shape[0] > 150 or dem_data.shape[1] > 150:
-            dem_data = dem_data[::2, ::2]
-            print(f"📏 Downsampled to: {dem_data.shape}")
-        
-        # Calculate statistics
-        min_elev = float(np.nanmin(dem_data))
-        max_elev = float(np.nanmax(dem_data))
-        mean_elev = float(np.nanmean(dem_data))
-        
-        print(f"📈 Elevation range: {min_elev:.1f}m to {max_elev:.1f}m")
-        print(f"📊 Mean elevation: {mean_elev:.1f}m")
-        
-        # Convert to list for JSON
-        elevation_list = dem_data.tolist()
-        
-        # Create terrain data
-        terrain_data = {
-            "elevation": elevation_list,
-            "minElevation": min_elev,
-            "maxElevation": max_elev,
-            "meanElevation": mean_elev,
-            "width": int(dem_data.shape[1]),
-            "height": int(dem_data.shape[0]),
-            "bounds": {
-                "left": float(bounds.left),
-                "right": float(bounds.right),
-                "bottom": float(bounds.bottom),
-                "top": float(bounds.top)
-            },
-            "scale": 3,
-            "timestamp": datetime.now().isoformat(),
-            "dataSource": dem_file
-        }
-        
-        # Save with unique filename
-        output_dir = "static/3d"
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_json = os.path.join(output_dir, f"terrain_{timestamp}.json")
-        
-        os.makedirs(output_dir, exist_ok=True)
-        with open(output_json, 'w') as f:
-            json.dump(terrain_data, f, indent=2)
-        
-        print(f"✅ 3D terrain data saved: {output_json}")
-        print(f"📐 Terrain size: {terrain_data['width']} x {terrain_data['height']}")
-        
-        return output_json
+
+        from artifact_store import artifact_key, terrain_store
+        from raster_store import raster_hash
+
+        source_hash = raster_hash(dem_file)
+        key = artifact_key(source_hash, TERRAIN_JSON_PARAMS)
+        cached = terrain_store.get(key)
+        if cached:
+            return cached
+
+        dem_data, bounds = load_3d_elevation(dem_file)
+        return store_3d_terrain_data(dem_data, bounds, dem_file, key, source_hash)
         
     except Exception as e:
         print(f"❌ Error generating 3D data: {e}")
         return generate_sample_3d_data()
 
-def get_latest_3d_data():
-    """Get the most recent 3D terrain data file"""
-    output_dir = "static/3d"
-    if not os.path.exists(output_dir):
-        return generate_3d_terrain_data()
+def store_3d_terrain_data(dem_data, bounds, dem_file, key, source_hash):
+    """
+    Encode a prepared elevation grid as viewer JSON and store it under key
+    in the terrain artifact store. Returns the artifact path.
+    """
+    from artifact_store import terrain_store
+
+    # Calculate statistics
+    min_elev = float(np.nanmin(dem_data))
+    max_elev = float(np.nanmax(dem_data))
+    mean_elev = float(np.nanmean(dem_data))
+    
+    print(f"📈 Elevation range: {min_elev:.1f}m to {max_elev:.1f}m")
+    print(f"📊 Mean elevation: {mean_elev:.1f}m")
     
-    # Find all terrain JSON files
-    terrain_files = [f for f in os.listdir(output_dir) if f.startswith('terrain_') and f.endswith('.json')]
+    # Convert to list for JSON
+    elevation_list = dem_data.tolist()
     
-    if not terrain_files:
-        return generate_3d_terrain_data()
+    # Create terrain data (timestamp is the raster's, so identical
+    # inputs give identical artifacts)
+    terrain_data = {
+        "elevation": elevation_list,
+        "minElevation": min_elev,
+        "maxElevation": max_elev,
+        "meanElevation": mean_elev,
+        "width": int(dem_data.shape[1]),
+        "height": int(dem_data.shape[0]),
+        "bounds": {
+            "left": float(bounds.left),
+            "right": float(bounds.right),
+            "bottom": float(bounds.bottom),
+            "top": float(bounds.top)
+        },
+        "scale": 3,
+        "timestamp": datetime.fromtimestamp(os.path.getmtime(dem_file)).isoformat(),
+        "dataSource": dem_file
+    }
+    
+    payload = json.dumps(terrain_data, separators=(',', ':')).encode()
+    output_json = terrain_store.put(key, payload, source=source_hash,
+                                    params={"format": "terrain_json"})
     
-    # Get the most recent file
-    latest_file = max(terrain_files)
-    return os.path.join(output_dir, latest_file)
+    print(f"✅ 3D terrain data saved: {output_json}")
+    print(f"📐 Terrain size: {terrain_data['width']} x {terrain_data['height']}")
+    
+    return output_json
+
+def get_latest_3d_data(dem_file="cropped.tif"):
+    """
+    Terrain data for the current raster. Looks the raster up in the
+    artifact index (generating it on a miss) instead of scanning static/3d.
+    """
+    if os.path.exists(dem_file):
+        return generate_3d_terrain_data(dem_file)
+
+    from artifact_store import terrain_store
+    return terrain_store.latest() or generate_sample_3d_data()
 
 def fill_nan_values(data):
-    """Fill NaN values using interpolation"""
+    """Fill NaN values by multigrid inpainting of the voids"""
     mask = np.isnan(data)
     if not np.any(mask):
         return data
     
     try:
-        from scipy import ndimage
-        indices = ndimage.distance_transform_edt(mask, return_distances=False, return_indices=True)
-        data[mask] = data[tuple(indices[:, mask])]
-    except:
+        from nodata_fill import fill_nodata
+        fill_nodata(data, mask)
+    except Exception as e:
+        print(f"⚠️ NoData fill failed, using mean: {e}")
         # Simple fill with mean
         data[mask] = np.nanmean(data)
     
     return data
 
 def generate_sample_3d_data():
-    """Generate realistic sample quarry terrain"""
+    """Generate realistic sample quarry terrain (deterministic, so it is stored once)"""
+    from artifact_store import artifact_key, terrain_store
+
+    key = artifact_key("sample_quarry", {"format": "terrain_json"})
+    cached = terrain_store.get(key)
+    if cached:
+        return cached
+
     print("🔄 Generating sample quarry terrain...")
     
     # Create a more realistic quarry shape
@@ -148,18 +189,172 @@ def generate_sample_3d_data():
             "top": 3
         },
         "scale": 3,
-        "timestamp": datetime.now().isoformat(),
         "dataSource": "sample_quarry"
     }
     
-    output_dir = "static/3d"
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_json = os.path.join(output_dir, f"sample_terrain_{timestamp}.json")
-    
-    os.makedirs(output_dir, exist_ok=True)
-    with open(output_json, 'w') as f:
-        json.dump(terrain_data, f, indent=2)
+    payload = json.dumps(terrain_data, separators=(',', ':')).encode()
+    output_json = terrain_store.put(key, payload, source="sample_quarry",
+                                    params={"format": "terrain_json"})
     
     print(f"✅ Sample 3D data saved: {output_json}")
     return output_json
+# === BINARY HEIGHTMAP FORMAT ===
+# Little-endian, 64-byte header followed by a row-major grid:
+#   magic 'QDFH', uint16 version, uint16 dtype (1 = uint16 quantized, 2 = float32),
+#   uint32 width, uint32 height, float32 min, max, reference elevation,
+#   float64 bounds left, bottom, right, top, zero padding to 64 bytes.
+# uint16 values decode as min + q * (max - min) / 65535.
+HEIGHTMAP_MAGIC = b'QDFH'
+HEIGHTMAP_VERSION = 1
+HEIGHTMAP_HEADER = struct.Struct('<4sHHIIfff4d')
+HEIGHTMAP_HEADER_SIZE = 64
+HEIGHTMAP_DTYPES = {'uint16': 1, 'float32': 2}
+
+
+def encode_heightmap(dem_data, bounds, dtype='uint16', reference_elevation=None):
+    """Pack an elevation grid into the binary heightmap format"""
+    if dtype not in HEIGHTMAP_DTYPES:
+        raise ValueError(f"Unsupported heightmap dtype: {dtype}")
+
+    min_elev = float(np.nanmin(dem_data))
+    max_elev = float(np.nanmax(dem_data))
+    if reference_elevation is None:
+        reference_elevation = float(np.nanpercentile(dem_data, 85))
+
+    if dtype == 'uint16':
+        span = max(max_elev - min_elev, 1e-6)
+        grid = np.rint((dem_data - min_elev) * (65535.0 / span)).astype('<u2')
+    else:
+        grid = dem_data.astype('<f4')
+
+    header = HEIGHTMAP_HEADER.pack(
+        HEIGHTMAP_MAGIC, HEIGHTMAP_VERSION, HEIGHTMAP_DTYPES[dtype],
+        grid.shape[1], grid.shape[0],
+        min_elev, max_elev, float(reference_elevation),
+        float(bounds.left), float(bounds.bottom), float(bounds.right), float(bounds.top),
+    )
+    header = header.ljust(HEIGHTMAP_HEADER_SIZE, b'\0')
+    return header + np.ascontiguousarray(grid).tobytes()
+
+
+def decode_heightmap(payload):
+    """Inverse of encode_heightmap, returns (elevation grid, header dict)"""
+    magic, version, dtype_code, width, height, min_elev, max_elev, reference, *bounds = \
+        HEIGHTMAP_HEADER.unpack_from(payload)
+    if magic != HEIGHTMAP_MAGIC:
+        raise ValueError("Not a QDFH heightmap")
+
+    if dtype_code == HEIGHTMAP_DTYPES['uint16']:
+        grid = np.frombuffer(payload, dtype='<u2', count=width * height, offset=HEIGHTMAP_HEADER_SIZE)
+        grid = min_elev + grid.astype(np.float32) * ((max_elev - min_elev) / 65535.0)
+    else:
+        grid = np.frombuffer(payload, dtype='<f4', count=width * height, offset=HEIGHTMAP_HEADER_SIZE)
+
+    header = {
+        'version': version,
+        'width': width,
+        'height': height,
+        'minElevation': min_elev,
+        'maxElevation': max_elev,
+        'referenceElevation': reference,
+        'bounds': bounds,
+    }
+    return grid.reshape(height, width), header
+
+
+def compress_payload(payload, accept_encoding=''):
+    """Brotli when the client accepts it and the module is installed, else gzip"""
+    if brotli is not None and 'br' in accept_encoding:
+        return brotli.compress(payload, quality=5), 'br'
+    if 'gzip' in accept_encoding:
+        return gzip.compress(payload, compresslevel=6), 'gzip'
+    return payload, None
+
+
+@memoize_analysis("terrain_heightmap")
+def generate_3d_terrain_binary(dem_file="cropped.tif", dtype='uint16'):
+    """Binary heightmap for the analysed DEM, memoised per raster content"""
+    if dtype not in HEIGHTMAP_DTYPES:
+        raise ValueError(f"Unsupported heightmap dtype: {dtype}")
+
+    from volume_calculator import estimate_reference_elevation
+
+    dem_data, bounds = load_3d_elevation(dem_file)
+    reference = estimate_reference_elevation(dem_data)
+    return encode_heightmap(dem_data, bounds, dtype, reference)
+
+
+def generate_3d_terrain_mesh(dem_file="cropped.tif", level=0):
+    """
+    Adaptive RTIN mesh of the full-resolution DEM in the binary mesh format.
+    All LOD levels are built together and memoised per raster content.
+    """
+    from terrain_mesh import DEFAULT_LOD_ERRORS
+
+    if not 0 <= level < len(DEFAULT_LOD_ERRORS):
+        raise ValueError(f"LOD level must be between 0 and {len(DEFAULT_LOD_ERRORS) - 1}")
+
+    return build_3d_terrain_mesh_lods(dem_file)[level]
+
+
+@memoize_analysis("terrain_mesh")
+def build_3d_terrain_mesh_lods(dem_file="cropped.tif"):
+    """Encoded mesh payloads for every LOD level of a DEM"""
+    from terrain_mesh import DEFAULT_LOD_ERRORS, build_terrain_lods, encode_mesh
+    from volume_calculator import estimate_reference_elevation
+
+    dem_data, _ = load_3d_elevation(dem_file, downsample=False)
+    reference = estimate_reference_elevation(dem_data)
+    lods = build_terrain_lods(dem_data, DEFAULT_LOD_ERRORS)
+    height, width = dem_data.shape
+
+    print(f"🔺 Terrain mesh LODs: " + ", ".join(
+        f"{lod['max_error']:g}m → {lod['triangle_count']:,} tris" for lod in lods))
+    return [
+        encode_mesh(lod, width, height, index, reference)
+        for index, lod in enumerate(lods)
+    ]
+
+
+def benchmark_terrain_formats(dem_file="cropped.tif", repeat=5):
+    """
+    Compare payload size and serialization time of the JSON terrain
+    format against the binary heightmap variants
+    """
+    dem_data, bounds = load_3d_elevation(dem_file)
+
+    candidates = {
+        'json_indent': lambda: json.dumps({"elevation": dem_data.tolist()}, indent=2).encode(),
+        'json_compact': lambda: json.dumps({"elevation": dem_data.tolist()}, separators=(',', ':')).encode(),
+        'binary_float32': lambda: encode_heightmap(dem_data, bounds, 'float32'),
+        'binary_uint16': lambda: encode_heightmap(dem_data, bounds, 'uint16'),
+    }
+
+    results = {}
+    for name, serialize in candidates.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            payload = serialize()
+        serialize_ms = (time.perf_counter() - start) * 1000 / repeat
+
+        start = time.perf_counter()
+        compressed = gzip.compress(payload, compresslevel=6)
+        gzip_ms = (time.perf_counter() - start) * 1000
+
+        results[name] = {
+            'bytes': len(payload),
+            'gzip_bytes': len(compressed),
+            'serialize_ms': round(serialize_ms, 3),
+            'gzip_ms': round(gzip_ms, 3),
+        }
+
+    baseline = results['json_indent']['bytes']
+    for result in results.values():
+        result['size_vs_json_indent'] = round(result['bytes'] / baseline, 4)
+
+    print(f"📦 Terrain format benchmark ({dem_data.shape[1]} x {dem_data.shape[0]})")
+    for name, result in results.items():
+        print(f"   {name:15s} {result['bytes']:>10,d} B  gzip {result['gzip_bytes']:>10,d} B  "
+              f"{result['serialize_ms']:8.2f} ms")
+    return results
 # [file content end]
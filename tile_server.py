@@ -0,0 +1,328 @@
+import hashlib
+import io
+import math
+import os
+import threading
+from collections import OrderedDict
+
+import matplotlib
+import numpy as np
+import rasterio
+from flask import Blueprint, Response, request
+from PIL import Image  # Pillow ships with matplotlib
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.vrt import WarpedVRT
+
+from metrics import record_cache, stage
+
+TILE_SIZE = 256
+TILE_SOURCE = "cropped.tif"
+TILE_CACHE_DIR = os.path.join("static", "tiles")
+MEMORY_CACHE_TILES = 512
+DISK_CACHE_BYTES = 200 * 1024 * 1024
+
+# Half the width of the Web Mercator world in metres
+ORIGIN_SHIFT = 20037508.342789244
+
+LAYER_COLORMAPS = {
+    "elevation": "terrain",
+    "depth": "Spectral_r",
+    "slope": "YlOrRd",
+    "hillshade": "gray",
+}
+
+
+def tile_bounds(z, x, y):
+    """Web Mercator (EPSG:3857) bounds of an XYZ tile"""
+    tile_span = 2 * ORIGIN_SHIFT / (2 ** z)
+    left = -ORIGIN_SHIFT + x * tile_span
+    top = ORIGIN_SHIFT - y * tile_span
+    return left, top - tile_span, left + tile_span, top
+
+
+_lut_cache = {}
+
+
+def colormap_lut(name):
+    """256-entry RGBA lookup table for a matplotlib colormap"""
+    if name not in _lut_cache:
+        cmap = matplotlib.colormaps[name]
+        _lut_cache[name] = (cmap(np.linspace(0, 1, 256)) * 255).astype(np.uint8)
+    return _lut_cache[name]
+
+
+def raster_key(dem_file):
+    """Cheap identity of a raster file, changes whenever the file is rewritten"""
+    stat = os.stat(dem_file)
+    return f"{os.path.abspath(dem_file)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+_summary_cache = {}
+_summary_lock = threading.Lock()
+
+
+def raster_summary(dem_file):
+    """
+    Value ranges for colour scaling, computed once per raster from a
+    decimated (overview) read so every tile uses the same scale
+    """
+    key = raster_key(dem_file)
+    with _summary_lock:
+        if key in _summary_cache:
+            return _summary_cache[key]
+
+    from depth_analysis import estimate_original_surface
+
+    with rasterio.open(dem_file) as src:
+        scale = max(1, max(src.width, src.height) // 1024)
+        data = src.read(
+            1,
+            out_shape=(max(1, src.height // scale), max(1, src.width // scale)),
+            resampling=Resampling.nearest,
+        ).astype(np.float32)
+        if src.nodata is not None:
+            data[data == src.nodata] = np.nan
+
+    surface = float(estimate_original_surface(data))
+    summary = {
+        "min_elevation": float(np.nanmin(data)),
+        "max_elevation": float(np.nanmax(data)),
+        "surface_elevation": surface,
+        "max_depth": max(float(surface - np.nanmin(data)), 1.0),
+    }
+    with _summary_lock:
+        _summary_cache[key] = summary
+    return summary
+
+
+def read_tile_window(dem_file, z, x, y, buffer=1):
+    """
+    Read one tile (plus a pixel buffer for gradients) warped to Web
+    Mercator. GDAL only reads the source window under the tile and picks
+    an overview level when the tile is coarser than the raster.
+    """
+    left, bottom, right, top = tile_bounds(z, x, y)
+    pixel = (right - left) / TILE_SIZE
+    size = TILE_SIZE + 2 * buffer
+    tile_transform = from_bounds(
+        left - buffer * pixel, bottom - buffer * pixel,
+        right + buffer * pixel, top + buffer * pixel,
+        size, size,
+    )
+
+    with rasterio.open(dem_file) as src:
+        if src.crs is None:
+            return None, pixel
+        nodata = src.nodata if src.nodata is not None else -9999.0
+        with WarpedVRT(src, crs="EPSG:3857", transform=tile_transform,
+                       width=size, height=size, nodata=nodata,
+                       resampling=Resampling.bilinear) as vrt:
+            data = vrt.read(1).astype(np.float32)
+
+    data[data == nodata] = np.nan
+    return data, pixel
+
+
+def render_tile(dem_file, layer, z, x, y):
+    """Render a 256 px RGBA PNG tile for one analysis layer"""
+    data, pixel = read_tile_window(dem_file, z, x, y)
+    if data is None or np.all(np.isnan(data)):
+        return None
+
+    summary = raster_summary(dem_file)
+
+    if layer in ("slope", "hillshade"):
+        # Web Mercator metres are stretched by 1/cos(latitude)
+        _, bottom, _, top = tile_bounds(z, x, y)
+        lat = math.degrees(math.atan(math.sinh(((top + bottom) / 2) / 6378137.0)))
+        ground_pixel = pixel * math.cos(math.radians(lat))
+        grad_y, grad_x = np.gradient(data, ground_pixel)
+        if layer == "slope":
+            values = np.degrees(np.arctan(np.hypot(grad_x, grad_y)))
+            low, high = 0.0, 90.0
+        else:
+            azimuth, altitude = np.radians(315.0), np.radians(45.0)
+            slope = np.arctan(np.hypot(grad_x, grad_y))
+            aspect = np.arctan2(-grad_x, grad_y)
+            values = (np.sin(altitude) * np.cos(slope) +
+                      np.cos(altitude) * np.sin(slope) * np.cos(azimuth - aspect))
+            low, high = 0.0, 1.0
+    elif layer == "depth":
+        values = summary["surface_elevation"] - data
+        values[values <= 0] = np.nan
+        low, high = 0.0, summary["max_depth"]
+    else:
+        values = data
+        low, high = summary["min_elevation"], summary["max_elevation"]
+
+    values = values[1:-1, 1:-1]
+    missing = np.isnan(values)
+    scaled = (np.nan_to_num(values, nan=low) - low) * (255.0 / max(high - low, 1e-6))
+    index = np.clip(scaled, 0, 255).astype(np.uint8)
+
+    rgba = colormap_lut(LAYER_COLORMAPS[layer])[index]
+    rgba[missing, 3] = 0
+
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, mode="RGBA").save(buffer, format="PNG", optimize=False)
+    return buffer.getvalue()
+
+
+class TileCache:
+    """Two-tier LRU tile cache: an in-memory dict in front of a bounded disk directory"""
+
+    def __init__(self, cache_dir=TILE_CACHE_DIR, max_tiles=MEMORY_CACHE_TILES,
+                 max_bytes=DISK_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_tiles = max_tiles
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk_bytes = None
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, etag):
+        return os.path.join(self.cache_dir, etag[:2], f"{etag}.png")
+
+    def get(self, etag):
+        with self.lock:
+            if etag in self.memory:
+                self.memory.move_to_end(etag)
+                self.hits += 1
+                record_cache("tiles", True)
+                return self.memory[etag]
+
+        path = self._path(etag)
+        try:
+            with open(path, "rb") as f:
+                tile = f.read()
+            os.utime(path)  # mark as recently used for disk eviction
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            record_cache("tiles", False)
+            return None
+
+        self._remember(etag, tile)
+        with self.lock:
+            self.hits += 1
+        record_cache("tiles", True)
+        return tile
+
+    def put(self, etag, tile):
+        self._remember(etag, tile)
+
+        path = self._path(etag)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(tile)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            if self.disk_bytes is None:
+                self.disk_bytes = sum(size for _, _, size in self._disk_entries())
+            else:
+                self.disk_bytes += len(tile)
+            over_budget = self.disk_bytes > self.max_bytes
+        if over_budget:
+            self._evict_disk()
+
+    def _remember(self, etag, tile):
+        with self.lock:
+            self.memory[etag] = tile
+            self.memory.move_to_end(etag)
+            while len(self.memory) > self.max_tiles:
+                self.memory.popitem(last=False)
+
+    def _disk_entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".png"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, stat.st_mtime, stat.st_size
+
+    def _evict_disk(self):
+        """Drop least recently used tiles until the directory is at 80% of its budget"""
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        target = self.max_bytes * 0.8
+        for path, _, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        with self.lock:
+            self.disk_bytes = total
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "memory_tiles": len(self.memory),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+tile_cache = TileCache()
+
+
+
+def empty_tile():
+    """Transparent tile for areas outside the raster"""
+    if "empty" not in _lut_cache:
+        buffer = io.BytesIO()
+        Image.new("RGBA", (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0)).save(buffer, format="PNG")
+        _lut_cache["empty"] = buffer.getvalue()
+    return _lut_cache["empty"]
+
+
+def tile_etag(dem_file, layer, z, x, y):
+    identity = f"{raster_key(dem_file)}:{layer}:{z}/{x}/{y}"
+    return hashlib.sha1(identity.encode()).hexdigest()
+
+
+def create_tile_routes(app):
+    tiles = Blueprint("tiles", __name__)
+
+    @tiles.route("/tiles/<layer>/<int:z>/<int:x>/<int:y>.png")
+    def get_tile(layer, z, x, y):
+        """Serve one XYZ map tile of the analysed raster"""
+        if layer not in LAYER_COLORMAPS or not 0 <= z <= 24:
+            return Response("Unknown layer", status=404)
+        if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            return Response("Tile out of range", status=404)
+        if not os.path.exists(TILE_SOURCE):
+            return Response(empty_tile(), mimetype="image/png")
+
+        etag = tile_etag(TILE_SOURCE, layer, z, x, y)
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+        tile = tile_cache.get(etag)
+        if tile is None:
+            try:
+                with stage("tile_render"):
+                    tile = render_tile(TILE_SOURCE, layer, z, x, y) or empty_tile()
+            except Exception as e:
+                print(f"❌ Tile render error {layer}/{z}/{x}/{y}: {e}")
+                return Response(empty_tile(), mimetype="image/png")
+            tile_cache.put(etag, tile)
+
+        response = Response(tile, mimetype="image/png")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "public, max-age=60, must-revalidate"
+        return response
+
+    return tiles
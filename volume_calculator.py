@@ -4,29 +4,60 @@ import numpy as np
 import rasterio
 from scipy import integrate
 
-def calculate_excavation_volume(dem_file, reference_elevation=None):
+from geodesy import pixel_area_m2
+from precision import ACCUMULATOR_DTYPE, as_working, depth_totals, read_elevation
+from result_cache import memoize_analysis
+
+# Rows integrated per block, bounding the float64 temporaries of Simpson's rule
+INTEGRAL_BLOCK_ROWS = 512
+
+@memoize_analysis("excavation_volume")
+def calculate_excavation_volume(dem_file, reference_elevation=None, fill_voids=False, boundary=None):
     """
-    Calculate excavation volume using multiple methods
+    Calculate excavation volume using multiple methods.
+    With fill_voids, NoData holes inside the pit are inpainted first.
+    With a boundary, only the polygon is measured, boundary pixels by
+    the fraction inside it.
     """
     with rasterio.open(dem_file) as src:
-        dem_data = src.read(1)
+        dem_data = read_elevation(src)
         transform = src.transform
-        
-    dem_data = dem_data.astype(np.float64)
-    dem_data[dem_data == src.nodata] = np.nan
+        crs = src.crs
+    
+    if fill_voids:
+        from nodata_fill import fill_nodata
+        fill_nodata(dem_data)
     
     if reference_elevation is None:
         reference_elevation = estimate_reference_elevation(dem_data)
     
-    # Calculate depth map
-    depth_map = reference_elevation - dem_data
-    depth_map[depth_map < 0] = 0
+    # Calculate depth map in place: the elevations are not needed afterwards
+    depth_map = np.subtract(as_working(reference_elevation, dem_data), dem_data, out=dem_data)
+    np.maximum(depth_map, 0, out=depth_map)
+    
+    coverage = None
+    if boundary:
+        from pixel_coverage import pixel_coverage
+        coverage = pixel_coverage(boundary, transform, crs, depth_map.shape)
+        if coverage is not None:
+            depth_map[~coverage.covered] = np.nan
     
-    # Only consider areas with significant depth (> 1m)
+    return volume_from_depth(depth_map, transform, reference_elevation, crs, coverage)
+
+def volume_from_depth(depth_map, transform, reference_elevation, crs=None, coverage=None):
+    """
+    Volume figures from a depth map already measured below reference_elevation.
+    Pixel areas of geographic rasters are measured per row on the ellipsoid;
+    with a pixel_coverage.PixelCoverage (depth NaN outside the polygon), boundary
+    pixels count by their covered fraction.
+    """
+    # Only consider areas with significant depth (> 1m); NaN compares False
     quarry_mask = depth_map > 1.0
-    quarry_depths = depth_map[quarry_mask]
+    pixel_area = pixel_area_m2(transform, crs, depth_map.shape[0])
+    quarry_pixels, depth_sum, quarry_area, volume_pixel = depth_totals(
+        depth_map, quarry_mask, pixel_area, coverage)
     
-    if len(quarry_depths) == 0:
+    if quarry_pixels == 0:
         return {
             'volume_pixel_method_m3': 0,
             'volume_integral_method_m3': 0,
@@ -34,29 +65,28 @@ def calculate_excavation_volume(dem_file, reference_elevation=None):
             'max_excavation_depth_m': 0,
             'excavation_area_m2': 0,
             'material_categories': {},
-            'reference_elevation': reference_elevation,
+            'reference_elevation': float(reference_elevation),
             'quarry_pixels': 0
         }
     
-    # Method 1: Pixel-based volume calculation
-    pixel_area = abs(transform[0] * transform[4])
-    volume_pixel = np.nansum(quarry_depths) * pixel_area
+    # Method 1: Pixel-based volume calculation (volume_pixel above)
     
     # Method 2: Integration-based
-    volume_integral = calculate_integral_volume(depth_map, transform)
+    volume_integral = calculate_integral_volume(depth_map, transform, crs, coverage)
     
     # Calculate material categories based on depth
-    material_categories = categorize_excavation_material(depth_map, transform)
+    material_categories = categorize_excavation_material(depth_map, transform, crs, coverage)
+    quarry_weight = quarry_pixels if coverage is None else coverage.weight_sum(quarry_mask)
     
     return {
         'volume_pixel_method_m3': float(volume_pixel),
         'volume_integral_method_m3': float(volume_integral),
-        'average_depth_m': float(np.nanmean(quarry_depths)),
-        'max_excavation_depth_m': float(np.nanmax(quarry_depths)),
-        'excavation_area_m2': float(np.sum(quarry_mask) * pixel_area),
+        'average_depth_m': float(depth_sum / quarry_weight),
+        'max_excavation_depth_m': float(np.max(depth_map, where=quarry_mask, initial=0)),
+        'excavation_area_m2': float(quarry_area),
         'material_categories': material_categories,
         'reference_elevation': float(reference_elevation),
-        'quarry_pixels': int(np.sum(quarry_mask))
+        'quarry_pixels': int(quarry_pixels)
     }
 
 def estimate_reference_elevation(dem_data):
@@ -64,7 +94,7 @@ def estimate_reference_elevation(dem_data):
     Estimate original ground elevation using terrain analysis
     """
     # Use 85th percentile as reference (high points around quarry)
-    flat_dem = dem_data[~np.isnan(dem_data)].flatten()
+    flat_dem = dem_data[~np.isnan(dem_data)]
     
     if len(flat_dem) > 0:
         reference = np.percentile(flat_dem, 85)
@@ -73,7 +103,7 @@ def estimate_reference_elevation(dem_data):
     
     return reference
 
-def calculate_integral_volume(depth_map, transform):
+def calculate_integral_volume(depth_map, transform, crs=None, coverage=None):
     """
     Calculate volume using numerical integration
     """
@@ -82,27 +112,31 @@ def calculate_integral_volume(depth_map, transform):
     if not np.any(quarry_mask):
         return 0
     
-    # Create grid for integration
-    x_res = abs(transform[0])
-    y_res = abs(transform[4])
-    
-    x = np.arange(depth_map.shape[1]) * x_res
-    y = np.arange(depth_map.shape[0]) * y_res
-    
-    # Integrate only quarry areas
-    quarry_depths = np.where(quarry_mask, depth_map, 0)
+    # Integrate over pixel indices, weighting each row by its pixel area
+    # (dx * dy, constant unless the raster is geographic)
+    row_areas = np.broadcast_to(pixel_area_m2(transform, crs, depth_map.shape[0]),
+                                depth_map.shape[:1])
+    row_volumes = np.empty(depth_map.shape[0], dtype=ACCUMULATOR_DTYPE)
     
     try:
-        volume = integrate.simps(integrate.simps(quarry_depths, x), y)
+        for start in range(0, depth_map.shape[0], INTEGRAL_BLOCK_ROWS):
+            block = depth_map[start:start + INTEGRAL_BLOCK_ROWS]
+            quarry_depths = np.where(block > 1.0, block, 0).astype(ACCUMULATOR_DTYPE, copy=False)
+            if coverage is not None:
+                coverage.weight_rows(quarry_depths, start)
+            row_volumes[start:start + len(block)] = (integrate.simpson(quarry_depths, dx=1.0)
+                                                     * row_areas[start:start + len(block)])
+        volume = integrate.simpson(row_volumes, dx=1.0)
         return float(abs(volume))
-    except:
+    except Exception as e:
+        print(f"⚠️ Integral volume failed: {e}")
         return 0
 
-def categorize_excavation_material(depth_map, transform):
+def categorize_excavation_material(depth_map, transform, crs=None, coverage=None):
     """
     Categorize excavation into material types based on depth ranges
     """
-    pixel_area = abs(transform[0] * transform[4])
+    pixel_area = pixel_area_m2(transform, crs, depth_map.shape[0])
     
     categories = {
         'shallow_0_5m': {'depth_range': (1, 5), 'volume_m3': 0, 'area_m2': 0},
@@ -113,10 +147,9 @@ def categorize_excavation_material(depth_map, transform):
     
     for category, info in categories.items():
         min_depth, max_depth = info['depth_range']
-        mask = (depth_map >= min_depth) & (depth_map < max_depth) & (~np.isnan(depth_map))
+        mask = (depth_map >= min_depth) & (depth_map < max_depth)  # False on NaN
         
-        category_volume = np.sum(depth_map[mask]) * pixel_area
-        category_area = np.sum(mask) * pixel_area
+        _, _, category_area, category_volume = depth_totals(depth_map, mask, pixel_area, coverage)
         
         categories[category]['volume_m3'] = float(category_volume)
         categories[category]['area_m2'] = float(category_area)